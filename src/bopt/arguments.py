@@ -10,6 +10,7 @@ def parse_args():
     parser.add_argument('--task', type=str, choices=["morpheme_prediction", "language_modeling", "skip_gram", "sentiment_analysis"], default="morpheme_prediction", help='name of the task', required=True)
     parser.add_argument('--overwrite_output_dir', action='store_true')
     parser.add_argument('--overwrite_cache', action='store_true')
+    parser.add_argument('--cache_store', type=str, default=None, help="directory of preprocessed caches shared by runs, keyed by a fingerprint of the data, the tokenizer and the preprocessing arguments, runs hard link them into their own cache")
 
     parser.add_argument('--input_vocab', type=str, default=None, required=True)
     parser.add_argument('--continuing_subword_prefix', type=str)
@@ -29,6 +30,8 @@ def parse_args():
     parser.add_argument('--eval_steps', type=int, default=10)
     parser.add_argument('--save_epochs', type=int)
     parser.add_argument('--save_steps', type=int, default=1000)
+    parser.add_argument('--compaction_epochs', type=int, default=None, help="every this many epochs, drop the units with a potential below compaction_threshold from the vocabulary, the model and the caches")
+    parser.add_argument('--compaction_threshold', type=float, default=1e-6)
     parser.add_argument('--train_dataset', type=str, default=None, required=False)
     parser.add_argument('--encoding', type=str, default=None, required=False)
     parser.add_argument('--eval_dataset', type=str, default=None, required=False)
@@ -38,9 +41,12 @@ def parse_args():
 
     parser.add_argument('--gpu_batch_size', type=int, default=8)
     parser.add_argument('--eval_gpu_batch_size', type=int, default=None)
+    parser.add_argument('--batch_token_budget', type=int, default=None, help="batch the training examples by similar numbers of blocks and block lengths, as many as fit in this many positions of the (trimmed) lattice inputs, instead of --gpu_batch_size examples (every batch still counts as one gpu batch towards --train_batch_size)")
     parser.add_argument('--train_batch_size', type=int, default=8)
     parser.add_argument('--eval_batch_size', type=int, default=16)
     parser.add_argument('--data_num_workers', type=int, default=1)
+    parser.add_argument('--preprocessing_num_workers', type=int, default=1, help="preprocess the datasets in this many processes, over parts of --preprocessing_lines_per_part lines (an interrupted preprocessing resumes with the unfinished parts)")
+    parser.add_argument('--preprocessing_lines_per_part', type=int, default=10000)
 
     parser.add_argument('--max_grad_norm', type=int, default=1)
     parser.add_argument('--learning_rate', type=float, default=6.25e-5)
@@ -60,6 +66,13 @@ def parse_args():
 
     parser.add_argument('--bias_mode', type=str, choices=["albo", "mult_then_renorm"], default="albo")
     parser.add_argument('--vopt', action='store_true')
+    parser.add_argument('--factorized_bias', action='store_true', help="keep the lattice attention bias factorized per block instead of a dense [S, S] tensor (language modeling)")
+    parser.add_argument('--prune_threshold', type=float, default=None, help="drop the lattice edges with a marginal below this from the model inputs")
+    parser.add_argument('--prune_top_k', type=int, default=None, help="only keep the k most likely lattice edges starting at every character in the model inputs")
+    parser.add_argument('--statistics_cache_mb', type=int, default=256, help="cache the lattice statistics of every word between tokenizer updates (for evaluation and frozen tokenizers) up to this many MB, 0 disables it")
+    parser.add_argument('--scan_min_block_length', type=int, default=None, help="run the log partition sweeps (forward_algorithm) over blocks at least this long as a log-depth scan instead of a loop over the characters")
+    parser.add_argument('--stale_lattice', action='store_true', help="compute the lattice statistics of the next batch on a worker thread while the model runs on the current one, with the tokenizer weights of one update before (training only)")
+    parser.add_argument('--candidate_output_head', action='store_true', help="in the lattice language model, only score the candidate output units of every node (over chunks of the output vocabulary) instead of a log_softmax over the whole output vocabulary, which saves the memory of the [batch, N * L, V] logits at the cost of recomputing them in backward")
     parser.add_argument('--debug_viterbi_lattice', action='store_true')
     parser.add_argument('--debug_node_unigram', action='store_true')
     parser.add_argument('--debug_fixed_point', action='store_true')
@@ -118,6 +131,12 @@ def check_args(args):
     else:
         if len(os.listdir(args.output_dir)) != 0 and not args.overwrite_output_dir:
             raise ValueError("Output dir exists and is non-empty, please set overwrite_output_dir to True")
+    if args.compaction_epochs is not None and not args.vopt:
+        raise ValueError("vocabulary compaction needs a learned vocabulary (vopt)")
+    if args.stale_lattice and (not args.vopt or args.mixture_count > 1 or args.debug_fixed_point):
+        raise ValueError("stale lattice statistics need a learned vocabulary (vopt) without mixtures of lattices or debug_fixed_point")
+    if args.batch_token_budget is not None and (args.task != "language_modeling" or not args.vopt):
+        raise ValueError("token budget batching needs language_modeling with a learned vocabulary (vopt)")
     if args.task not in ["morpheme_prediction", "sentiment_analysis"] and args.eval_segmentation:
         raise NotImplementedError(f"eval_segmentation is not implemented with {args.task}")
     return args
\ No newline at end of file
@@ -0,0 +1,219 @@
+from typing import Callable, Iterator, NamedTuple, Optional, Tuple, Union
+
+import torch
+
+INF = 1e9
+
+
+class BlockAttentionBias(NamedTuple):
+    """
+    Factorized lattice attention bias of N blocks of E edges (and L nodes), equivalent to the dense [B, S, S] bias of
+    `LatticeAttentionMixin.tile` (S = N * E) or `tile_lm` (S = N * (E + L), the edges of all blocks followed by the
+    nodes of all blocks) without materializing it.
+
+    Within its block a query uses the conditionals of the block, across blocks every query sees the same marginals
+    of the key block, so only O(N * E^2) values are kept instead of O((N * E)^2). With nodes (language modeling) the
+    bias is causal, queries see the edges of their own block (masked causally) and of the blocks before them.
+
+    edge_conditionals: [B, N, E, E] (log) bias of the edges of a block for the edges of the same block
+    edge_marginals: [B, N, E] (log) bias of the edges of a block for the edge queries of other blocks
+    edge_mask: [B, N, E] 0 for edge queries that don't attend to anything
+    node_conditionals: [B, N, L, E] (log) bias of the nodes of a block for the edges of the same block
+    node_marginals: [B, N, E] (log) bias of the edges of a block for the node queries of later blocks
+    node_previous: [B, N, E] (log) bias of the first node of a block for the edges of the block before it, which
+                   uses the conditionals of the last node of that block instead of its marginals
+    node_mask: [B, N, L] 0 for node queries that don't attend to anything (not even themselves)
+    fill: value of the keys a query doesn't attend to
+    diagonal: if set, value of every query for itself (key = query), regardless of the masks
+    """
+    edge_conditionals: torch.FloatTensor
+    edge_marginals: torch.FloatTensor
+    edge_mask: torch.FloatTensor
+    node_conditionals: Optional[torch.FloatTensor] = None
+    node_marginals: Optional[torch.FloatTensor] = None
+    node_previous: Optional[torch.FloatTensor] = None
+    node_mask: Optional[torch.FloatTensor] = None
+    fill: float = -INF
+    diagonal: Optional[float] = None
+
+    @property
+    def causal(self) -> bool:
+        return self.node_conditionals is not None
+
+    def size(self, dim: int = None):
+        B, N, E = self.edge_marginals.size()
+        S = N * E + (N * self.node_mask.size(-1) if self.causal else 0)
+        size = torch.Size((B, S, S))
+        return size if dim is None else size[dim]
+
+    def map(self, fn: Callable[[torch.Tensor], torch.Tensor]) -> "BlockAttentionBias":
+        """
+        Applies an elementwise `fn` to the bias values (including `fill` and `diagonal`, not the masks).
+        """
+        def constant(value):
+            return None if value is None else fn(torch.tensor(value, dtype=self.edge_marginals.dtype)).item()
+        values = dict(edge_conditionals=fn(self.edge_conditionals), edge_marginals=fn(self.edge_marginals), fill=constant(self.fill), diagonal=constant(self.diagonal))
+        if self.causal:
+            values.update(node_conditionals=fn(self.node_conditionals), node_marginals=fn(self.node_marginals), node_previous=fn(self.node_previous))
+        return self._replace(**values)
+
+    def max(self) -> torch.FloatTensor:
+        values = [self.edge_conditionals, self.edge_marginals] + ([self.node_conditionals, self.node_marginals, self.node_previous] if self.causal else [])
+        return torch.stack([v.max() for v in values]).max()
+
+    def edge_rows(self, block: int) -> torch.FloatTensor:
+        """
+        Dense bias [B, E, S] of the edge queries of `block`.
+        """
+        B, N, E = self.edge_marginals.size()
+        bias = self.edge_marginals.unsqueeze(1).expand(B, E, N, E).clone()
+        bias[:, :, block] = self.edge_conditionals[:, block]
+        if self.causal:
+            bias[:, :, block + 1:] = self.fill
+        bias = bias.reshape(B, E, N * E)
+        if self.causal:
+            bias = torch.cat([bias, bias.new_full((B, E, self.node_mask.size(1) * self.node_mask.size(2)), self.fill)], -1)
+        return self.set_diagonal(bias.masked_fill(self.edge_mask[:, block, :, None] == 0, self.fill), block * E)
+
+    def node_rows(self, block: int) -> torch.FloatTensor:
+        """
+        Dense bias [B, L, S] of the node queries of `block`.
+        """
+        B, N, L = self.node_mask.size()
+        E = self.edge_marginals.size(-1)
+        bias = self.node_marginals.unsqueeze(1).expand(B, L, N, E).clone()
+        bias[:, :, block] = self.node_conditionals[:, block]
+        if block > 0:
+            bias[:, 0, block - 1] = self.node_previous[:, block]
+        bias[:, :, block + 1:] = self.fill
+
+        # nodes only attend to themselves among the nodes
+        nodes = bias.new_full((B, L, N, L), self.fill)
+        nodes[:, :, block] = (1 - torch.eye(L, dtype=bias.dtype, device=bias.device)) * self.fill
+        bias = torch.cat([bias.reshape(B, L, N * E), nodes.reshape(B, L, N * L)], -1)
+        return self.set_diagonal(bias.masked_fill(self.node_mask[:, block, :, None] == 0, self.fill), N * E + block * L)
+
+    def set_diagonal(self, bias: torch.FloatTensor, row_offset: int) -> torch.FloatTensor:
+        if self.diagonal is None:
+            return bias
+        Q, S = bias.size()[-2:]
+        return bias.masked_fill(torch.arange(S, device=bias.device)[None, :] == torch.arange(row_offset, row_offset + Q, device=bias.device)[:, None], self.diagonal)
+
+    def row_blocks(self) -> Iterator[Tuple[int, int, torch.FloatTensor]]:
+        """
+        Yields the query rows (start, stop) of every block with their dense bias [B, stop - start, S].
+        """
+        B, N, E = self.edge_marginals.size()
+        for block in range(N):
+            yield block * E, (block + 1) * E, self.edge_rows(block)
+        if self.causal:
+            L = self.node_mask.size(-1)
+            for block in range(N):
+                yield N * E + block * L, N * E + (block + 1) * L, self.node_rows(block)
+
+    def dense(self) -> torch.FloatTensor:
+        """
+        Materializes the [B, S, S] bias (e.g. for logging).
+        """
+        return torch.cat([bias for _, _, bias in self.row_blocks()], 1)
+
+
+class AttentionBiasBundle(NamedTuple):
+    """
+    The layer independent part of a lattice attention bias, prepared once per batch by `prepare_attention_bias` and
+    shared by all the layers of the encoder.
+
+    bias: [B, 1, S, S] or a `BlockAttentionBias`, the (log) attention bias, for albo with the diagonal set to 0 to
+          prevent underflow by allowing one nonzero marginal
+    log_complements: (albo only) log(1 - (1 - epsilon) * exp(bias)), in the same layout as bias
+    """
+    bias: Union[torch.FloatTensor, BlockAttentionBias]
+    log_complements: Union[torch.FloatTensor, BlockAttentionBias] = None
+
+    def row_blocks(self) -> Iterator[Tuple[int, int, torch.FloatTensor, Optional[torch.FloatTensor]]]:
+        """
+        Yields the query rows (start, stop) of every block of a factorized bias with their dense bias and log
+        complements [B, 1, stop - start, S].
+        """
+        complements = self.log_complements.row_blocks() if self.log_complements is not None else None
+        for start, stop, bias in self.bias.row_blocks():
+            yield start, stop, bias.unsqueeze(1), next(complements)[2].unsqueeze(1) if complements is not None else None
+
+
+def log_complement(log_marginals: torch.FloatTensor, epsilon: float = 1e-6) -> torch.FloatTensor:
+    return torch.log1p(-(1-epsilon) * log_marginals.exp())
+
+
+def prepare_attention_bias(attn_bias: Union[torch.FloatTensor, BlockAttentionBias], bias_mode: str, mixture_bias: bool = False, epsilon: float = 1e-6) -> AttentionBiasBundle:
+    """
+    Everything about the attention bias that doesn't depend on the layer: the head dimension, the diagonal and the log
+    complements of albo.
+
+    attn_bias: [B, S, S], [B, 1, S, S], [B, K, S, S] with mixture_bias (K lattices) or a `BlockAttentionBias`
+    """
+    if isinstance(attn_bias, BlockAttentionBias):
+        if mixture_bias:
+            raise ValueError("mixture_bias is not supported with a factorized attention bias")
+        if bias_mode == "albo":
+            attn_bias = attn_bias._replace(diagonal=0.0)
+            return AttentionBiasBundle(attn_bias, attn_bias.map(lambda x: log_complement(x, epsilon)))
+        return AttentionBiasBundle(attn_bias)
+
+    if attn_bias.dim() == 3:
+        attn_bias = attn_bias.unsqueeze(1)
+    if attn_bias.dim() == 4 and mixture_bias:
+        attn_bias = attn_bias.transpose(0,1)
+    if bias_mode == "albo":
+        eye = torch.eye(attn_bias.size(-1), dtype=torch.bool, device=attn_bias.device)
+        attn_bias = attn_bias.masked_fill(eye, 0.0)
+        return AttentionBiasBundle(attn_bias, log_complement(attn_bias, epsilon))
+    return AttentionBiasBundle(attn_bias)
+
+
+def albo_attention_probs(attention_scores: torch.FloatTensor, log_marginals: torch.FloatTensor, log_complements: torch.FloatTensor) -> torch.FloatTensor:
+    """
+    ALBO attention, p_ij = m_ij q_ij / (sum_k m_ik q_ik + (1 - (1 - epsilon) m_ij) q_ij) with q = softmax(attention_scores)
+    and m the marginals, in log space.
+
+    attention_scores: [B, H, Q, S]
+    log_marginals: [B, 1, Q, S] (log) attention bias
+    log_complements: [B, 1, Q, S] log(1 - (1 - epsilon) m)
+    """
+    log_attention_probs = torch.log_softmax(attention_scores, dim=-1)
+    log_numerators = log_marginals + log_attention_probs
+    log_adjustment = log_complements + log_attention_probs
+    log_denominators = torch.logaddexp(torch.logsumexp(log_numerators, dim=-1, keepdim=True), log_adjustment)
+    return (log_numerators - log_denominators).exp()
+
+
+class AlboAttentionFunction(torch.autograd.Function):
+    """
+    `albo_attention_probs` over chunks of query rows. None of the [B, H, S, S] intermediates are kept, backward
+    recomputes them one chunk at a time from the scores and the bias.
+    """
+
+    @staticmethod
+    def forward(ctx, attention_scores, log_marginals, log_complements, chunk_size):
+        ctx.save_for_backward(attention_scores, log_marginals, log_complements)
+        ctx.chunk_size = chunk_size
+        attention_probs = torch.empty_like(attention_scores)
+        for start in range(0, attention_scores.size(-2), chunk_size):
+            rows = slice(start, start + chunk_size)
+            attention_probs[..., rows, :] = albo_attention_probs(attention_scores[..., rows, :], log_marginals[..., rows, :], log_complements[..., rows, :])
+        return attention_probs
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_probs):
+        inputs = ctx.saved_tensors
+        input_grads = [torch.zeros_like(x) if needs_grad else None for x, needs_grad in zip(inputs, ctx.needs_input_grad)]
+        for start in range(0, inputs[0].size(-2), ctx.chunk_size):
+            rows = slice(start, start + ctx.chunk_size)
+            with torch.enable_grad():
+                chunk = [x[..., rows, :].detach().requires_grad_(grad is not None) for x, grad in zip(inputs, input_grads)]
+                probs = albo_attention_probs(*chunk)
+                grads = iter(torch.autograd.grad(probs, [x for x in chunk if x.requires_grad], grad_probs[..., rows, :]))
+            for grad in input_grads:
+                if grad is not None:
+                    grad[..., rows, :] = next(grads)
+        return (*input_grads, None)
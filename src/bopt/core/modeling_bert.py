@@ -54,6 +54,8 @@ from transformers.modeling_utils import (
 )
 from transformers.utils import logging
 
+from bopt.core.attention_bias import AlboAttentionFunction, AttentionBiasBundle, prepare_attention_bias
+
 EPSILON = 1e-6
 DEBUG = False
 
@@ -347,12 +349,32 @@ class BertSelfAttention(nn.Module):
             self.distance_embedding = nn.Embedding(2 * config.max_position_embeddings - 1, self.attention_head_size)
 
         self.is_decoder = config.is_decoder
+        self.albo_chunk_size = getattr(config, "albo_chunk_size", 256) # query rows per chunk of the albo attention
 
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
         x = x.view(*new_x_shape)
         return x.permute(0, 2, 1, 3)
 
+    def biased_attention_probs(self, attention_scores, attn_bias, bias_mode, log_complements=None):
+        """
+        Combines attention scores [B, H, Q, S] with a prepared (log) lattice attention bias [B, 1, Q, S] according to
+        bias_mode (see `prepare_attention_bias`, albo also needs the log complements).
+        """
+        if bias_mode == "mult_then_renorm":
+            attention_scores = attention_scores + attn_bias
+            attention_probs = nn.Softmax(dim=-1)(attention_scores)
+        elif bias_mode == "norm_then_threshold":
+            attention_transformer = nn.Softmax(dim=-1)(attention_scores)
+            attention_threshold = attn_bias.exp()
+            attention_probs = torch.min(attention_transformer, attention_threshold)
+        elif bias_mode == "albo":
+            attention_probs = AlboAttentionFunction.apply(attention_scores, attn_bias, log_complements, self.albo_chunk_size)
+        else:
+            print(bias_mode)
+            raise ValueError
+        return attention_probs
+
     def forward(
         self,
         hidden_states,
@@ -428,44 +450,16 @@ class BertSelfAttention(nn.Module):
             attention_scores = attention_scores + attention_mask
 
 
-        if attn_bias is not None:
-            if attn_bias.dim() == 3:
-                attn_bias = attn_bias.unsqueeze(1)
-            if attn_bias.dim() == 4 and mixture_bias:
-                attn_bias = attn_bias.transpose(0,1)
-            if bias_mode == "mult_then_renorm":
-                attention_scores += attn_bias
-                attention_probs = nn.Softmax(dim=-1)(attention_scores)
-            elif bias_mode == "norm_then_threshold":
-                attention_transformer = nn.Softmax(dim=-1)(attention_scores)
-                attention_threshold = attn_bias.exp()
-                attention_probs = torch.min(attention_transformer, attention_threshold)
-            elif bias_mode == "albo":
-                eye = torch.eye(attn_bias.size(-1), dtype=attn_bias.dtype, device=attn_bias.device).unsqueeze(0)
-                log_marginals = attn_bias * (1 - eye)  # prevent underflow by allowing one nonzero marginal
-                log_attention_probs = torch.log_softmax(attention_scores, dim=-1)
-                log_numerators = log_marginals + log_attention_probs
-                log_adjustment = torch.log(1-(1-EPSILON) * log_marginals.exp()) + log_attention_probs
-                log_denominators = torch.logaddexp(torch.logsumexp(log_numerators, dim=-1,keepdim=True), log_adjustment)
-                attention_probs = (log_numerators - log_denominators).exp()
-                if DEBUG: code.interact(local=locals())
-                # min_ = log_denominators.min()
-                # max_ = log_denominators.max()
-                # local = locals()
-                # def intercept(grad):
-                #     print("############## intercept ##############")
-                #     nonlocal local
-                #     code.interact(local=dict(list(local.items()) + [("grad", grad)]))
-                #attention_probs.register_hook(intercept)
-                # if attention_probs.isnan().any():
-                #     print("Nan attention probs detected")
-                # if attention_probs.isinf().any():
-                #     print("inf attention probs detected")
-                # print(min_, max_)
-                # code.interact(local=locals())
-            else:
-                print(bias_mode)
-                raise ValueError
+        if attn_bias is not None and not isinstance(attn_bias, AttentionBiasBundle):
+            # normally prepared once for all layers in BertModel forward()
+            attn_bias = prepare_attention_bias(attn_bias, bias_mode, mixture_bias=mixture_bias, epsilon=EPSILON)
+
+        if attn_bias is not None and not torch.is_tensor(attn_bias.bias):
+            # apply the bias one block of query rows at a time so that the dense [B, S, S] bias never exists
+            attention_probs = torch.cat([self.biased_attention_probs(attention_scores[:, :, start:stop], bias, bias_mode, log_complements)
+                                         for start, stop, bias, log_complements in attn_bias.row_blocks()], dim=2)
+        elif attn_bias is not None:
+            attention_probs = self.biased_attention_probs(attention_scores, attn_bias.bias, bias_mode, attn_bias.log_complements)
         else:
             # Normalize the attention scores to probabilities.
             attention_probs = nn.Softmax(dim=-1)(attention_scores)
@@ -808,10 +802,57 @@ class BertPredictionHeadTransform(nn.Module):
         return hidden_states
 
 
+class LinearCandidateLogSoftmaxFunction(torch.autograd.Function):
+    """
+    log_softmax(hidden_states @ weight.T + bias, -1) gathered at candidate_ids [..., K], over chunks of the output
+    vocabulary. The logits of a chunk give both its share of the log normalizer and the logits of the candidates in
+    it, so neither the [..., V] logits nor the [..., K, hidden_size] candidate rows of weight are built or kept,
+    backward recomputes the logits one chunk at a time from the hidden states and the log normalizers.
+    """
+
+    @staticmethod
+    def forward(ctx, hidden_states, weight, bias, candidate_ids, chunk_size):
+        log_normalizers = hidden_states.new_full(hidden_states.size()[:-1], -float("inf"))
+        candidate_logits = hidden_states.new_zeros(candidate_ids.size())
+        for start in range(0, weight.size(0), chunk_size):
+            logits = nn.functional.linear(hidden_states, weight[start:start + chunk_size], bias[start:start + chunk_size])
+            log_normalizers = torch.logaddexp(log_normalizers, torch.logsumexp(logits, dim=-1))
+            in_chunk = (candidate_ids >= start) & (candidate_ids < start + logits.size(-1))
+            chunk_logits = torch.gather(logits, -1, (candidate_ids - start).clamp(0, logits.size(-1) - 1))
+            candidate_logits = torch.where(in_chunk, chunk_logits, candidate_logits)
+        ctx.save_for_backward(hidden_states, weight, bias, candidate_ids, log_normalizers)
+        ctx.chunk_size = chunk_size
+        return candidate_logits - log_normalizers.unsqueeze(-1)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_log_probs):
+        hidden_states, weight, bias, candidate_ids, log_normalizers = ctx.saved_tensors
+        grad_hidden_states, grad_weight, grad_bias = [torch.zeros_like(x) if needs_grad else None for x, needs_grad in zip((hidden_states, weight, bias), ctx.needs_input_grad[:3])]
+        flat_hidden_states = hidden_states.reshape(-1, hidden_states.size(-1))
+        grad_log_normalizers = grad_log_probs.sum(-1, keepdim=True)
+        for start in range(0, weight.size(0), ctx.chunk_size):
+            rows = slice(start, start + ctx.chunk_size)
+            logits = nn.functional.linear(hidden_states, weight[rows], bias[rows])
+            # d log_softmax_k / d logits = onehot(candidate k) - softmax
+            grad_logits = - (logits - log_normalizers.unsqueeze(-1)).exp() * grad_log_normalizers
+            in_chunk = (candidate_ids >= start) & (candidate_ids < start + logits.size(-1))
+            grad_logits.scatter_add_(-1, (candidate_ids - start).clamp(0, logits.size(-1) - 1), grad_log_probs * in_chunk)
+            if grad_hidden_states is not None:
+                grad_hidden_states += grad_logits @ weight[rows]
+            grad_logits = grad_logits.reshape(-1, grad_logits.size(-1))
+            if grad_weight is not None:
+                grad_weight[rows] = grad_logits.t() @ flat_hidden_states
+            if grad_bias is not None:
+                grad_bias[rows] = grad_logits.sum(0)
+        return grad_hidden_states, grad_weight, grad_bias, None, None
+
+
 class BertLMPredictionHead(nn.Module):
     def __init__(self, config):
         super().__init__()
         self.transform = BertPredictionHeadTransform(config)
+        self.output_chunk_size = getattr(config, "output_chunk_size", 4096) # vocabulary rows per chunk of the log normalizer
 
         # The output weights are the same as the input embeddings, but there is
         # an output-only bias for each token.
@@ -833,13 +874,30 @@ class BertLMPredictionHead(nn.Module):
             hidden_states = hidden_states + self.expert_coefficient * unigram_expert[None, None, :]
         return hidden_states
 
+    def candidate_log_probs(self, hidden_states, candidate_ids, unigram_expert=None):
+        """
+        Log probabilities [..., K] of the `candidate_ids` [..., K] of every position, the same values as gathering
+        them from the log_softmax of `forward`, computed over chunks of the vocabulary without keeping the [..., V]
+        logits (see `LinearCandidateLogSoftmaxFunction`).
+
+        hidden_states: [..., hidden_size]
+        """
+        hidden_states = self.transform(hidden_states)
+        bias = self.decoder.bias
+        if unigram_expert is not None:
+            bias = bias + self.expert_coefficient * unigram_expert
+        return LinearCandidateLogSoftmaxFunction.apply(hidden_states, self.decoder.weight, bias, candidate_ids, self.output_chunk_size)
+
 
 class BertOnlyMLMHead(nn.Module):
     def __init__(self, config):
         super().__init__()
         self.predictions = BertLMPredictionHead(config)
 
-    def forward(self, sequence_output, unigram_expert=None):
+    def forward(self, sequence_output, unigram_expert=None, candidate_ids=None):
+        if candidate_ids is not None:
+            # only score the last candidate_ids.size(1) positions
+            return self.predictions.candidate_log_probs(sequence_output[:, -candidate_ids.size(1):], candidate_ids, unigram_expert=unigram_expert)
         prediction_scores = self.predictions(sequence_output, unigram_expert=unigram_expert)
         return prediction_scores
 
@@ -1144,6 +1202,9 @@ class BertModel(BertPreTrainedModel):
             inputs_embeds=inputs_embeds,
             past_key_values_length=past_key_values_length,
         )
+        if attn_bias is not None:
+            # the bias doesn't depend on the layer, only the scores do
+            attn_bias = prepare_attention_bias(attn_bias, bias_mode, mixture_bias=mixture_bias, epsilon=EPSILON)
         encoder_outputs = self.encoder(
             embedding_output,
             attention_mask=extended_attention_mask,
@@ -1478,15 +1539,22 @@ class BertForMaskedLM(BertPreTrainedModel):
         attn_bias=None,
         mixture_bias=False,
         unigram_expert=None,
+        output_candidates=None,
     ):
         r"""
         labels (:obj:`torch.LongTensor` of shape :obj:`(batch_size, sequence_length)`, `optional`):
             Labels for computing the masked language modeling loss. Indices should be in ``[-100, 0, ...,
             config.vocab_size]`` (see ``input_ids`` docstring) Tokens with indices set to ``-100`` are ignored
             (masked), the loss is only computed for the tokens with labels in ``[0, ..., config.vocab_size]``
+        output_candidates (:obj:`torch.LongTensor` of shape :obj:`(batch_size, num_positions, num_candidates)`, `optional`):
+            Output ids to score at the last ``num_positions`` positions. If given, ``logits`` are the log
+            probabilities of the candidates, of shape :obj:`(batch_size, num_positions, num_candidates)`, instead of
+            the scores of the whole vocabulary.
         """
 
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+        if output_candidates is not None and labels is not None:
+            raise ValueError("labels are not supported with output_candidates")
 
         outputs = self.bert(
             input_ids,
@@ -1506,7 +1574,7 @@ class BertForMaskedLM(BertPreTrainedModel):
         )
 
         sequence_output = outputs[0]
-        prediction_scores = self.cls(sequence_output, unigram_expert=unigram_expert)
+        prediction_scores = self.cls(sequence_output, unigram_expert=unigram_expert, candidate_ids=output_candidates)
 
         masked_lm_loss = None
         if labels is not None:
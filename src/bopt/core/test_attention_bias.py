@@ -0,0 +1,72 @@
+import torch
+
+from bopt.core.attention_bias import AlboAttentionFunction, BlockAttentionBias, INF, prepare_attention_bias
+
+EPSILON = 1e-6
+
+
+def reference_albo_attention_probs(attention_scores, attn_bias):
+    # the unfused albo branch of BertSelfAttention, every intermediate is a full [B, H, S, S] tensor
+    eye = torch.eye(attn_bias.size(-1), dtype=attn_bias.dtype, device=attn_bias.device).unsqueeze(0)
+    log_marginals = attn_bias * (1 - eye)
+    log_attention_probs = torch.log_softmax(attention_scores, dim=-1)
+    log_numerators = log_marginals + log_attention_probs
+    log_adjustment = torch.log(1-(1-EPSILON) * log_marginals.exp()) + log_attention_probs
+    log_denominators = torch.logaddexp(torch.logsumexp(log_numerators, dim=-1,keepdim=True), log_adjustment)
+    return (log_numerators - log_denominators).exp()
+
+
+def random_inputs(B=2, H=3, S=11):
+    torch.manual_seed(0)
+    attention_scores = torch.randn(B, H, S, S, dtype=torch.double)
+    attention_scores[..., -2:] += -10000.0 # padding from the attention mask
+    log_marginals = torch.rand(B, 1, S, S, dtype=torch.double).log()
+    log_marginals[torch.rand(B, 1, S, S) < 0.3] = -INF # invalid attentions
+    log_marginals[torch.rand(B, 1, S, S) < 0.1] = 0.0 # edges on every path
+    return attention_scores.requires_grad_(), log_marginals.requires_grad_()
+
+
+def test_albo_attention():
+    attention_scores, log_marginals = random_inputs()
+    reference = reference_albo_attention_probs(attention_scores, log_marginals)
+    weights = torch.randn_like(reference)
+    reference_grads = torch.autograd.grad((reference * weights).sum(), (attention_scores, log_marginals))
+    for chunk_size in [1, 4, 11, 64]:
+        bundle = prepare_attention_bias(log_marginals, "albo", epsilon=EPSILON)
+        probs = AlboAttentionFunction.apply(attention_scores, bundle.bias, bundle.log_complements, chunk_size)
+        grads = torch.autograd.grad((probs * weights).sum(), (attention_scores, log_marginals))
+        assert torch.allclose(probs, reference)
+        for grad, reference_grad in zip(grads, reference_grads):
+            assert torch.allclose(grad, reference_grad)
+
+
+def test_albo_attention_row_blocks():
+    attention_scores, log_marginals = random_inputs()
+    reference = reference_albo_attention_probs(attention_scores, log_marginals)
+    weights = torch.randn_like(reference)
+    reference_grads = torch.autograd.grad((reference * weights).sum(), (attention_scores, log_marginals))
+
+    # query rows in blocks, as for a factorized bias
+    bundle = prepare_attention_bias(log_marginals, "albo", epsilon=EPSILON)
+    probs = torch.cat([AlboAttentionFunction.apply(attention_scores[..., start:stop, :], bundle.bias[..., start:stop, :], bundle.log_complements[..., start:stop, :], 2)
+                       for start, stop in [(0, 3), (3, 8), (8, 11)]], dim=-2)
+    grads = torch.autograd.grad((probs * weights).sum(), (attention_scores, log_marginals))
+    assert torch.allclose(probs, reference)
+    for grad, reference_grad in zip(grads, reference_grads):
+        assert torch.allclose(grad, reference_grad)
+
+
+def test_prepare_factorized_attention_bias():
+    torch.manual_seed(0)
+    B, N, E, L = 2, 3, 4, 3
+    bias = BlockAttentionBias(torch.rand(B, N, E, E, dtype=torch.double).log(), torch.rand(B, N, E, dtype=torch.double).log(), (torch.rand(B, N, E) < 0.8).double(),
+                              torch.rand(B, N, L, E, dtype=torch.double).log(), torch.rand(B, N, E, dtype=torch.double).log(), torch.rand(B, N, E, dtype=torch.double).log(), (torch.rand(B, N, L) < 0.8).double())
+    dense = prepare_attention_bias(bias.dense(), "albo", epsilon=EPSILON)
+    factorized = prepare_attention_bias(bias, "albo", epsilon=EPSILON)
+    assert torch.allclose(factorized.bias.dense(), dense.bias[:, 0])
+    assert torch.allclose(factorized.log_complements.dense(), dense.log_complements[:, 0])
+
+if __name__ == "__main__":
+    test_albo_attention()
+    test_albo_attention_row_blocks()
+    test_prepare_factorized_attention_bias()
@@ -0,0 +1,22 @@
+import torch
+
+from bopt.core.modeling_bert import LinearCandidateLogSoftmaxFunction
+
+
+def test_linear_candidate_log_softmax():
+    torch.manual_seed(0)
+    V, H = 37, 16
+    hidden_states = torch.randn(2, 8, H, dtype=torch.double, requires_grad=True)
+    weight = torch.randn(V, H, dtype=torch.double, requires_grad=True)
+    bias = torch.randn(V, dtype=torch.double, requires_grad=True)
+    candidate_ids = torch.randint(0, V, (2, 8, 4))
+    candidate_ids[..., 1] = candidate_ids[..., 0] # repeated candidates (padding units of a node)
+    reference = torch.gather(torch.log_softmax(hidden_states @ weight.t() + bias, -1), -1, candidate_ids)
+    weights = torch.randn_like(reference)
+    reference_grads = torch.autograd.grad((reference * weights).sum(), (hidden_states, weight, bias))
+    for chunk_size in [1, 5, 37, 4096]:
+        log_probs = LinearCandidateLogSoftmaxFunction.apply(hidden_states, weight, bias, candidate_ids, chunk_size)
+        grads = torch.autograd.grad((log_probs * weights).sum(), (hidden_states, weight, bias))
+        assert torch.allclose(log_probs, reference)
+        for grad, reference_grad in zip(grads, reference_grads):
+            assert torch.allclose(grad, reference_grad)
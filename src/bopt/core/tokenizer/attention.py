@@ -1,157 +1,211 @@
 import code
-from typing import List, Tuple
+from typing import List, Sequence, Tuple, Union
 
 import torch
+
+from bopt.core.attention_bias import BlockAttentionBias
+from bopt.core.tokenizer.structure import structures
 INF = 1e9
 
 class LatticeAttentionMixin:
-    permutation_cache = dict()
-    edge_initial_position_cache = dict()
-    valid_attention_cache = dict()
-    causal_mask_cache = dict()
+    structures = structures
+    conditionals_row_chunk_size = None # source edges per chunk in `conditionals`, None builds all rows at once
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+    @classmethod
+    def edges(self, L: int, M: int) -> Tuple[torch.LongTensor, torch.LongTensor]:
+        """
+        Start and end nodes [E] of the possible edges of a block, ordered by start node then by length (the order of
+        the lattice inputs of the model).
+        """
+        def build():
+            start = torch.arange(L)[:, None].expand(L, M)
+            end = start + torch.arange(1, M + 1)[None, :]
+            valid = end <= L
+            return start[valid], end[valid]
+        return self.structures.get("edges", (L, M), build)
+
     @classmethod
     def valid_attention(self, L: int, M: int, device: str = "cpu"):
-        if (L, M, device) in self.valid_attention_cache:
-            return self.valid_attention_cache[(L, M, device)]
-        E = L * (L + 1) // 2 - (L - M) * (L - M + 1) // 2
-        mask = torch.zeros(E, E, dtype=torch.float).to(device)
-        edges = []
-        for i in range(L):
-            for j in range(i + 1, min(L + 1, i + M + 1)):
-                edges.append((i, j))
-        for i, (si, ei) in enumerate(edges):
-            for j, (sj, ej) in enumerate(edges):
-                if not (si >= ej or sj >= ei):
-                    mask[i, j] = 0
-                else:
-                    mask[i, j] = 1
-        mask = mask[:E, :E]
-        self.valid_attention_cache[(L, M, device)] = mask
-        return mask
+        def build():
+            start, end = self.edges(L, M)
+            # edges can attend to each other iff they don't overlap
+            return ((start[:, None] >= end[None, :]) | (start[None, :] >= end[:, None])).to(torch.float)
+        return self.structures.get("valid_attention", (L, M), build, device=device)
+
+    @classmethod
+    def permutation(self, L: int, M: int) -> torch.LongTensor:
+        """
+        Position of every edge (in the order of `edges`) among the possible edges of a [M, L] transition matrix in
+        row major order, where the row of length k+1 holds L-k edges.
+        """
+        def build():
+            start, end = self.edges(L, M)
+            row = end - start - 1
+            return row * L - row * (row - 1) // 2 + start
+        return self.structures.get("permutation", (L, M), build)
 
     @classmethod
-    def permutation(self, L: int, M: int):
-        if (L, M) in self.permutation_cache:
-            return self.permutation_cache[(L, M)]
-        num_substr_per_length = list(reversed(range(1, L + 1)))
-        num_substr_lt_length = [sum(num_substr_per_length[:i]) for i in range(L)]
-        l = []
-        for i in range(L):
-            for j in range(i + 1, min(L + 1, i + M + 1)):
-                l.append(num_substr_lt_length[j - i - 1] + i)
-        self.permutation_cache[(L, M)] = l
-        return l
+    def inverse_permutation(self, L, M) -> torch.LongTensor:
+        def build():
+            permutation = self.permutation(L, M)
+            inverse_permutation = torch.empty_like(permutation)
+            inverse_permutation[permutation] = torch.arange(permutation.size(0))
+            return inverse_permutation
+        return self.structures.get("inverse_permutation", (L, M), build)
 
     @classmethod
-    def inverse_permutation(self, L, M):
-        permutation = self.permutation(L, M)
-        inverse_permutation = [None] * len(permutation)
-        for i, push_index in enumerate(permutation):
-            inverse_permutation[push_index] = i
-        return inverse_permutation
+    def edge_initial_position(self, L: int, M: int) -> torch.LongTensor:
+        return self.edges(L, M)[0]
+
     @classmethod
-    def edge_initial_position(self, L: int, M: int) -> List[int]:
-        if (L, M) in self.edge_initial_position_cache:
-            return self.edge_initial_position_cache[(L, M)]
-        l = []
-        for i in range(L):
-            for j in range(i + 1, min(L + 1, i + M + 1)):
-                l.append(i)
-        self.edge_initial_position_cache[(L, M)] = l
-        return l
+    def linearize(self, values: torch.Tensor) -> torch.Tensor:
+        """
+        Gathers the possible edges of [..., M, L] values into the [..., E] order of the lattice inputs of the model
+        (see `permutation`).
+        """
+        M, L = values.size()[-2:]
+        triu_ones = torch.triu(torch.ones(M, L, dtype=torch.bool, device=values.device), diagonal=0)
+        return values[..., triu_ones][..., self.permutation(L, M)]
+
+    def sampled_conditionals(self, paths: torch.FloatTensor,
+                             fwd_ms: torch.FloatTensor,
+                             marginal_temperature: float = None) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+        """
+        Monte-Carlo estimates of the (log) conditionals and marginals returned by `conditionals`, from sampled paths
+        (e.g. `sample_paths`) instead of the prefix lattice betas, in the same layout so they can be passed to `tile`.
+
+        paths: B, K, M, L edge indicators of K sampled paths per lattice
+        fwd_ms: B, M, L
+        """
+        B, K, M, L = paths.size()
+        E = L * (L+1) // 2 - (L-M) * (L-M+1) // 2
+        device = paths.device
+
+        edges = self.linearize(paths) # [B, K, E]
+        ms = self.linearize(fwd_ms) # [B, E]
+
+        # empirical marginals and co-occurrence frequencies of the sampled edges
+        frequency = edges.mean(1) # [B, E]
+        cooccurrence = torch.einsum("bki,bkj->bij", edges, edges) / K # [B, E (src), E (tgt)]
+        m = frequency.log().clamp(min=-INF)
+        ec = (cooccurrence.log() - m.unsqueeze(-1)).masked_fill(frequency.unsqueeze(-1) == 0, -INF).clamp(min=-INF)
+
+        cm = self.valid_attention(L, M, device=device).unsqueeze(0) * ms.unsqueeze(1) * ms.unsqueeze(2)
+        if marginal_temperature is not None:
+            ec = ec / marginal_temperature
+            m = m / marginal_temperature
+        ec = ec * cm + (1-cm) * -INF # mask out invalid attentions
+
+        off_diagonal = 1 - torch.eye(E, dtype=torch.float, device=device)
+        c = off_diagonal * ec + torch.diag_embed((1-ms) * -INF)
+        return c, m
 
     def conditionals(self, fwd_ts: torch.FloatTensor,
                      fwd_ms:  torch.FloatTensor,
                      log_alpha:  torch.FloatTensor,
                      edge_log_alpha:  torch.FloatTensor,
-                     log_betas:  torch.FloatTensor,
-                     edge_log_betas:  torch.FloatTensor,
+                     node_log_inside:  torch.FloatTensor,
                      marginal_temperature: float=None,
-                     device: str = "cpu") -> Tuple[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
+                     device: str = "cpu",
+                     row_chunk_size: int = None,
+                     prefix_marginals: bool = True) -> Tuple[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
         """
         fwd_ts: B, M, L
         fwd_ms: B, M, L
         log_alpha: B
         edge_log_alpha: B, M, L
-        log_betas: B, L
-        edge_log_betas: B, L, M, L
+        node_log_inside: B, L+1, L+1 inside weights between all pairs of nodes (see `pairwise_algorithm`)
+        row_chunk_size: if set, builds the conditionals this many source edges at a time to bound the size of the
+                        [B, E, E] intermediates (defaults to `conditionals_row_chunk_size`)
+        prefix_marginals: whether to return the edge marginals of all the prefix lattices (needed by `tile_lm`)
+
+        The conditional of a pair of edges needs the weight of the paths between the end of the first and the start
+        of the second edge, i.e. the inside weights between all pairs of nodes, O(L^2) per lattice, which one reverse
+        sweep (`backward_algorithm`, the betas to the last node only) can't supply. The (unnormalized) marginals of the
+        edges in the prefix lattices are gathered from them as needed for every chunk of rows, so apart from the
+        returned tensors nothing larger than [B, R, E] is built.
+
+        Returns the conditionals [B, E, E], the edge alphas [B, 1, E], the edge marginals of the prefix lattices ending
+        at node 1 ... L [B, L, E] (unnormalized, None if not `prefix_marginals`) and the marginals [B, E].
         """
         B, M, L = edge_log_alpha.size()
         E = L * (L+1) // 2 - (L-M) * (L-M+1) // 2# number of all possible edges for a chunk of length L with max edge length M is L (L + 1) / 2 - (L-M) * (L-M+1) // 2
 
-        ela = edge_log_alpha
-        elb = edge_log_betas.flip(-1) # remember the backward transition matrices are ordered from last to first char
-                                     # flip so that it matches the first to last order of ela
-        ts = fwd_ts
-        ms = fwd_ms
+        # gather all the `possible` edges (not necessarily in vocab, just possible) into the order of the model inputs
+        # (see `permutation`), which guarantees that any edge ei in position i < j will always intersect ej (in which
+        # case it's not valid attention) or be in front of ej which is valid
+        ea = self.linearize(edge_log_alpha).reshape(B, 1, -1) # [B, 1, E]
+        td = self.linearize(fwd_ts) # [B, E]
+        ms = self.linearize(fwd_ms) # [B, E]
+        bmask: torch.BoolTensor = fwd_ms.to(torch.bool)
+        edge_log_potentials = self.linearize(torch.ones_like(fwd_ts).fill_(-INF).masked_fill(bmask, 0.0) + fwd_ts) # [B, E]
+        node_mask = self.linearize(self.lattice_node_mask(fwd_ms)) # [B, E], requires `LatticeDPMixin`
+        edge_start_pos, edge_end_pos = self.edges(L, M)
+        edge_start_pos, edge_end_pos = edge_start_pos.to(device), edge_end_pos.to(device)
+
+        def prefix_edge_marginals(prefixes: torch.LongTensor, edges: Union[slice, torch.LongTensor]) -> torch.FloatTensor:
+            """
+            (log of) the sum of all paths through the `edges` [R] in the lattices ending at node `prefixes` + 1 [P],
+            [B, P, R]. The beta of an edge in a prefix lattice is its potential times the inside weight from its end
+            node to the end of the prefix, edges that end after the prefix are -INF.
+            """
+            end = edge_end_pos[edges]
+            inside = node_log_inside[:, end[None, :], prefixes[:, None] + 1] # [B, P, R]
+            eb = edge_log_potentials[:, None, edges] + inside * node_mask[:, None, edges]
+            eb = eb.masked_fill((end[None, :] > prefixes[:, None] + 1).unsqueeze(0), -INF)
+            return ea[:, :, edges] + eb - td[:, None, edges]
 
-        # gather all the `possible` edges (not necessarily in vocab, just possible) using masked indexing
-        # they exactly live in upper triangular part of the transition matrix
-        triu_ones = torch.triu(torch.ones(M, L, dtype=torch.bool).to(device), diagonal=0)
-
-        ea = ela[triu_ones[None, ...].expand(B, -1, -1)].reshape(B, 1, -1) # [B, 1, E] where E  = L (L+1) / 2
-        eb = elb[triu_ones.flip(-1)[None, None, ...].expand(B, L, -1, -1)].reshape(B, L, -1) # [B, L, E]
-        td = ts[triu_ones[None, ...].expand(B, -1, -1)].reshape(B, 1, -1) # [B, L, E]
-        ms = ms[triu_ones[None, ...].expand(B, -1, -1)].reshape(B, -1) # [B, E]
-
-        # permute the final dimension of size E cleverly to guarantee any edge ei in position i < j
-        # will always intersect ej (in which case it's not valid attention) or be in front of ej which is valid
-        permutation = self.permutation(L, M)
-        ea = ea[..., permutation]
-        eb = eb[..., permutation]
-        td = td[..., permutation]
-        ms = ms[..., permutation]
-
-
-        em_ = ea + eb - td # [B, L, E] this is the (log of) the sum of all paths through every edge, with L different
-                            # lattice ending positions
-        # code.interact(local=locals())
-        # code.interact(local=locals())
         # make conditionals matrix, encoded as A_ij = attention from ith row (src) -> to jth column (tgt)
         # given src tgt (src always guaranteed to be in front of target)
         # compute the numerator of the conditional probability
         # u(tgt | src) = bacward_marginal(src, tgt.start_node) * beta(tgt, last_node)
         # visually it's this [n1] ... src ... [nx] tgt ... [nN] the first part is the src backward marginal, second part is tgt beta
-        edge_start_pos = self.edge_initial_position(L, M) # List of size E
-        edge_start_pos = torch.tensor(edge_start_pos, dtype=torch.long, device=device).unsqueeze(0).unsqueeze(1).unsqueeze(-1).expand(B, E, E, 1) # [B, E (dup), E (tgt), 1]
-        em_expansion = em_.transpose(-1,-2).unsqueeze(2).expand(-1,-1,E,-1) # [B, E, L] -> [B, E, 1, L] -> [B, E, E (dup), L]
-        em_src = torch.gather(em_expansion, -1, (edge_start_pos-1).clamp(min=0)).squeeze(-1) # [B, E (src), E (tgt)]
-
-        eb_tgt = eb[:,-1,:].unsqueeze(1) # [B, E (dup), E (tgt)], we take the last beta value wihch corresponds to the full lattice
+        # the backward marginal of src in the prefix lattice ending at the start node of tgt is the prefix marginal
+        # indexed by the edge start of tgt
+        tgt_prefix = (edge_start_pos-1).clamp(min=0) # [E]
+        last = torch.tensor([L - 1], device=device)
+        eb_tgt = (edge_log_potentials + node_log_inside[:, edge_end_pos, L] * node_mask) # [B, E (tgt)], the beta in the full lattice
 
-        ec_numerator = em_src + eb_tgt
+        # denominator is just the marginals of the edge corresponding to the row
+        ec_denom = prefix_edge_marginals(last, slice(None))[:, 0] # [B, E]
 
-        # the numerator matrix should be symmetric and the triu values are the correct ones so lets flip it
+        # create a mask for valid edges (that don't cross), intersect it with the vocabulary mask so that what remains is
+        # only edge-edge attentions that are valid and from vocab item to vocab item
+        valid = self.valid_attention(L, M, device=device)
         triu_c = torch.triu(torch.ones(E, E, dtype=torch.float).to(device), diagonal=1)
         tril_c = torch.tril(torch.ones(E, E, dtype=torch.float).to(device), diagonal=-1)
-        ec_numerator = ec_numerator * triu_c + ec_numerator.transpose(-1,-2) * tril_c
 
-        # denominator is just the marginals of the edge corresponding to the row
-        ec_denom = em_[:,-1,:] # [B, E]
-        ec = ec_numerator - ec_denom.unsqueeze(-1) # [B, E, E] - [B, E, 1 (dup)]
+        rows = []
+        chunk_size = row_chunk_size or self.conditionals_row_chunk_size or E
+        for r in range(0, E, chunk_size):
+            src = slice(r, min(E, r + chunk_size))
 
-        # create a mask for valid edges (that don't cross), intersect it with the vocabulary mask so that what remains is
-        # only edge-edge attentions that are valid and from vocab item to vocab item
-        cm = self.valid_attention(L, M, device=device).unsqueeze(0) * ms.unsqueeze(1) * ms.unsqueeze(2)
-        if marginal_temperature is not None:
-            ec = ec / marginal_temperature
-        ec = ec * cm + (1-cm) * -INF # mask out invalid attentions
+            # the numerator matrix should be symmetric and the triu values are the correct ones so lets flip it
+            ec_numerator_triu = prefix_edge_marginals(tgt_prefix, src).transpose(-1,-2) + eb_tgt.unsqueeze(1) # [B, R (src), E (tgt)]
+            ec_numerator_tril = prefix_edge_marginals(tgt_prefix[src], slice(None)) + eb_tgt[:, src].unsqueeze(-1) # the transposed numerator
+            ec_numerator = ec_numerator_triu * triu_c[src] + ec_numerator_tril * tril_c[src]
+
+            ec = ec_numerator - ec_denom[:, src].unsqueeze(-1) # [B, R, E] - [B, R, 1 (dup)]
 
-        # here's the normalized backward marginals maybe useful?
-        # em = em_ - log_betas[..., None]
+            cm = valid[src].unsqueeze(0) * ms.unsqueeze(1) * ms[:, src].unsqueeze(2)
+            if marginal_temperature is not None:
+                ec = ec / marginal_temperature
+            ec = ec * cm + (1-cm) * -INF # mask out invalid attentions
+            rows.append(triu_c[src] * ec + tril_c[src] * ec)
 
         # put together the matrix by taking the triu, tril, and diagonal with only non-vocab items -inf'ed out
-        c = triu_c * ec + tril_c * ec + torch.diag_embed((1-ms) * -INF)
+        c = torch.cat(rows, 1) + torch.diag_embed((1-ms) * -INF)
 
-        m = em_[:, -1, :] - log_alpha.unsqueeze(1)
+        # [B, L, E] this is the (log of) the sum of all paths through every edge, with L different lattice ending positions
+        em_ = prefix_edge_marginals(torch.arange(L, device=device), slice(None)) if prefix_marginals else None
+
+        m = ec_denom - log_alpha.unsqueeze(1)
         if marginal_temperature is not None:
             m = m / marginal_temperature
-        # code.interact(local=locals())
-        return c, ea, eb, em_, m
+        return c, ea, em_, m
 
     def tile(self, marginals: torch.FloatTensor, conditionals: torch.FloatTensor, batch_size: int, num_blocks: int, M: int, L: int , ms: torch.FloatTensor, task_mask: torch.FloatTensor = None):
         """
@@ -213,33 +267,149 @@ class LatticeAttentionMixin:
         full_attention = full_attention * mask + (-INF) * (1-mask)
         return full_attention
 
+    def tile_factorized(self, marginals: torch.FloatTensor, conditionals: torch.FloatTensor, batch_size: int, num_blocks: int, M: int, L: int, ms: torch.FloatTensor,
+                        edge_marginals: torch.FloatTensor = None, log_betas: torch.FloatTensor = None, token_mask: torch.FloatTensor = None) -> BlockAttentionBias:
+        """
+        Same bias as `tile` (or `tile_lm` if edge_marginals is given) as a `BlockAttentionBias`, without the
+        [batch, S, S] tensor.
+
+            (log) marginals: batch * block, E
+            (log) conditionals:  batch * block, E, E
+            ms: batch * block, M, L
+            edge_marginals: batch * block, L, E (lm only)
+            log_betas: batch * block, L (lm only)
+            token_mask: batch, block * (E + L) (lm only) 0 for padding positions, the `lm_mask` of `tile_lm` is
+                        token_mask[:, :, None] * token_mask[:, None, :] * causal_mask(block, L, M)
+        """
+        E = marginals.size(-1)
+        device = marginals.device
+        ms = self.linearize(ms).reshape(batch_size, num_blocks, E)
+        marginals = marginals.reshape(batch_size, num_blocks, E)
+        conditionals = conditionals.reshape(batch_size, num_blocks, E, E)
+        if edge_marginals is None:
+            return BlockAttentionBias(conditionals.masked_fill((ms.unsqueeze(-1) * ms.unsqueeze(-2)) == 0, -INF),
+                                      marginals.masked_fill(ms == 0, -INF), ms)
+
+        start, end = self.edges(L, M)
+        start, end = start.to(device), end.to(device)
+        edge_tokens = token_mask[:, :num_blocks * E].reshape(batch_size, num_blocks, E)
+        node_tokens = token_mask[:, num_blocks * E:].reshape(batch_size, num_blocks, L)
+
+        # edges see the edges of their block that end before they start (and themselves)
+        edge_keys = ms * edge_tokens
+        edge_causal_mask = (end[None, :] <= start[:, None]) | torch.eye(E, dtype=torch.bool, device=device)
+        edge_conditionals = conditionals.masked_fill(~(edge_keys.unsqueeze(-2).to(torch.bool) & edge_causal_mask), -INF)
+
+        # node l+1 uses the conditionals (prefix lattice marginals) of node l, nodes see the edges that end before them
+        em = (edge_marginals - log_betas[..., None]).reshape(batch_size, num_blocks, L, E)
+        node_causal_mask = end[None, :] <= torch.arange(L, device=device)[:, None] # [L, E]
+        node_keys = edge_tokens.unsqueeze(-2).to(torch.bool) # [batch, block, 1, E]
+        node_conditionals = em.roll(1, -2).masked_fill(~(node_keys & node_causal_mask), -INF)
+        node_previous = torch.cat([torch.full_like(em[:, :1, -1], -INF), em[:, :-1, -1]], 1).masked_fill(edge_tokens.roll(1, 1) == 0, -INF)
+        return BlockAttentionBias(edge_conditionals, marginals.masked_fill(edge_keys == 0, -INF), ms * edge_tokens,
+                                  node_conditionals, marginals.masked_fill(edge_tokens == 0, -INF), node_previous, node_tokens)
+
+    @classmethod
+    def delinearize(self, values: torch.Tensor, M: int, L: int, fill=0.0) -> torch.Tensor:
+        """
+        Inverse of `linearize`, scatters [..., E] values into the [..., M, L] layout, the slots outside the lattice band
+        are `fill`.
+        """
+        start, end = self.edges(L, M)
+        dense = values.new_full((*values.size()[:-1], M, L), fill)
+        dense[..., end - start - 1, end - 1] = values
+        return dense
+
+    def prune_edges(self, marginals: torch.FloatTensor, fwd_ms: torch.FloatTensor, lengths: torch.LongTensor,
+                    threshold: float = None, top_k: int = None) -> torch.BoolTensor:
+        """
+        Selects the edges worth a position in the model inputs: the edges with a marginal of at least `threshold` and /
+        or among the `top_k` most likely edges that start at the same node. The path with the largest marginals is always
+        kept so that the remaining edges still cover every lattice. Requires `LatticeDPMixin`.
+
+        (log) marginals: batch, block, E (see `conditionals`)
+        fwd_ms: batch, block, M, L
+        lengths: batch, block
+
+        Returns the kept edges [batch, block * E] in the order of the model inputs.
+        """
+        batch_size, num_blocks, M, L = fwd_ms.size()
+        E = marginals.size(-1)
+        marginals = marginals.detach()
+        keep = self.linearize(fwd_ms).to(torch.bool)
+        if threshold is not None:
+            keep = keep & (marginals.exp() >= threshold)
+        if top_k is not None:
+            # rank among the edges with the same start node, ties go to the shorter edge
+            start, _ = self.edges(L, M)
+            start = start.to(marginals.device)
+            index = torch.arange(E, device=marginals.device)
+            better = (marginals.unsqueeze(-2) > marginals.unsqueeze(-1)) | ((marginals.unsqueeze(-2) == marginals.unsqueeze(-1)) & (index[None, :] < index[:, None]))
+            rank = (better & (start[None, :] == start[:, None])).sum(-1)
+            keep = keep & (rank < top_k)
+
+        # the path with the largest product of marginals
+        _, _, back_pointers = self.viterbi_algorithm(self.delinearize(marginals, M, L, fill=-INF).reshape(-1, M, L), fwd_ms.reshape(-1, M, L), lengths.reshape(-1))
+        rows, columns, counts = self.backtrace_edges(lengths.reshape(-1), back_pointers)
+        start, end = self.edges(L, M)
+        slots = torch.full((M, L), E, dtype=torch.long)
+        slots[end - start - 1, end - 1] = torch.arange(E)
+        path = slots.to(rows.device)[rows, columns].masked_fill(torch.arange(rows.size(-1), device=rows.device)[None, :] >= counts[:, None], E)
+        on_path = torch.zeros(batch_size * num_blocks, E + 1, dtype=torch.bool, device=rows.device).scatter(1, path, True)[:, :E]
+        return (keep | on_path.reshape(batch_size, num_blocks, E)).reshape(batch_size, num_blocks * E)
+
+    def repack(self, keep: torch.BoolTensor, attn_bias: torch.FloatTensor, sequences: Sequence[torch.Tensor], padding_values: Sequence[Union[int, float]]) -> Tuple[torch.FloatTensor, Tuple[torch.Tensor, ...], torch.LongTensor]:
+        """
+        Moves the kept positions of every sequence to the front (in order) and cuts the batch to the longest one. Only the
+        first keep.size(-1) positions are pruned, the positions after them (the nodes of a language model) are always kept
+        and stay at the end.
+
+        keep: batch, P (e.g. `prune_edges`)
+        attn_bias: [..., batch, S, S] dense (log) attention bias, padding positions get -INF
+        sequences: [batch, S] model inputs (ids, position ids, masks, labels, ...)
+        padding_values: the padding value of every sequence
+
+        Returns the attention bias, the sequences and the original position of every new position [batch, S'].
+        """
+        if isinstance(attn_bias, BlockAttentionBias):
+            raise ValueError("pruning does not support a factorized attention bias")
+        batch_size, P = keep.size()
+        S = attn_bias.size(-1)
+        counts = keep.sum(-1)
+        order = torch.argsort((~keep).to(torch.long), dim=-1, stable=True)[:, :counts.max()]
+        valid = torch.arange(order.size(-1), device=keep.device)[None, :] < counts[:, None]
+        suffix = torch.arange(P, S, device=keep.device)[None, :].expand(batch_size, -1)
+        index = torch.cat([order, suffix], -1)
+        valid = torch.cat([valid, torch.ones_like(suffix, dtype=torch.bool)], -1)
+
+        sequences = tuple(sequence.gather(-1, index).masked_fill(~valid, padding_value) for sequence, padding_value in zip(sequences, padding_values))
+        size = (*attn_bias.size()[:-2], index.size(-1))
+        attn_bias = attn_bias.gather(-2, index[..., :, None].expand(*size, S)).gather(-1, index[..., None, :].expand(*size, index.size(-1)))
+        attn_bias = attn_bias.masked_fill(~(valid[..., :, None] & valid[..., None, :]), -INF)
+        return attn_bias, sequences, index
+
     @classmethod
     def block_tril(self, mat: torch.Tensor, N: int, diagonal_mat: torch.Tensor = None, shift: int = 0):
         """
         Tiles the lower triangular part of a N x N grid with `mat`
         """
         if diagonal_mat is None: diagonal_mat = mat
-        zeros = torch.zeros_like(mat)
-        grid = [[mat if row - col > shift else (diagonal_mat if row - col == shift else zeros) for col in range(N)] for row in range(N)]
-        return torch.cat([torch.cat(grid_row, dim=1) for grid_row in grid], dim=0)
+        blocks = torch.arange(N, device=mat.device)
+        offset = blocks[:, None] - blocks[None, :] # [N (row), N (col)]
+        grid = (offset > shift)[:, None, :, None] * mat[None, :, None, :] + (offset == shift)[:, None, :, None] * diagonal_mat[None, :, None, :]
+        return grid.reshape(N * mat.size(0), N * mat.size(1))
 
     @classmethod
     def causal_mask(self, N: int, L:int, M:int, device="cpu"):
         """
         Returns a NxE + NxL by NxE + NxL matrix representing the causal mask.
         """
-        # make the within-block causal mask
-        if (N, L, M, device) not in self.causal_mask_cache:
-            triu = torch.triu(torch.ones((M, L), dtype=torch.bool))
-            trius = torch.triu(torch.ones((L, M, L), dtype=torch.bool))
-            for i in range(L):
-                trius[i, :, i:] = 0
-
-            permutation = self.permutation(L, M)
-            node_causal_mask = trius[triu.unsqueeze(0).expand(L, M, L)].reshape(L, -1) # [L, E]
-            node_causal_mask = node_causal_mask[..., permutation]
-
-            edge_causal_mask = torch.stack([node_causal_mask[s] for s in range(L) for l in range(1, 1 + min(L-s, M))])
+        def build():
+            # make the within-block causal mask, nodes see the edges that end before them and edges see the edges that
+            # end before their start
+            start, end = self.edges(L, M)
+            node_causal_mask = end[None, :] <= torch.arange(L)[:, None] # [L, E]
+            edge_causal_mask = end[None, :] <= start[:, None] # [E, E]
 
             top_left = self.block_tril(torch.ones_like(edge_causal_mask), N, diagonal_mat=edge_causal_mask)
             bottom_left = self.block_tril(torch.ones_like(node_causal_mask), N, diagonal_mat=node_causal_mask)
@@ -247,6 +417,5 @@ class LatticeAttentionMixin:
             bottom_right = torch.eye(bottom_left.size(0))
             causal_mask = torch.cat([torch.cat([top_left, top_right], dim=1), torch.cat([bottom_left, bottom_right], dim=1)], dim=0)
             causal_mask[torch.eye(causal_mask.size(0), dtype=torch.bool)] = 1
-            self.causal_mask_cache[(N, L, M, device)] = causal_mask.to(device)
-        return self.causal_mask_cache[(N, L, M, device)]
-
+            return causal_mask
+        return self.structures.get("causal_mask", (N, L, M), build, device=device)
@@ -3,64 +3,289 @@ from typing import List, Tuple
 
 import torch
 
+from bopt.core.tokenizer.semiring import Semiring, LogSemiring, MaxSemiring, LogExpectationSemiring, EntropySemiring, ProductSemiring, \
+    PairwiseLogSemiring, tree_map, tree_flatten, tree_unflatten
+from bopt.core.tokenizer.structure import structures
+
 INF = 1e9
 
 DEBUG = False
+
+
+def semiring_sweep(edge_values: Tuple, node_mask: torch.FloatTensor, semiring: Semiring, active: List[int] = None) -> Tuple[Tuple, List]:
+    """
+    The loop of `LatticeDPMixin.semiring_algorithm`, returns the values of all nodes [B, L+1, ...] and the back
+    pointers of every node after the first.
+
+    edge_values: semiring values of the edges [B, M, L, ...]
+    node_mask: [B, M, L]
+    active: (non increasing) number of lattices that are still running at every step, the batch has to be sorted by
+            length. Step i only updates the first active[i] lattices, the nodes past the end of the others get
+            `semiring.zero` and the loop exits once all lattices are done.
+    """
+    B, M, L = node_mask.size()
+    active = active if active is not None else [B] * L
+    one = semiring.one(edge_values)
+    zero = semiring.zero(one)
+    window = tree_map(lambda v: v.unsqueeze(1).expand(B, M, *v.size()[1:]), one)
+    node_values = [one]
+    back_pointers = []
+    for i in range(L):
+        n = active[i]
+        if n == 0:
+            node_values.extend([zero] * (L - i))
+            back_pointers.extend([None if not back_pointers or back_pointers[-1] is None else torch.zeros_like(back_pointers[-1])] * (L - i))
+            break
+        if n == B:
+            values, indices = semiring.plus(semiring.times(window, tree_map(lambda e: e[:, :, i], edge_values), node_mask[:, :, i]))
+            node_values.append(values)
+            back_pointers.append(indices)
+        else:
+            window = tree_map(lambda w: w[:n], window)
+            values, indices = semiring.plus(semiring.times(window, tree_map(lambda e: e[:n, :, i], edge_values), node_mask[:n, :, i]))
+            node_values.append(tree_map(lambda v, z: torch.cat([v, z[n:]], 0), values, zero))
+            back_pointers.append(indices if indices is None else torch.cat([indices, indices.new_zeros(B - n)], 0))
+        window = tree_map(lambda v, w: torch.cat([v.unsqueeze(1), w[:, :-1]], 1), values, window)
+    return tree_map(lambda *vs: torch.stack(vs, 1), *node_values), back_pointers
+
+
+def semiring_sweep_backward(edge_values: Tuple, node_mask: torch.FloatTensor, semiring: Semiring, all_node_values: Tuple, all_node_grads: Tuple, active: List[int] = None) -> Tuple:
+    """
+    Reverse mode of `semiring_sweep`, one sweep from the last node to the first. The gradient of a node is complete once
+    all of its outgoing edges (the columns to its right) have been visited, `pending` collects it in the same rolling
+    window layout as the forward sweep, pending[:, j] = gradient of node i - j.
+
+    all_node_values: [B, L+1, ...] from `semiring_sweep`
+    all_node_grads: gradient w.r.t. all_node_values
+    active: as in `semiring_sweep`, the nodes past the end of a lattice don't depend on the edges
+
+    Returns the gradient w.r.t. edge_values. For the log semiring this is the usual outside pass: with a gradient of 1
+    at the last node, the gradient of an edge is its marginal alpha(start) * potential * beta(end) / Z.
+    """
+    B, M, L = node_mask.size()
+    device = node_mask.device
+    active = active if active is not None else [B] * L
+    edge_grads = tree_map(torch.zeros_like, edge_values)
+    pending = tree_map(lambda v: v.new_zeros(B, M, *v.size()[2:]), all_node_values)
+    node_grads = tree_map(lambda g: g[:, L], all_node_grads)
+    for i in reversed(range(L)):
+        n = active[i]
+        if n == 0:
+            node_grads = tree_map(lambda g: g[:, i], all_node_grads)
+            continue
+        start = (i - torch.arange(M, device=device)).clamp(min=0) # start nodes of the incoming edges of node i+1
+        window_grads, column_grads = semiring.backward(tree_map(lambda v: v[:n, start], all_node_values),
+                                                       tree_map(lambda e: e[:n, :, i], edge_values),
+                                                       node_mask[:n, :, i],
+                                                       tree_map(lambda v: v[:n, i + 1], all_node_values),
+                                                       tree_map(lambda g: g[:n], node_grads))
+        tree_map(lambda e, g: e[:n, :, i].copy_(g), edge_grads, column_grads)
+        pending = tree_map(lambda p, g: p + g if n == B else torch.cat([p[:n] + g, p[n:]], 0), pending, window_grads)
+        node_grads = tree_map(lambda g, p: g[:, i] + p[:, 0], all_node_grads, pending)
+        pending = tree_map(lambda p: torch.cat([p[:, 1:], torch.zeros_like(p[:, :1])], 1), pending)
+    return edge_grads
+
+
+class LatticeSweepFunction(torch.autograd.Function):
+    """
+    `semiring_sweep` with an analytic backward (`semiring_sweep_backward`). Only the edge values [B, M, L, ...] and
+    the node values [B, L+1, ...] are kept for backward, instead of the graph of all L steps.
+
+    Edge values are passed as flat leaves (see `tree_flatten`) since autograd only tracks tensor arguments.
+    """
+
+    @staticmethod
+    def forward(ctx, semiring, node_mask, active, structure, *edge_leaves):
+        all_node_values, _ = semiring_sweep(tree_unflatten(edge_leaves, structure), node_mask, semiring, active)
+        node_leaves, node_structure = tree_flatten(all_node_values)
+        ctx.semiring, ctx.active, ctx.structure, ctx.node_structure = semiring, active, structure, node_structure
+        ctx.num_edge_leaves = len(edge_leaves)
+        ctx.save_for_backward(node_mask, *edge_leaves, *node_leaves)
+        return tuple(node_leaves)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, *node_grads):
+        node_mask, *leaves = ctx.saved_tensors
+        edge_leaves, node_leaves = leaves[:ctx.num_edge_leaves], leaves[ctx.num_edge_leaves:]
+        edge_grads = semiring_sweep_backward(tree_unflatten(edge_leaves, ctx.structure),
+                                             node_mask,
+                                             ctx.semiring,
+                                             tree_unflatten(node_leaves, ctx.node_structure),
+                                             tree_unflatten(node_grads, ctx.node_structure),
+                                             ctx.active)
+        edge_grads, _ = tree_flatten(edge_grads)
+        return (None, None, None, None, *edge_grads)
+
 class LatticeDPMixin:
+    structures = structures
+    scan_min_length = None # if set, log semiring sweeps over blocks at least this long use `scan_log_alphas` instead of the loop
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    def forward_algorithm(self, transition_matrix: torch.FloatTensor, mask: torch.FloatTensor, lengths: torch.LongTensor, return_nodes=False) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+    @classmethod
+    def lattice_band(self, M: int, L: int, device: str = "cpu") -> Tuple[torch.LongTensor, torch.BoolTensor]:
+        """
+        Returns the start node of every slot of a [M, L] transition matrix and the band of slots that are inside
+        the lattice.
+
+        Column i of a transition matrix holds the (at most M) incoming edges of node i+1, the edge in row k starts
+        at node i-k. Slots with i-k < 0 would start before the first node, they are excluded from the band and their
+        start is clamped to 0 so that it can be used as a gather index.
+
+        start: [M, L]
+        band: [M, L]
+        """
+        def build():
+            start = torch.arange(L)[None, :] - torch.arange(M)[:, None]
+            band = start >= 0
+            return start.clamp(min=0), band
+        return self.structures.get("lattice_band", (M, L), build, device=device)
+
+    def lattice_node_mask(self, mask: torch.FloatTensor) -> torch.FloatTensor:
+        """
+        Intersects the vocabulary mask with the lattice band, the result marks every edge that receives the alpha of its
+        start node. This is the union of all the per-node `maski` diagonals in one tensor.
+
+        mask: [B, M, L]
+        """
+        B, M, L = mask.size()
+        _, band = self.lattice_band(M, L, device=mask.device)
+        return (mask.to(torch.bool) & band.unsqueeze(0)).to(torch.float)
+
+    def semiring_algorithm(self, transition_matrix: torch.FloatTensor, mask: torch.FloatTensor, lengths: torch.LongTensor, semiring: Semiring) -> Tuple[Tuple, Tuple, Tuple, List]:
         """
+        One forward sweep over the lattice in an arbitrary semiring.
+
         transition_matrix: [B, M, L]
         mask: [B, M, L]
         lengths: [B]
+
+        Returns the values of the last nodes [B, ...], of all edges [B, M, L, ...] (the paths from the first node
+        through the edge), of all nodes [B, L+1, ...], and the back pointers returned by `semiring.plus` for every
+        node after the first.
         """
         B, M, L = transition_matrix.size()
 
-        bmask: torch.BoolTensor = mask.to(torch.bool)
-        edge_log_alphas: torch.FloatTensor = torch.ones_like(transition_matrix).fill_(-INF)
-        edge_log_alphas[bmask] = 0.0
-        edge_log_alphas += transition_matrix
-
-        log_alphas: List[torch.FloatTensor] = [mask.new_zeros(B)]
-        for i in range(L):
-            # maski is the intersection of bmask and the ith diagonal, represents all outgoing edges at a node
-            #
-            # Example: for the chunk `hate`, the lattice (only drawing character edges) looks like
-            #
-            #   [n0] - h - [n1] - a - [n2] - t - [n3] - e [n4]
-            #
-            # where [nx] is the xth node in the lattice.
-            #
-            # The transition matrices organize the outgoing edge potentials from a given node along (shifted) diagonals,
-            # and incoming edge potentials along columns.
-            #
-            # For example, for forward transitions, mask2 represents all outgoing edges from
-            # the node before `t`.
-            #   valid edges                   bmask        shifted diagonal
-            # [ h a  t   e   ]             [ 1 1 1 1 ]       [ 0 0 1 0 ]
-            # [      at      ]   mask2 =   [ 0 0 1 0 ]   &   [ 0 0 0 1 ]
-            # [      hat ate ]             [ 0 0 1 1 ]       [ 0 0 0 0 ]
-            # [          hate]             [ 0 0 0 1 ]       [ 0 0 0 0 ]
-            maski = (bmask & torch.diag_embed(mask.new_ones(L - i, dtype=torch.bool), offset=i)[:M].unsqueeze(0)).to(torch.float)
-            # this update corresponds to the propagation of alpha from a node to all `outgoing` edges
-            # for i = 2 as an example, this propagates [n1], which we aggregated last iteration
-            node_to_edge = log_alphas[i][:, None, None] * maski
-            edge_log_alphas = edge_log_alphas + node_to_edge
-
-            # this update corresponds to aggregating the `incoming` edge-alphas into the alpha of a node
-            # for i = 2 as an example, this aggregates [n2], which is guaranteed
-            # to have all incoming edges with edge-alphas already computed
-            log_alphas.append(torch.logsumexp(edge_log_alphas[:, :, i], -1))
-
-        all_log_alphas = torch.stack(log_alphas)
-        last_log_alphas = torch.gather(all_log_alphas, 0, lengths.unsqueeze(0))
+        # The transition matrices organize the outgoing edge potentials from a given node along (shifted) diagonals,
+        # and incoming edge potentials along columns.
+        #
+        # Example: for the chunk `hate`, the lattice (only drawing character edges) looks like
+        #
+        #   [n0] - h - [n1] - a - [n2] - t - [n3] - e [n4]
+        #
+        # where [nx] is the xth node in the lattice.
+        #
+        #   valid edges            bmask       start node     column 2 = incoming edges of [n3]
+        # [ h a  t   e   ]      [ 1 1 1 1 ]    [ 0 1 2 3 ]             [ t   ] <- [n2]
+        # [      at      ]      [ 0 0 1 0 ]    [ - 0 1 2 ]             [ at  ] <- [n1]
+        # [      hat ate ]      [ 0 0 1 1 ]    [ - - 0 1 ]             [ hat ] <- [n0]
+        # [          hate]      [ 0 0 0 1 ]    [ - - - 0 ]             [     ]
+        #
+        # Instead of propagating the value of node i along its (masked) diagonal, which touches all of [B, M, L] on
+        # every step, we pull the values of the M start nodes of the incoming edges of node i+1, which only touches
+        # column i. `window` keeps the last M node values, window[:, k] = value of node i - k (see `semiring_sweep`).
+        node_mask = self.lattice_node_mask(mask)
+        edge_values = semiring.edge_values(transition_matrix, mask, node_mask)
+        if type(semiring) is LogSemiring and self.scan_min_length is not None and L >= self.scan_min_length:
+            all_node_values, back_pointers = (self.scan_log_alphas(edge_values[0], node_mask),), [None] * L
+        else:
+            # Sort the lattices by length so that the loop can stop updating (and eventually exit for) the lattices that
+            # are done, which skips the padding of short blocks.
+            order, active = self.length_buckets(lengths, L)
+            sweep_edge_values, sweep_node_mask = edge_values, node_mask
+            if order is not None:
+                sweep_edge_values, sweep_node_mask = tree_map(lambda e: e[order], edge_values), node_mask[order]
+
+            # When gradients are needed and the semiring supports it, the sweep is differentiated analytically by
+            # `LatticeSweepFunction`, which avoids storing the L steps of the loop for autograd.
+            edge_leaves, structure = tree_flatten(sweep_edge_values)
+            if semiring.analytic_backward and torch.is_grad_enabled() and any(e.requires_grad for e in edge_leaves):
+                node_leaves = LatticeSweepFunction.apply(semiring, sweep_node_mask, active, structure, *edge_leaves)
+                _, node_structure = tree_flatten(semiring.one(edge_values))
+                all_node_values, back_pointers = tree_unflatten(node_leaves, node_structure), [None] * L
+            else:
+                all_node_values, back_pointers = semiring_sweep(sweep_edge_values, sweep_node_mask, semiring, active) # [B, L+1, ...]
+
+            if order is not None:
+                inverse = torch.argsort(order)
+                all_node_values = tree_map(lambda v: v[inverse], all_node_values)
+                back_pointers = [bp if bp is None else bp[inverse] for bp in back_pointers]
+
+        # propagate the value of every node to all its `outgoing` edges in one go
+        start, _ = self.lattice_band(M, L, device=transition_matrix.device)
+        edge_values = semiring.times(tree_map(lambda v: v[:, start], all_node_values), edge_values, node_mask)
+        batch_index = torch.arange(B, device=lengths.device)
+        last_values = tree_map(lambda v: v[batch_index, lengths], all_node_values)
+        return last_values, edge_values, all_node_values, back_pointers
+
+    def length_buckets(self, lengths: torch.LongTensor, L: int) -> Tuple[torch.LongTensor, List[int]]:
+        """
+        Order that sorts a batch by decreasing length and the number of lattices that are still running at each of the
+        L steps of a sweep (see `semiring_sweep`). The order is None if there is no padding to skip.
+
+        lengths: [B]
+        """
+        sorted_lengths, order = torch.sort(lengths, descending=True)
+        active = (sorted_lengths[None, :] > torch.arange(L, device=lengths.device)[:, None]).sum(1).tolist()
+        if active[-1] == lengths.size(0):
+            return None, active
+        return order, active
+
+    def scan_log_alphas(self, edge_log_alphas: torch.FloatTensor, node_mask: torch.FloatTensor) -> torch.FloatTensor:
+        """
+        The log semiring sweep of `semiring_algorithm` as an associative scan, with O(log L) sequential steps instead
+        of L, which pays off for long blocks (e.g. unsegmented character sequences).
+
+        Each column is an [M+1, M+1] transfer matrix (in the log semiring) acting on the window of the last M node
+        alphas plus a constant 1 (log 0) for edges that don't receive the alpha of their start node,
+
+            window_{i+1} = A_i window_i,    A_i = [ e_0 e_1 ... e_M-1  c ]    e_k = incoming edge k of node i+1
+                                                  [  0                 . ]    c   = logsumexp of the edges outside the
+                                                  [      ...           . ]          node mask
+                                                  [           0        . ]
+                                                  [                    0 ]
+
+        and all prefix products A_i ... A_0 are computed with a Hillis-Steele scan. The work is O(L log L M^3), so this
+        only pays off where the loop is dominated by per step overhead (long blocks on GPU), see `scan_min_length`.
+
+        edge_log_alphas: [B, M, L] edge values of the `LogSemiring`
+        node_mask: [B, M, L]
+
+        Returns the node log alphas [B, L+1].
+        """
+        B, M, L = edge_log_alphas.size()
+        S = M + 1
+        bmask = node_mask.to(torch.bool)
+        incoming = torch.where(bmask, edge_log_alphas, -INF).transpose(1, 2) # [B, L, M]
+        constant = torch.where(bmask, -INF, edge_log_alphas).logsumexp(1).unsqueeze(-1) # [B, L, 1]
+        shift = edge_log_alphas.new_full((S - 1, S), -INF)
+        shift[torch.arange(S - 2), torch.arange(S - 2)] = 0.0 # window[k] -> window[k+1]
+        shift[-1, -1] = 0.0 # and the constant stays
+        transfer = torch.cat([torch.cat([incoming, constant], -1).unsqueeze(2), shift.expand(B, L, S - 1, S)], 2) # [B, L, S, S]
+
+        # prefix[:, i] = transfer[:, i] ... transfer[:, 0] after ceil(log2 L) rounds
+        prefix = transfer
+        d = 1
+        while d < L:
+            prefix = torch.cat([prefix[:, :d], torch.logsumexp(prefix[:, d:, :, :, None] + prefix[:, :-d, None, :, :], -2)], 1)
+            d *= 2
+
+        # the window starts out as all zeros (log 1), so the alpha of node i+1 is the sum of the first row
+        return torch.cat([edge_log_alphas.new_zeros(B, 1), prefix[:, :, 0].logsumexp(-1)], 1)
+
+    def forward_algorithm(self, transition_matrix: torch.FloatTensor, mask: torch.FloatTensor, lengths: torch.LongTensor, return_nodes=False) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+        """
+        transition_matrix: [B, M, L]
+        mask: [B, M, L]
+        lengths: [B]
+        """
+        (last_log_alphas,), (edge_log_alphas,), (all_log_alphas,), _ = self.semiring_algorithm(transition_matrix, mask, lengths, LogSemiring())
         if not return_nodes:
-            return last_log_alphas.squeeze(0), edge_log_alphas
+            return last_log_alphas, edge_log_alphas
         else:
-            return last_log_alphas.squeeze(0), edge_log_alphas, all_log_alphas.T # return alpha for nodes |x|, ..., and 0 to |x|,
+            return last_log_alphas, edge_log_alphas, all_log_alphas # return alpha for nodes |x|, ..., and 0 to |x|,
 
     def viterbi_algorithm(self, transition_matrix: torch.FloatTensor, mask: torch.FloatTensor, lengths: torch.LongTensor) -> Tuple[torch.FloatTensor, torch.FloatTensor, List[torch.LongTensor]]:
         """
@@ -68,107 +293,266 @@ class LatticeDPMixin:
         mask: [B, M, L]
         lengths: [B]
         """
+        (log_alphas,), (edge_log_alphas,), _, back_pointers = self.semiring_algorithm(transition_matrix, mask, lengths, MaxSemiring())
+        if log_alphas.isnan().any():
+            print("Nan loss detected")
+            code.interact(local=locals())
+        return log_alphas, edge_log_alphas, back_pointers
+
+    def viterbi_forward_algorithm(self, transition_matrix: torch.FloatTensor, mask: torch.FloatTensor, lengths: torch.LongTensor) -> Tuple[torch.FloatTensor, List[torch.LongTensor], torch.FloatTensor]:
+        """
+        `viterbi_algorithm` and `forward_algorithm` in one sweep of the product of the (max, +) and log semirings.
+
+        transition_matrix: [B, M, L]
+        mask: [B, M, L]
+        lengths: [B]
+
+        Returns the viterbi scores [B], the back pointers and log Z [B].
+        """
+        ((max_log_alphas,), (log_alphas,)), _, _, back_pointers = self.semiring_algorithm(transition_matrix, mask, lengths, ProductSemiring(MaxSemiring(), LogSemiring()))
+        return max_log_alphas, back_pointers, log_alphas
+
+    def reverse_lattice(self, transition_matrix: torch.Tensor, mask: torch.FloatTensor, lengths: torch.LongTensor) -> Tuple[torch.Tensor, torch.FloatTensor, torch.LongTensor, torch.BoolTensor]:
+        """
+        Reverses each lattice within its length, so that node |x| - n becomes node n. Running any semiring sweep on the
+        reversed lattice is a backward (outside) sweep on the original one.
+
+        The reversal maps slot [k, i] to slot [k, |x| - 1 - i + k] and is its own inverse, so the returned index also
+        maps values of the reversed lattice back to the original layout.
+
+        transition_matrix: [B, M, L]
+        mask: [B, M, L]
+        lengths: [B]
+
+        Returns the reversed transition_matrix and mask, the index [B, M, L] and the slots [B, M, L] that are inside the
+        lattice.
+        """
+        B, M, L = transition_matrix.size()
+        _, band = self.lattice_band(M, L, device=transition_matrix.device)
+        columns = torch.arange(L, device=lengths.device)[None, None, :]
+        index = lengths[:, None, None] - 1 - columns + torch.arange(M, device=lengths.device)[None, :, None]
+        valid = band.unsqueeze(0) & (columns < lengths[:, None, None]) & (index >= 0) & (index < L)
+        index = index.clamp(min=0, max=L - 1)
+        reversed_transition_matrix = torch.gather(transition_matrix, -1, index)
+        reversed_mask = torch.gather(mask, -1, index) * valid
+        return reversed_transition_matrix, reversed_mask, index, valid
+
+    def backward_algorithm(self, transition_matrix: torch.FloatTensor, mask: torch.FloatTensor, lengths: torch.LongTensor, return_nodes=False) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+        """
+        One reverse sweep over the (forward encoded) lattice.
+
+        transition_matrix: [B, M, L]
+        mask: [B, M, L]
+        lengths: [B]
+
+        Returns log Z [B], the edge betas [B, M, L] (edge potential times beta of the end node, in the same layout as
+        transition_matrix) and optionally the node betas [B, L+1]. Nodes past |x| are connected to the last node with
+        weight one, like the padding of the backward encoding.
+        """
         B, M, L = transition_matrix.size()
+        reversed_transition_matrix, reversed_mask, index, valid = self.reverse_lattice(transition_matrix, mask, lengths)
+        (log_betas,), (reversed_edge_log_betas,), (reversed_node_log_betas,), _ = self.semiring_algorithm(reversed_transition_matrix, reversed_mask, lengths, LogSemiring())
 
-        bmask: torch.BoolTensor = mask.to(torch.bool)
-        edge_log_alphas: torch.FloatTensor = torch.ones_like(transition_matrix).fill_(-INF)
-        edge_log_alphas[bmask] = 0.0
-        edge_log_alphas += transition_matrix
+        edge_log_betas = torch.gather(reversed_edge_log_betas, -1, index)
+        edge_log_betas = torch.where(valid & mask.to(torch.bool), edge_log_betas, -INF + transition_matrix)
+        if not return_nodes:
+            return log_betas, edge_log_betas
+        node_index = lengths[:, None] - torch.arange(L + 1, device=lengths.device)[None, :]
+        node_log_betas = torch.gather(reversed_node_log_betas, -1, node_index.clamp(min=0))
+        node_log_betas = node_log_betas * (node_index >= 0)
+        return log_betas, edge_log_betas, node_log_betas
 
-        log_alphas: List[torch.FloatTensor] = [mask.new_zeros(B)]
-        back_pointers: List[torch.LongTensor] = []
-        for i in range(L):
-            maski = (bmask & torch.diag_embed(mask.new_ones(L - i, dtype=torch.bool), offset=i)[:M].unsqueeze(0)).to(torch.float)
+    def pairwise_algorithm(self, transition_matrix: torch.FloatTensor, mask: torch.FloatTensor, lengths: torch.LongTensor) -> torch.FloatTensor:
+        """
+        Log of the summed weight of all paths between every pair of nodes, computed with one sweep that carries the
+        inside weights from all L+1 possible start nodes at once (see `PairwiseLogSemiring`). Nodes past |x| are
+        connected to the last node with weight one, like the padding of the backward encoding.
 
-            node_to_edge = log_alphas[i][:, None, None] * maski
-            edge_log_alphas = edge_log_alphas + node_to_edge
+        The result is O(L^2) per lattice, `conditionals` needs the inside weights between all pairs of nodes so
+        `backward_algorithm` can't replace it. With gradients the sweep is differentiated by `LatticeSweepFunction`,
+        which keeps the result and not the [B, M, L+1] window of each of the L steps.
 
-            values, indices = torch.max(edge_log_alphas[:, :, i], -1)
-            log_alphas.append(values)
-            back_pointers.append(indices)
+        transition_matrix: [B, M, L]
+        mask: [B, M, L]
+        lengths: [B]
 
-        log_alphas = torch.gather(torch.stack(log_alphas), 0, lengths.unsqueeze(0)).squeeze(0)
-        if log_alphas.isnan().any():
-            print("Nan loss detected")
-            code.interact(local=locals())
-        return log_alphas, edge_log_alphas, back_pointers
+        Returns [B, L+1 (from), L+1 (to)], row 0 are the alphas and column L the betas of all nodes.
+        """
+        B, M, L = transition_matrix.size()
 
-    def decode_backpointers(self, fwd_ids: torch.LongTensor, lengths: torch.LongTensor, back_pointers: List[torch.LongTensor]) -> List[List[int]]:
+        tail = torch.zeros_like(mask, dtype=torch.bool)
+        tail[:, 0, :] = torch.arange(L, device=lengths.device)[None, :] >= lengths[:, None]
+        transition_matrix = transition_matrix.masked_fill(tail, 0.0)
+        mask = mask.masked_fill(tail, 1.0)
+
+        # with the tail edges every lattice runs to node L, so there is no padding for the sweep to skip
+        semiring = PairwiseLogSemiring(L + 1)
+        node_mask = self.lattice_node_mask(mask)
+        edge_values = semiring.edge_values(transition_matrix, mask, node_mask)
+        active = [B] * L
+        edge_leaves, structure = tree_flatten(edge_values)
+        if semiring.analytic_backward and torch.is_grad_enabled() and any(e.requires_grad for e in edge_leaves):
+            log_inside, = LatticeSweepFunction.apply(semiring, node_mask, active, structure, *edge_leaves)
+        else:
+            (log_inside,), _ = semiring_sweep(edge_values, node_mask, semiring, active) # [B, L+1 (to), L+1 (steps back)]
+
+        # from node a to node b is b - a steps back from b
+        steps = torch.arange(L + 1, device=lengths.device)[None, :] - torch.arange(L + 1, device=lengths.device)[:, None] # [from, to]
+        node_log_inside = torch.gather(log_inside.transpose(1, 2), 1, steps.clamp(min=0).expand(B, L + 1, L + 1))
+        return node_log_inside.masked_fill(steps < 0, -INF)
+
+    def backtrace_edges(self, lengths: torch.LongTensor, back_pointers: List[torch.LongTensor]) -> Tuple[torch.LongTensor, torch.LongTensor, torch.LongTensor]:
+        """
+        Follows back pointers (the row of the chosen incoming edge of every node) for the whole batch at once, one
+        step per unit of the longest path.
+
+        lengths: [B]
+        back_pointers: L x [B]
+
+        Returns the rows and columns [B, L] of the edges on the paths from right to left (clamped to 0 after the first
+        node is reached) and the number of units of every path [B].
+        """
+        B, L = lengths.size(0), len(back_pointers)
+        back_pointers = torch.stack(back_pointers, 1) # [B, L]
+        batch_index = torch.arange(B, device=lengths.device)
+
+        column = lengths - 1
+        rows, columns = [], []
+        counts = torch.zeros_like(lengths)
+        for t in range(L):
+            active = column >= 0
+            curr_col = column.clamp(min=0)
+            curr_row = back_pointers[batch_index, curr_col]
+            rows.append(curr_row * active)
+            columns.append(curr_col)
+            counts = counts + active
+            column = column - (curr_row + 1) * active # unit length = row + 1
+        return torch.stack(rows, 1), torch.stack(columns, 1), counts
+
+    def viterbi_backtrace(self, fwd_ids: torch.LongTensor, lengths: torch.LongTensor, back_pointers: List[torch.LongTensor], padding_id: int = 0) -> Tuple[torch.LongTensor, torch.LongTensor]:
+        """
+        Follows the back pointers of `viterbi_algorithm` for the whole batch at once, one step per unit of the longest
+        path instead of one `.item()` per unit and lattice.
+
+        fwd_ids: [B, M, L]
+        lengths: [B]
+        back_pointers: L x [B]
+
+        Returns the ids of the viterbi paths [B, L] (left aligned, padded with `padding_id`) and the number of units of
+        every path [B].
+        """
         B, M, L = fwd_ids.size()
+        steps = torch.arange(L, device=fwd_ids.device)[None, :]
+
+        # the path ids come out right to left
+        rows, columns, counts = self.backtrace_edges(lengths, back_pointers)
+        reversed_ids = fwd_ids[torch.arange(B, device=fwd_ids.device)[:, None], rows, columns]
+
+        ids = torch.gather(reversed_ids, 1, (counts[:, None] - 1 - steps).clamp(min=0))
+        return ids.masked_fill(steps >= counts[:, None], padding_id), counts
+
+    def sample_algorithm(self, transition_matrix: torch.FloatTensor, mask: torch.FloatTensor, lengths: torch.LongTensor, num_samples: int = 1, generator: torch.Generator = None) -> List[torch.LongTensor]:
+        """
+        Forward filtering backward sampling, draws `num_samples` paths per lattice from the distribution defined by the
+        edge weights.
+
+        Walking backwards from the last node, the incoming edge of the current node is drawn in proportion to its
+        edge alpha (the forward weight of all paths ending with that edge), which only depends on the node. So one
+        draw per node and sample (Gumbel max over the rows) gives back pointers that `backtrace_edges` can follow
+        like the viterbi ones.
+
+        transition_matrix: [B, M, L]
+        mask: [B, M, L]
+        lengths: [B]
+
+        Returns back pointers L x [B * num_samples], the samples of every lattice are consecutive.
+        """
+        B, M, L = transition_matrix.size()
+        with torch.no_grad():
+            _, edge_log_alphas = self.forward_algorithm(transition_matrix, mask, lengths)
+            uniform = torch.rand(B, num_samples, M, L, device=edge_log_alphas.device, generator=generator)
+            gumbel = -(-uniform.clamp(min=1e-20).log()).log()
+            back_pointers = torch.argmax(edge_log_alphas.float().unsqueeze(1) + gumbel, 2).reshape(B * num_samples, L)
+        return list(back_pointers.unbind(1))
+
+    def sample_paths(self, transition_matrix: torch.FloatTensor, mask: torch.FloatTensor, lengths: torch.LongTensor, num_samples: int = 1, generator: torch.Generator = None) -> torch.FloatTensor:
+        """
+        Draws `num_samples` paths per lattice (see `sample_algorithm`).
+
+        Returns the edges on the paths as 0 / 1 indicators in the layout of the transition matrix [B, num_samples, M, L].
+        """
+        B, M, L = transition_matrix.size()
+        back_pointers = self.sample_algorithm(transition_matrix, mask, lengths, num_samples=num_samples, generator=generator)
+        rows, columns, counts = self.backtrace_edges(lengths.repeat_interleave(num_samples), back_pointers)
+        on_path = torch.arange(L, device=counts.device)[None, :] < counts[:, None]
+        paths = transition_matrix.new_zeros(B * num_samples, M, L)
+        paths[torch.arange(B * num_samples, device=counts.device)[:, None].expand(-1, L)[on_path], rows[on_path], columns[on_path]] = 1.0
+        return paths.reshape(B, num_samples, M, L)
+
+    def sample_tokenizations(self, fwd_ids: torch.LongTensor, transition_matrix: torch.FloatTensor, mask: torch.FloatTensor, lengths: torch.LongTensor, num_samples: int = 1, padding_id: int = 0, generator: torch.Generator = None) -> Tuple[torch.LongTensor, torch.LongTensor]:
+        """
+        Draws `num_samples` tokenizations per lattice (see `sample_algorithm`).
+
+        Returns the ids [B, num_samples, L] (left aligned, padded with `padding_id`) and the number of units of every
+        sample [B, num_samples].
+        """
+        B, M, L = fwd_ids.size()
+        back_pointers = self.sample_algorithm(transition_matrix, mask, lengths, num_samples=num_samples, generator=generator)
+        ids, counts = self.viterbi_backtrace(fwd_ids.repeat_interleave(num_samples, 0), lengths.repeat_interleave(num_samples), back_pointers, padding_id=padding_id)
+        return ids.reshape(B, num_samples, L), counts.reshape(B, num_samples)
+
+    def decode_backpointers(self, fwd_ids: torch.LongTensor, lengths: torch.LongTensor, back_pointers: List[torch.LongTensor]) -> List[List[int]]:
+        ids, counts = self.viterbi_backtrace(fwd_ids, lengths, back_pointers)
+        return [row[:count] for row, count in zip(ids.tolist(), counts.tolist())]
 
-        viterbi_sequences = []
-        for b in range(B):
-            viterbi_back_sequence = []
-            curr_col = lengths[b]-1
-            while curr_col >= 0:
-                curr_row = back_pointers[curr_col][b]
-                curr_id = fwd_ids[b, curr_row, curr_col].item()
-                unit_length = curr_row + 1
-                viterbi_back_sequence.append(curr_id)
-                curr_col -= unit_length
-            assert curr_col == -1
-            viterbi_sequences.append(list(reversed(viterbi_back_sequence)))
-        return viterbi_sequences
     def entropy(self, transition_matrix: torch.FloatTensor, mask: torch.FloatTensor, lengths: torch.LongTensor) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
         """Essentially forward but with a more tricky semiring"""
-        B, M, L= transition_matrix.size()
-
         # alleviate overflow and underflow
         transition_matrix = transition_matrix.double()
 
-        bmask: torch.BoolTensor = mask.to(torch.bool)
-        edge_log_alphas: torch.FloatTensor = torch.ones_like(transition_matrix).fill_(-INF)
-        edge_log_alphas[bmask] = 0.0
-        edge_log_alphas += transition_matrix
-        edge_entropy: torch.FloatTensor = torch.zeros_like(transition_matrix).double() # diff
-        entropy_transition_matrix: torch.FloatTensor = - transition_matrix * transition_matrix.exp() * mask # diff -plogp
-        log_alphas: List[torch.FloatTensor] = [mask.new_zeros(B)]
-        entropies: List[torch.FloatTensor] = [mask.new_zeros(B)] # diff
-        for i in range(L):
-            maski = (bmask & torch.diag_embed(mask.new_ones(L - i, dtype=torch.bool), offset=i)[:M].unsqueeze(0)).to(torch.float)
-            node_to_edge = log_alphas[i][:, None, None] * maski
-            edge_log_alphas = edge_log_alphas + node_to_edge
-            log_alphas.append(torch.logsumexp(edge_log_alphas[:, :, i], -1))
-
-            node_to_edge_ent = ((log_alphas[i][:, None, None].exp() * maski) * (entropy_transition_matrix * maski)
-                                +  (entropies[i][:, None, None] * maski) * (transition_matrix.exp() * maski))# diff: possibly underflows if low weight edges exist
-            edge_entropy = edge_entropy + node_to_edge_ent
-            entropies.append(torch.sum(edge_entropy[:, :, i], -1))
-        uentropy = torch.gather(torch.stack(entropies), 0, lengths.unsqueeze(0))
-        log_alphas = torch.gather(torch.stack(log_alphas), 0, lengths.unsqueeze(0))
+        (log_alphas, uentropy), (_, edge_entropy), _, _ = self.semiring_algorithm(transition_matrix, mask, lengths, EntropySemiring())
         if DEBUG: code.interact(local=locals())
-        return (uentropy/ log_alphas.exp() + log_alphas).squeeze(0), edge_entropy # entropy = internal energy + free energy
+        return uentropy.squeeze(-1) / log_alphas.exp() + log_alphas, edge_entropy.squeeze(-1) # entropy = internal energy + free energy
 
     def expectation(self, transition_matrix: torch.FloatTensor, value_matrix: torch.FloatTensor, mask: torch.FloatTensor, lengths: torch.LongTensor) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
         """Essentially forward but with a more tricky semiring"""
-        B, M, L= transition_matrix.size()
-
         # alleviate overflow and underflow
         transition_matrix = transition_matrix.double()
 
-        # adjusting for underflow
-        bmask: torch.BoolTensor = mask.to(torch.bool)
-        edge_log_alphas: torch.FloatTensor = torch.ones_like(transition_matrix).fill_(-INF)
-        edge_log_alphas[bmask] = 0.0
-        edge_log_alphas += transition_matrix
-        edge_expected_value: torch.FloatTensor = torch.zeros_like(transition_matrix).double() # diff
-        expected_value_transition_matrix: torch.FloatTensor = value_matrix * transition_matrix.exp() # diff pv
-
-        log_alphas: List[torch.FloatTensor] = [mask.new_zeros(B)]
-        expected_values: List[torch.FloatTensor] = [mask.new_zeros(B)] # diff
-        for i in range(L):
-            maski = (bmask & torch.diag_embed(mask.new_ones(L - i, dtype=torch.bool), offset=i)[:M].unsqueeze(0)).to(torch.float)
-            node_to_edge = log_alphas[i][:, None, None] * maski
-            edge_log_alphas = edge_log_alphas + node_to_edge
-            log_alphas.append(torch.logsumexp(edge_log_alphas[:, :, i], -1))
-
-            node_to_edge_ent = ((log_alphas[i][:, None, None].exp() * maski) * (expected_value_transition_matrix * maski)
-                                +  (expected_values[i][:, None, None] * maski) * (transition_matrix.exp() * maski))# diff: possibly underflows if low weight edges exist
-            edge_expected_value = edge_expected_value + node_to_edge_ent
-            expected_values.append(torch.sum(edge_expected_value[:, :, i], -1))
-        uexpected_value = torch.gather(torch.stack(expected_values), 0, lengths.unsqueeze(0))
-        log_alphas = torch.gather(torch.stack(log_alphas), 0, lengths.unsqueeze(0))
-        ev = (uexpected_value/ log_alphas.exp()).squeeze(0)
+        (log_alphas, uexpected_value), (_, edge_expected_value), _, _ = self.semiring_algorithm(transition_matrix, mask, lengths, LogExpectationSemiring(value_matrix))
+        ev = uexpected_value.squeeze(-1) / log_alphas.exp()
         if ev.sum() < 1 or ev.isnan().any():
             print("Warning: underflow may be happening")
-        return ev, edge_expected_value # entropy = internal energy + free energy
+        return ev, edge_expected_value.squeeze(-1)
+
+    def forward_statistics(self, transition_matrix: torch.FloatTensor, mask: torch.FloatTensor, lengths: torch.LongTensor, value_matrix: torch.FloatTensor = None, entropy: bool = True) -> Tuple[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
+        """
+        Fuses `forward_algorithm`, `entropy` and `expectation` into a single (double precision) sweep.
+
+        transition_matrix: [B, M, L]
+        mask: [B, M, L]
+        lengths: [B]
+        value_matrix: [B, M, L] or [B, M, L, C] additive edge values (e.g. 1 for every edge to get the expected number
+                      of tokens)
+
+        Returns log_alpha [B], edge_log_alpha [B, M, L], node_log_alpha [B, L+1] (in the dtype of transition_matrix),
+        the entropy [B] (None if not `entropy`) and the expected values [B] or [B, C] (None if no value_matrix).
+        """
+        dtype = transition_matrix.dtype
+        transition_matrix = transition_matrix.double()
+
+        if not entropy and value_matrix is None:
+            semiring = LogSemiring()
+        else:
+            semiring = LogExpectationSemiring(value_matrix, entropy=entropy)
+        last_values, edge_values, node_values, _ = self.semiring_algorithm(transition_matrix, mask, lengths, semiring)
+        log_alpha, edge_log_alpha, node_log_alpha = last_values[0], edge_values[0], node_values[0]
+
+        ent, ev = None, None
+        if len(last_values) > 1:
+            normalized = last_values[1] / log_alpha.exp().unsqueeze(-1)
+            if entropy:
+                ent, normalized = normalized[:, 0] + log_alpha, normalized[:, 1:] # entropy = internal energy + free energy
+            if value_matrix is not None:
+                ev = normalized.squeeze(-1) if value_matrix.dim() == 3 else normalized
+        return log_alpha.to(dtype), edge_log_alpha.to(dtype), node_log_alpha.to(dtype), ent, ev
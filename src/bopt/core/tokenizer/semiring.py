@@ -0,0 +1,319 @@
+from typing import List, Optional, Tuple
+
+import torch
+
+INF = 1e9
+
+
+def tree_map(fn, *values):
+    """
+    Applies `fn` leaf-wise to (possibly nested) tuples of tensors with the same structure.
+    """
+    if isinstance(values[0], tuple):
+        return tuple(tree_map(fn, *vs) for vs in zip(*values))
+    return fn(*values)
+
+
+def tree_flatten(values) -> Tuple[List, object]:
+    """
+    Flattens (possibly nested) tuples of tensors into a list of leaves and a structure for `tree_unflatten`.
+    """
+    if isinstance(values, tuple):
+        leaves, structure = [], []
+        for v in values:
+            l, s = tree_flatten(v)
+            leaves.extend(l)
+            structure.append(s)
+        return leaves, tuple(structure)
+    return [values], None
+
+
+def tree_unflatten(leaves, structure):
+    """
+    Inverse of `tree_flatten`.
+    """
+    leaves = iter(leaves)
+
+    def unflatten(s):
+        if isinstance(s, tuple):
+            return tuple(unflatten(ss) for ss in s)
+        return next(leaves)
+    return unflatten(structure)
+
+
+def expand_mask(mask: torch.FloatTensor, value: torch.Tensor) -> torch.FloatTensor:
+    """
+    Appends singleton dimensions to `mask` so that it broadcasts against the trailing (semiring specific) dimensions of
+    `value`.
+    """
+    return mask.reshape(*mask.size(), *([1] * (value.dim() - mask.dim())))
+
+
+class Semiring:
+    """
+    A semiring for `LatticeDPMixin.semiring_algorithm`.
+
+    Values are tuples of tensors. Node values have shape [B, ...], a window of incoming edges [B, M, ...], and edge
+    values [B, M, L, ...], where the trailing dimensions are semiring specific (e.g. the value channels of an
+    expectation semiring).
+
+    Semirings with `analytic_backward` implement `backward`, which lets `LatticeSweepFunction` differentiate a sweep
+    with one reverse sweep instead of keeping the unrolled graph.
+    """
+    analytic_backward = False
+
+    def edge_values(self, transition_matrix: torch.FloatTensor, mask: torch.FloatTensor, node_mask: torch.FloatTensor) -> Tuple:
+        """
+        Converts edge log potentials into semiring values.
+
+        transition_matrix: [B, M, L]
+        mask: [B, M, L]
+        node_mask: [B, M, L], the edges that are inside the lattice and in the vocabulary
+        """
+        raise NotImplementedError
+
+    def one(self, edge_values: Tuple) -> Tuple:
+        """
+        Value of the start node of the lattice.
+        """
+        raise NotImplementedError
+
+    def zero(self, one: Tuple) -> Tuple:
+        """
+        Value of a node without any paths (of the same shape as `one`), used for the nodes past the end of a lattice.
+        """
+        raise NotImplementedError
+
+    def times(self, node_values: Tuple, edge_values: Tuple, node_mask: torch.FloatTensor) -> Tuple:
+        """
+        Extends the paths ending at the start node of every edge by that edge. `node_mask` is 0 for edges that don't
+        receive the value of their start node.
+        """
+        raise NotImplementedError
+
+    def plus(self, values: Tuple) -> Tuple[Tuple, Optional[torch.LongTensor]]:
+        """
+        Aggregates the values of the incoming edges of a node (dim 1), returns the node values and optionally
+        back pointers.
+        """
+        raise NotImplementedError
+
+    def backward(self, window: Tuple, edge_values: Tuple, node_mask: torch.FloatTensor, node_values: Tuple, node_grads: Tuple) -> Tuple[Tuple, Tuple]:
+        """
+        Reverse mode of `plus(times(window, edge_values, node_mask))` for a single node.
+
+        window: values of the start nodes of the incoming edges [B, M, ...]
+        edge_values: values of the incoming edges [B, M, ...]
+        node_mask: [B, M]
+        node_values: the result of the forward sweep for the node [B, ...]
+        node_grads: gradient w.r.t. node_values [B, ...]
+
+        Returns the gradients w.r.t. window and edge_values.
+        """
+        raise NotImplementedError
+
+
+class LogSemiring(Semiring):
+    """
+    (logsumexp, +), computes log alphas.
+    """
+    analytic_backward = True
+
+    def edge_values(self, transition_matrix, mask, node_mask):
+        bmask: torch.BoolTensor = mask.to(torch.bool)
+        edge_log_alphas: torch.FloatTensor = torch.ones_like(transition_matrix).fill_(-INF)
+        edge_log_alphas[bmask] = 0.0
+        edge_log_alphas += transition_matrix
+        return (edge_log_alphas,)
+
+    def one(self, edge_values):
+        return (edge_values[0].new_zeros(edge_values[0].size(0)),)
+
+    def zero(self, one):
+        return (torch.full_like(one[0], -INF),)
+
+    def times(self, node_values, edge_values, node_mask):
+        return (edge_values[0] + node_values[0] * node_mask,)
+
+    def plus(self, values):
+        return (torch.logsumexp(values[0], 1),), None
+
+    def posteriors(self, edge_log_alphas: torch.FloatTensor, log_alphas: torch.FloatTensor) -> torch.FloatTensor:
+        """
+        Share of every incoming edge [B, M] in the value of the node [B], i.e. the gradient of `plus`.
+        """
+        return (edge_log_alphas - log_alphas.unsqueeze(1)).exp()
+
+    def backward(self, window, edge_values, node_mask, node_values, node_grads):
+        edge_log_alphas, = self.times(window, edge_values, node_mask)
+        edge_grads = node_grads[0].unsqueeze(1) * self.posteriors(edge_log_alphas, node_values[0])
+        return (edge_grads * node_mask,), (edge_grads,)
+
+
+
+class PairwiseLogSemiring(LogSemiring):
+    """
+    (logsumexp, +) from all start nodes at once, the last dimension of a node value holds the log inside weights from
+    the nodes d = 0 ... num_nodes - 1 steps back (0 for d = 0, the empty path). An incoming edge of unit length k
+    extends the paths of its start node by k steps, i.e. shifts its values by k, so every node has the same layout and
+    the sweep (and `LatticeSweepFunction`) doesn't need to know which node it is at.
+    """
+
+    def __init__(self, num_nodes: int):
+        self.num_nodes = num_nodes
+
+    def shift(self, values: torch.FloatTensor, fill: float, reverse: bool = False) -> torch.FloatTensor:
+        """
+        Shifts the values [B, M, ..., S] of row k (unit length k+1) by k+1 steps back (forward if `reverse`),
+        filling with `fill`.
+        """
+        M, S = values.size(1), values.size(-1)
+        steps = torch.arange(1, M + 1, device=values.device)[:, None]
+        offsets = torch.arange(S, device=values.device)[None, :]
+        if reverse:
+            index, padding = offsets + steps, (0, M)
+        else:
+            index, padding = offsets - steps + M, (M, 0)
+        index = index.reshape(1, M, *([1] * (values.dim() - 3)), S).expand(values.size())
+        return torch.gather(torch.nn.functional.pad(values, padding, value=fill), -1, index)
+
+    def edge_values(self, transition_matrix, mask, node_mask):
+        edge_log_alphas, = LogSemiring.edge_values(self, transition_matrix, mask, node_mask)
+        return (edge_log_alphas.unsqueeze(-1),)
+
+    def one(self, edge_values):
+        one = edge_values[0].new_full((edge_values[0].size(0), self.num_nodes), -INF)
+        one[:, 0] = 0.0
+        return (one,)
+
+    def times(self, node_values, edge_values, node_mask):
+        shifted = self.shift(node_values[0], -INF)
+        return (edge_values[0] + shifted * expand_mask(node_mask, shifted),)
+
+    def plus(self, values):
+        log_inside = torch.logsumexp(values[0], 1)
+        return (torch.cat([torch.zeros_like(log_inside[..., :1]), log_inside[..., 1:]], -1),), None
+
+    def backward(self, window, edge_values, node_mask, node_values, node_grads):
+        edge_log_alphas, = self.times(window, edge_values, node_mask)
+        # the empty path doesn't depend on anything
+        node_grads = torch.cat([torch.zeros_like(node_grads[0][..., :1]), node_grads[0][..., 1:]], -1)
+        edge_grads = node_grads.unsqueeze(1) * self.posteriors(edge_log_alphas, node_values[0])
+        window_grads = self.shift(edge_grads * expand_mask(node_mask, edge_grads), 0.0, reverse=True)
+        return (window_grads,), (edge_grads.sum(-1, keepdim=True),)
+
+class MaxSemiring(LogSemiring):
+    """
+    (max, +), computes viterbi scores, `plus` also returns the back pointers (the row / unit length - 1 of the best
+    incoming edge).
+    """
+    analytic_backward = False
+
+    def plus(self, values):
+        values, indices = torch.max(values[0], 1)
+        return (values,), indices
+
+
+class LogExpectationSemiring(Semiring):
+    """
+    First order expectation semiring with the probability kept in log space, values are (log p, r) where r is the
+    unnormalized expectation (sum over paths of p(path) * value(path)) of one or more additive edge values.
+
+    value_matrix: [B, M, L] or [B, M, L, C] additive edge values
+    entropy: if set, the first channel is -log p(edge), which makes r / Z + log Z the entropy
+    """
+    analytic_backward = True
+
+    def __init__(self, value_matrix: torch.FloatTensor = None, entropy: bool = False):
+        if value_matrix is not None and value_matrix.dim() == 3:
+            value_matrix = value_matrix.unsqueeze(-1)
+        self.value_matrix = value_matrix
+        self.entropy = entropy
+
+    def edge_values(self, transition_matrix, mask, node_mask):
+        channels = []
+        if self.entropy:
+            channels.append((- transition_matrix * transition_matrix.exp() * mask).unsqueeze(-1)) # -plogp
+        if self.value_matrix is not None:
+            channels.append(self.value_matrix * transition_matrix.exp().unsqueeze(-1)) # pv
+        edge_log_alphas, = LogSemiring.edge_values(self, transition_matrix, mask, node_mask)
+        return edge_log_alphas, torch.cat(channels, -1) * node_mask.unsqueeze(-1), transition_matrix.exp() * node_mask
+
+    def one(self, edge_values):
+        B, C = edge_values[1].size(0), edge_values[1].size(-1)
+        return edge_values[0].new_zeros(B), edge_values[1].new_zeros(B, C)
+
+    def zero(self, one):
+        return torch.full_like(one[0], -INF), torch.zeros_like(one[1])
+
+    def times(self, node_values, edge_values, node_mask):
+        log_alphas, values = node_values
+        edge_log_alphas, edge_values, edge_potentials = edge_values
+        vmask = expand_mask(node_mask, values)
+        return (edge_log_alphas + log_alphas * node_mask,
+                (log_alphas.exp() * node_mask).unsqueeze(-1) * edge_values + (values * vmask) * edge_potentials.unsqueeze(-1)) # possibly underflows if low weight edges exist
+
+    def plus(self, values):
+        return (torch.logsumexp(values[0], 1), torch.sum(values[1], 1)), None
+
+    def backward(self, window, edge_values, node_mask, node_values, node_grads):
+        log_alphas, values = window
+        edge_log_alphas, edge_values, edge_potentials = edge_values
+        log_alpha_grad, value_grad = node_grads
+        vmask = expand_mask(node_mask, values)
+        alphas = log_alphas.exp() * node_mask
+
+        # log p, the log semiring part
+        edge_log_alpha_grads = log_alpha_grad.unsqueeze(1) * LogSemiring.posteriors(self, edge_log_alphas + log_alphas * node_mask, node_values[0])
+        # r, every incoming edge contributes alpha(start) * value(edge) + r(start) * p(edge)
+        value_grad = value_grad.unsqueeze(1)
+        window_grads = (edge_log_alpha_grads * node_mask + alphas * (value_grad * edge_values).sum(-1),
+                        value_grad * edge_potentials.unsqueeze(-1) * vmask)
+        edge_grads = (edge_log_alpha_grads,
+                      value_grad * alphas.unsqueeze(-1),
+                      (value_grad * values * vmask).sum(-1))
+        return window_grads, edge_grads
+
+
+class EntropySemiring(LogExpectationSemiring):
+
+    def __init__(self):
+        super().__init__(entropy=True)
+
+
+
+class ProductSemiring(Semiring):
+    """
+    Runs several semirings in the same sweep, values are tuples with one entry per semiring. `plus` returns the back
+    pointers of the first semiring that has any (e.g. the viterbi path of (max, +) next to log Z).
+
+    `LogExpectationSemiring` fuses log Z with its expectations through extra value channels instead, since its r
+    channels need the log alphas of the same sweep.
+    """
+
+    def __init__(self, *semirings: Semiring):
+        self.semirings = semirings
+
+    @property
+    def analytic_backward(self):
+        return all(semiring.analytic_backward for semiring in self.semirings)
+
+    def edge_values(self, transition_matrix, mask, node_mask):
+        return tuple(semiring.edge_values(transition_matrix, mask, node_mask) for semiring in self.semirings)
+
+    def one(self, edge_values):
+        return tuple(semiring.one(ev) for semiring, ev in zip(self.semirings, edge_values))
+
+    def zero(self, one):
+        return tuple(semiring.zero(o) for semiring, o in zip(self.semirings, one))
+
+    def times(self, node_values, edge_values, node_mask):
+        return tuple(semiring.times(nv, ev, node_mask) for semiring, nv, ev in zip(self.semirings, node_values, edge_values))
+
+    def plus(self, values):
+        values, back_pointers = zip(*[semiring.plus(v) for semiring, v in zip(self.semirings, values)])
+        return tuple(values), next((bp for bp in back_pointers if bp is not None), None)
+
+    def backward(self, window, edge_values, node_mask, node_values, node_grads):
+        window_grads, edge_grads = zip(*[semiring.backward(w, ev, node_mask, nv, ng) for semiring, w, ev, nv, ng in zip(self.semirings, window, edge_values, node_values, node_grads)])
+        return tuple(window_grads), tuple(edge_grads)
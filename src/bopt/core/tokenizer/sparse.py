@@ -0,0 +1,144 @@
+from typing import NamedTuple, Tuple
+
+import torch
+
+from bopt.core.tokenizer.semiring import INF
+
+
+class SparseLattice(NamedTuple):
+    """
+    A batch of lattices as one edge list, for large max unit lengths where most slots of the dense [B, M, L]
+    transition matrices are empty.
+
+    Edges are sorted by end node, so the incoming edges of node n (of all lattices in the batch) are
+    node_offsets[n-1]:node_offsets[n], the same as column n-1 of a transition matrix (CSR over end nodes).
+
+    ids: [E] unit ids
+    start: [E] start node of every edge
+    end: [E] end node of every edge (1 to L)
+    lattice: [E] index of the lattice of every edge in the batch
+    node_offsets: [L+1]
+    lengths: [B]
+    M: max unit length of the dense encoding
+    """
+    ids: torch.LongTensor
+    start: torch.LongTensor
+    end: torch.LongTensor
+    lattice: torch.LongTensor
+    node_offsets: torch.LongTensor
+    lengths: torch.LongTensor
+    M: int
+
+
+def segment_logsumexp(values: torch.FloatTensor, segments: torch.LongTensor, num_segments: int) -> torch.FloatTensor:
+    """
+    logsumexp of values [E] grouped by segments [E], returns [num_segments] with -INF for empty segments.
+    """
+    maxes = values.new_full((num_segments,), -INF).scatter_reduce(0, segments, values.detach(), "amax")
+    sums = values.new_zeros(num_segments).index_add(0, segments, (values - maxes[segments]).exp())
+    return maxes + sums.masked_fill(sums == 0, 1.0).log()
+
+
+class SparseLatticeMixin:
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    def to_sparse_lattice(self, fwd_ids: torch.LongTensor, fwd_ms: torch.FloatTensor, lengths: torch.LongTensor) -> SparseLattice:
+        """
+        Converts forward encodings (see `encode_transitions`) into a `SparseLattice`, keeping the slots in the mask.
+
+        fwd_ids: [B, M, L]
+        fwd_ms: [B, M, L]
+        lengths: [B]
+        """
+        B, M, L = fwd_ids.size()
+        band = torch.arange(L, device=fwd_ids.device)[None, :] >= torch.arange(M, device=fwd_ids.device)[:, None]
+        column, lattice, row = (fwd_ms.to(torch.bool) & band[None]).permute(2, 0, 1).nonzero(as_tuple=True) # sorted by column
+        node_offsets = torch.cat([column.new_zeros(1), torch.bincount(column, minlength=L).cumsum(0)])
+        return SparseLattice(fwd_ids[lattice, row, column], column - row, column + 1, lattice, node_offsets, lengths, M)
+
+    def to_dense_values(self, lattice: SparseLattice, values: torch.Tensor, fill) -> torch.Tensor:
+        """
+        Scatters edge values [E] into the [B, M, L] layout of the forward encodings, empty slots are `fill`.
+        """
+        B, L = lattice.lengths.size(0), lattice.node_offsets.size(0) - 1
+        dense = values.new_full((B, lattice.M, L), fill)
+        return dense.index_put((lattice.lattice, lattice.end - lattice.start - 1, lattice.end - 1), values)
+
+    def to_dense_lattice(self, lattice: SparseLattice) -> Tuple[torch.LongTensor, torch.FloatTensor, torch.LongTensor]:
+        """
+        Inverse of `to_sparse_lattice`, returns fwd_ids, fwd_ms and lengths.
+        """
+        fwd_ids = self.to_dense_values(lattice, lattice.ids, self.pad_index)
+        fwd_ms = self.to_dense_values(lattice, torch.ones_like(lattice.ids, dtype=torch.float), 0.0)
+        return fwd_ids, fwd_ms, lattice.lengths
+
+    def sparse_forward_algorithm(self, lattice: SparseLattice, transitions: torch.FloatTensor) -> Tuple[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
+        """
+        `forward_algorithm` over a `SparseLattice`, every step only touches the incoming edges of one node.
+
+        transitions: [E] edge log potentials (e.g. `get_weights(lattice.ids)`)
+
+        Returns log_alphas [B], edge_log_alphas [E] and node_log_alphas [B, L+1].
+        """
+        B, M, L = lattice.lengths.size(0), lattice.M, lattice.node_offsets.size(0) - 1
+        offsets = lattice.node_offsets.tolist()
+        unit_length = lattice.end - lattice.start - 1
+
+        # window[:, k] = alpha of node n - 1 - k, as in `semiring_algorithm`
+        window = transitions.new_zeros(B, M)
+        node_log_alphas = [window[:, 0]]
+        for n in range(1, L + 1):
+            edges = slice(offsets[n - 1], offsets[n])
+            log_alphas = segment_logsumexp(transitions[edges] + window[lattice.lattice[edges], unit_length[edges]], lattice.lattice[edges], B)
+            node_log_alphas.append(log_alphas)
+            window = torch.cat([log_alphas.unsqueeze(1), window[:, :-1]], 1)
+        node_log_alphas = torch.stack(node_log_alphas, 1)
+
+        edge_log_alphas = transitions + node_log_alphas[lattice.lattice, lattice.start]
+        return node_log_alphas[torch.arange(B, device=lattice.lengths.device), lattice.lengths], edge_log_alphas, node_log_alphas
+
+    def sparse_entropy(self, lattice: SparseLattice, transitions: torch.FloatTensor) -> torch.FloatTensor:
+        """
+        `entropy` over a `SparseLattice`, the first order expectation semiring with -log p(edge) as the edge value,
+        summed per node with `index_add`.
+
+        transitions: [E] edge log potentials
+
+        Returns the entropy [B].
+        """
+        # alleviate overflow and underflow
+        transitions = transitions.double()
+
+        B, M, L = lattice.lengths.size(0), lattice.M, lattice.node_offsets.size(0) - 1
+        offsets = lattice.node_offsets.tolist()
+        unit_length = lattice.end - lattice.start - 1
+        potentials = transitions.exp()
+        edge_entropy = - transitions * potentials # -plogp
+
+        window, uentropy_window = transitions.new_zeros(B, M), transitions.new_zeros(B, M)
+        node_values = [(window[:, 0], uentropy_window[:, 0])]
+        for n in range(1, L + 1):
+            edges = slice(offsets[n - 1], offsets[n])
+            segments = lattice.lattice[edges]
+            start_log_alphas, start_uentropy = window[segments, unit_length[edges]], uentropy_window[segments, unit_length[edges]]
+            log_alphas = segment_logsumexp(transitions[edges] + start_log_alphas, segments, B)
+            uentropy = transitions.new_zeros(B).index_add(0, segments, start_log_alphas.exp() * edge_entropy[edges] + start_uentropy * potentials[edges])
+            node_values.append((log_alphas, uentropy))
+            window = torch.cat([log_alphas.unsqueeze(1), window[:, :-1]], 1)
+            uentropy_window = torch.cat([uentropy.unsqueeze(1), uentropy_window[:, :-1]], 1)
+        log_alphas, uentropy = [torch.stack(values, 1)[torch.arange(B, device=lattice.lengths.device), lattice.lengths] for values in zip(*node_values)]
+        return uentropy / log_alphas.exp() + log_alphas # entropy = internal energy + free energy
+
+    def sparse_marginals(self, lattice: SparseLattice, transitions: torch.FloatTensor) -> torch.FloatTensor:
+        """
+        Edge marginals [E], the gradient of log Z w.r.t. the edge log potentials (forward x outside).
+        """
+        create_graph = torch.is_grad_enabled() and transitions.requires_grad
+        with torch.enable_grad():
+            if not transitions.requires_grad:
+                transitions = transitions.detach().requires_grad_()
+            log_alphas, _, _ = self.sparse_forward_algorithm(lattice, transitions)
+            marginals, = torch.autograd.grad(log_alphas.sum(), transitions, create_graph=create_graph)
+        return marginals
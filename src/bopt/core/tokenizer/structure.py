@@ -0,0 +1,105 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Tuple, Union
+
+import numpy as np
+import torch
+
+Structure = Union[torch.Tensor, Tuple[torch.Tensor, ...]]
+
+
+class StructureRegistry:
+    """
+    Least recently used cache of the structural tensors that only depend on the shape of a lattice (permutations,
+    attention masks, ...), shared by the tokenizer mixins.
+
+    Entries are built on cpu and copied to other devices on demand, every (name, key, device) counts towards
+    `max_bytes`. If `persist_dir` is set (or the BOPT_STRUCTURE_CACHE environment variable), the cpu copies are also
+    written there as .npy files and loaded back memory mapped (copy on write), so DataLoader workers and later runs
+    share the pages instead of rebuilding them.
+
+    The registry is shared by all tokenizers of the process, including copies running on other threads (see
+    `StaleLatticePipeline`), so the entries are only touched under a lock. Values are built outside of it.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20, persist_dir: str = None):
+        self.max_bytes = max_bytes
+        self.persist_dir = persist_dir if persist_dir is not None else os.environ.get("BOPT_STRUCTURE_CACHE")
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, name: str, key: Tuple, build: Callable[[], Structure], device: str = "cpu") -> Structure:
+        """
+        Returns the structure `name` for `key` (e.g. (L, M)) on `device`, calling `build` for a cpu copy on a miss.
+        """
+        entry = (name, key, str(device))
+        with self.lock:
+            if entry in self.entries:
+                self.entries.move_to_end(entry)
+                return self.entries[entry]
+        if str(device) != "cpu":
+            value = self.get(name, key, build)
+            value = tuple(v.to(device) for v in value) if isinstance(value, tuple) else value.to(device)
+        else:
+            value = self.load(name, key, build)
+        return self.insert(entry, value)
+
+    def load(self, name: str, key: Tuple, build: Callable[[], Structure]) -> Structure:
+        if self.persist_dir is None:
+            return build()
+        prefix = os.path.join(self.persist_dir, "-".join([name] + [str(k) for k in key]))
+        if not os.path.exists(f"{prefix}.npy") and not os.path.exists(f"{prefix}-0.npy"):
+            value = build()
+            os.makedirs(self.persist_dir, exist_ok=True)
+            # write to temporary files first so that concurrent readers never see a partial array, the first file
+            # marks the entry as complete so it is moved into place last
+            for path, v in reversed(list(zip(self.paths(prefix, value), value if isinstance(value, tuple) else (value,)))):
+                tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as f:
+                    np.save(f, v.numpy())
+                os.replace(tmp, path)
+            return value
+        if os.path.exists(f"{prefix}.npy"):
+            return torch.from_numpy(np.load(f"{prefix}.npy", mmap_mode="c"))
+        values, i = [], 0
+        while os.path.exists(f"{prefix}-{i}.npy"):
+            values.append(torch.from_numpy(np.load(f"{prefix}-{i}.npy", mmap_mode="c")))
+            i += 1
+        return tuple(values)
+
+    @staticmethod
+    def paths(prefix: str, value: Structure):
+        if isinstance(value, tuple):
+            return [f"{prefix}-{i}.npy" for i in range(len(value))]
+        return [f"{prefix}.npy"]
+
+    def insert(self, entry: Tuple, value: Structure) -> Structure:
+        """
+        Adds `value` unless another thread added the entry in the meantime, returns the value of the entry.
+        """
+        with self.lock:
+            if entry in self.entries:
+                self.entries.move_to_end(entry)
+                return self.entries[entry]
+            self.entries[entry] = value
+            self.nbytes += self.size(value)
+            # always keep the newest entry, even if it is larger than the budget on its own
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= self.size(evicted)
+            return value
+
+    @staticmethod
+    def size(value: Structure) -> int:
+        values = value if isinstance(value, tuple) else (value,)
+        return sum(v.numel() * v.element_size() for v in values)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+structures = StructureRegistry()
@@ -0,0 +1,377 @@
+import itertools
+import math
+
+import torch
+
+from bopt.core.attention_bias import BlockAttentionBias
+from bopt.core.integerize import Integerizer
+from bopt.core.tokenizer import Tokenizer
+from bopt.core.tokenizer.attention import LatticeAttentionMixin
+from bopt.core.tokenizer.dynamic import LatticeDPMixin
+from bopt.core.tokenizer.semiring import LogExpectationSemiring, LogSemiring, ProductSemiring
+
+INF = 1e9
+
+dp = LatticeDPMixin()
+
+
+def random_lattices(B=4, M=3, L=7, lengths=(5, 7, 0, 1), seed=0):
+    # ragged unsorted lengths (including an empty lattice) and edges missing from the vocabulary, characters are
+    # always edges
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.tensor(lengths)
+    mask = (torch.rand(B, M, L, generator=generator) > 0.4).double()
+    mask[:, 0] = 1
+    mask = mask * torch.triu(torch.ones(M, L, dtype=torch.double)) * (torch.arange(L)[None, None] < lengths[:, None, None])
+    transition_matrix = torch.randn(B, M, L, dtype=torch.double, generator=generator)
+    value_matrix = torch.rand(B, M, L, 2, dtype=torch.double, generator=generator)
+    return transition_matrix, value_matrix, mask, lengths
+
+
+def uses_sweep_function(tensor: torch.Tensor) -> bool:
+    seen, stack = set(), [tensor.grad_fn]
+    while stack:
+        fn = stack.pop()
+        if fn is None or fn in seen:
+            continue
+        seen.add(fn)
+        if type(fn).__name__ == "LatticeSweepFunctionBackward":
+            return True
+        stack.extend(next_fn for next_fn, _ in fn.next_functions)
+    return False
+
+
+def loop_gradients(fn, inputs, weights):
+    # autograd through the unrolled loop of `semiring_sweep`
+    try:
+        LogSemiring.analytic_backward = LogExpectationSemiring.analytic_backward = False
+        outputs = fn(*inputs)
+        assert not any(uses_sweep_function(output) for output in outputs)
+        return torch.autograd.grad(sum((output * weight).sum() for output, weight in zip(outputs, weights)), inputs)
+    finally:
+        LogSemiring.analytic_backward = LogExpectationSemiring.analytic_backward = True
+
+
+def inside(mask, log_alpha, edge_log_alpha, *outputs):
+    # the numerical jacobian of -INF + t is mostly rounding error, the edges outside the lattice are left out
+    return (log_alpha, edge_log_alpha.masked_fill(mask == 0, 0.0), *outputs)
+
+
+def check_analytic_backward(fn, inputs):
+    inputs = tuple(x.detach().requires_grad_() for x in inputs)
+    outputs = fn(*inputs)
+    assert all(uses_sweep_function(output) for output in outputs)
+    assert torch.autograd.gradcheck(fn, inputs)
+
+    weights = [torch.randn_like(output) for output in outputs]
+    grads = torch.autograd.grad(sum((output * weight).sum() for output, weight in zip(outputs, weights)), inputs)
+    for grad, reference in zip(grads, loop_gradients(fn, inputs, weights)):
+        assert torch.allclose(grad, reference)
+
+
+def test_forward_algorithm_backward():
+    transition_matrix, _, mask, lengths = random_lattices()
+    check_analytic_backward(lambda ts: inside(mask, *dp.forward_algorithm(ts, mask, lengths, return_nodes=True)), (transition_matrix,))
+
+
+def test_entropy_backward():
+    transition_matrix, _, mask, lengths = random_lattices()
+    check_analytic_backward(lambda ts: dp.entropy(ts, mask, lengths), (transition_matrix,))
+
+
+def test_expectation_backward():
+    transition_matrix, value_matrix, mask, lengths = random_lattices()
+    check_analytic_backward(lambda ts, vs: dp.expectation(ts, vs[..., 0], mask, lengths), (transition_matrix, value_matrix))
+
+
+def test_forward_statistics_backward():
+    transition_matrix, value_matrix, mask, lengths = random_lattices()
+    check_analytic_backward(lambda ts, vs: inside(mask, *dp.forward_statistics(ts, mask, lengths, value_matrix=vs)), (transition_matrix, value_matrix))
+    # no padding to skip
+    transition_matrix, value_matrix, mask, lengths = random_lattices(lengths=(7, 7, 7, 7), seed=1)
+    check_analytic_backward(lambda ts, vs: inside(mask, *dp.forward_statistics(ts, mask, lengths, value_matrix=vs[..., 0])), (transition_matrix, value_matrix))
+
+
+def test_product_semiring():
+    transition_matrix, value_matrix, mask, lengths = random_lattices()
+    max_log_alpha, back_pointers, log_alpha = dp.viterbi_forward_algorithm(transition_matrix, mask, lengths)
+    reference_max_log_alpha, _, reference_back_pointers = dp.viterbi_algorithm(transition_matrix, mask, lengths)
+    assert torch.equal(max_log_alpha, reference_max_log_alpha)
+    assert all(torch.equal(bp, reference) for bp, reference in zip(back_pointers, reference_back_pointers))
+    assert torch.equal(log_alpha, dp.forward_algorithm(transition_matrix, mask, lengths)[0])
+
+    # the product of semirings with analytic backwards is differentiated by one reverse sweep
+    def product(ts, vs):
+        semiring = ProductSemiring(LogSemiring(), LogExpectationSemiring(vs, entropy=True))
+        ((log_alpha,), (expectation_log_alpha, r)), _, _, _ = dp.semiring_algorithm(ts, mask, lengths, semiring)
+        return log_alpha, expectation_log_alpha, r
+    check_analytic_backward(product, (transition_matrix, value_matrix))
+
+
+def test_pairwise_algorithm():
+    transition_matrix, _, mask, lengths = random_lattices()
+    node_log_inside = dp.pairwise_algorithm(transition_matrix, mask, lengths)
+    _, _, node_log_alpha = dp.forward_algorithm(transition_matrix, mask, lengths, return_nodes=True)
+    _, _, node_log_beta = dp.backward_algorithm(transition_matrix, mask, lengths, return_nodes=True)
+    nodes = torch.arange(transition_matrix.size(-1) + 1)[None, :] <= lengths[:, None]
+    assert torch.allclose(node_log_inside[:, 0][nodes], node_log_alpha[nodes])
+    assert torch.allclose(node_log_inside[:, :, -1], node_log_beta)
+
+    # the pairs of nodes without paths between them are left out like the edges outside the lattice
+    reachable = node_log_inside > -INF / 2
+    check_analytic_backward(lambda ts: (dp.pairwise_algorithm(ts, mask, lengths).masked_fill(~reachable, 0.0),), (transition_matrix,))
+
+
+def test_scan_log_alphas():
+    transition_matrix, _, mask, lengths = random_lattices(B=5, L=11, lengths=(9, 11, 0, 4, 1))
+    transition_matrix.requires_grad_()
+    loop = dp.forward_algorithm(transition_matrix, mask, lengths, return_nodes=True)
+    scan_dp = LatticeDPMixin()
+    scan_dp.scan_min_length = 8
+    scan = scan_dp.forward_algorithm(transition_matrix, mask, lengths, return_nodes=True)
+
+    # the nodes past the end of a lattice aren't defined
+    nodes = torch.arange(transition_matrix.size(-1) + 1)[None, :] <= lengths[:, None]
+    assert torch.allclose(scan[0], loop[0])
+    assert torch.allclose(scan[1][mask == 1], loop[1][mask == 1])
+    assert torch.allclose(scan[2][nodes], loop[2][nodes])
+    grad, = torch.autograd.grad(scan[0].sum(), transition_matrix)
+    reference, = torch.autograd.grad(loop[0].sum(), transition_matrix)
+    assert torch.allclose(grad, reference)
+
+
+def lattice_paths(transition_matrix, mask, length):
+    """
+    All paths of a lattice [M, L] as (edges, probability), edges are the (row, column) slots on the path.
+    """
+    M = mask.size(0)
+    paths = []
+    for unit_lengths in itertools.chain.from_iterable(itertools.product(range(1, M + 1), repeat=n) for n in range(1, length + 1)):
+        if sum(unit_lengths) != length:
+            continue
+        ends = list(itertools.accumulate(unit_lengths))
+        edges = tuple((l - 1, end - 1) for l, end in zip(unit_lengths, ends))
+        if all(mask[edge] == 1 for edge in edges):
+            paths.append((edges, math.exp(sum(transition_matrix[edge].item() for edge in edges))))
+    Z = sum(weight for _, weight in paths)
+    return [(edges, weight / Z) for edges, weight in paths]
+
+
+def test_sample_paths():
+    transition_matrix, _, mask, lengths = random_lattices(B=2, M=3, L=5, lengths=(5, 4))
+    K = 20000
+    paths = dp.sample_paths(transition_matrix, mask, lengths, num_samples=K, generator=torch.Generator().manual_seed(0))
+    assert paths.size() == (2, K, 3, 5)
+    for b in range(2):
+        samples = [tuple(map(tuple, path.nonzero().tolist())) for path in paths[b]]
+        # rows of a column are unit lengths - 1, nonzero gives the slots in row major order
+        samples = [tuple(sorted(edges, key=lambda edge: edge[1])) for edges in samples]
+        exact = lattice_paths(transition_matrix[b], mask[b], lengths[b].item())
+        assert set(samples) <= {edges for edges, _ in exact}
+        for edges, probability in exact:
+            # about 4 standard deviations
+            assert abs(samples.count(edges) / K - probability) < 4 * math.sqrt(probability * (1 - probability) / K) + 1e-3
+
+
+def test_sampled_layout():
+    transition_matrix, _, mask, lengths = random_lattices(B=2, M=3, L=5, lengths=(5, 4))
+    fwd_ids = torch.arange(2 * 3 * 5).reshape(2, 3, 5)
+    K = 50
+    paths = dp.sample_paths(transition_matrix, mask, lengths, num_samples=K, generator=torch.Generator().manual_seed(0))
+    ids, counts = dp.sample_tokenizations(fwd_ids, transition_matrix, mask, lengths, num_samples=K, generator=torch.Generator().manual_seed(0))
+
+    # in the order of the model inputs the edges of a path are its units from left to right
+    start, end = LatticeAttentionMixin.edges(5, 3)
+    edges = LatticeAttentionMixin.linearize(paths) # [B, K, E]
+    linear_ids = LatticeAttentionMixin.linearize(fwd_ids)
+    for b in range(2):
+        for k in range(K):
+            on_path = edges[b, k].to(torch.bool)
+            assert torch.equal(linear_ids[b][on_path], ids[b, k, :counts[b, k]])
+            assert torch.equal(start[on_path][1:], end[on_path][:-1]) and end[on_path][-1] == lengths[b]
+
+    # with many samples the empirical marginals of `sampled_conditionals` are the marginals
+    paths = dp.sample_paths(transition_matrix, mask, lengths, num_samples=20000, generator=torch.Generator().manual_seed(1))
+    _, m = LatticeAttentionMixin().sampled_conditionals(paths, mask)
+    ts = transition_matrix.detach().requires_grad_()
+    log_alpha, _ = dp.forward_algorithm(ts, mask, lengths)
+    marginals, = torch.autograd.grad(log_alpha.sum(), ts)
+    assert torch.allclose(m.exp(), LatticeAttentionMixin.linearize(marginals), atol=0.02)
+
+
+WORD_BLOCKS = [[["[SP1]", "abcd", "a"], ["abcd", "bcd"], ["dd", "a", "ca"]],
+               [["abcd", "abcd"], ["b"], []],
+               [["ca", "abc", "dd"], [], []]]
+
+
+def word_tokenizer(M=3):
+    units = ["[PAD]", "[UNK]", "[SP1]", "[SP2]", "[SP3]", "[SP4]", "[BOS]", "[EOS]"] + list("abcd") + ["ab", "bc", "abc", "cd", "bcd", "dd", "ca"]
+    generator = torch.Generator().manual_seed(0)
+    weights = dict(zip(units, (-3 * torch.rand(len(units), generator=generator)).tolist()))
+    tokenizer = Tokenizer(vocab=Integerizer(units), weights=weights, log_space_parametrization=True, max_unit_length=M, specials=["[SP1]", "[SP2]", "[SP3]"])
+    tokenizer.weights.weight.data = tokenizer.weights.weight.data.double()
+    return tokenizer
+
+
+def encode_blocks(tokenizer, blocks, M=3, L=8):
+    encoded = [tokenizer.encode_packed_batch(packed_chunks, M, L, compact=True) for packed_chunks in blocks]
+    fwd_ids, fwd_ms, lengths = [torch.stack([e[i] for e in encoded]) for i in range(3)]
+    return fwd_ids, fwd_ms.double(), lengths
+
+
+def word_lattices(M=3, L=8):
+    """
+    A tokenizer with random weights and a batch [3, 3, M, L] of packed blocks with repeated words, single character
+    words, short blocks and padding blocks (of length 0).
+    """
+    tokenizer = word_tokenizer(M)
+    return (tokenizer, *encode_blocks(tokenizer, WORD_BLOCKS, M, L))
+
+
+def tokenizer_outputs(tokenizer, fwd_ids, fwd_ms, lengths, **kwargs):
+    """
+    The entropy, attention bias, marginals and conditionals of `Tokenizer.forward` and the gradient of the weights.
+    """
+    tokenizer.weights.weight.grad = None
+    ent, a, m, c = tokenizer(fwd_ids, fwd_ms, lengths, **kwargs)
+    valid = a > -INF / 2
+    weights = torch.randn(a.size(), dtype=a.dtype, generator=torch.Generator().manual_seed(0))
+    (ent.sum() + (a.masked_fill(~valid, 0.0).exp() * weights).sum()).backward()
+    return ent.detach(), a.detach().clamp(min=-INF), m.detach(), c.detach(), tokenizer.weights.weight.grad.clone()
+
+
+def check_word_statistics(**kwargs):
+    tokenizer, fwd_ids, fwd_ms, lengths = word_lattices()
+    try:
+        tokenizer.factorize_words = False
+        reference = tokenizer_outputs(tokenizer, fwd_ids, fwd_ms, lengths, **kwargs)
+    finally:
+        tokenizer.factorize_words = True
+    ent, a, m, c, grad = tokenizer_outputs(tokenizer, fwd_ids, fwd_ms, lengths, **kwargs)
+
+    # marginals and conditionals are only defined for the edges of the lattices
+    edges = LatticeAttentionMixin.linearize(fwd_ms).to(torch.bool) # [B, N, E]
+    pairs = edges[..., :, None] & edges[..., None, :]
+    assert torch.allclose(ent, reference[0])
+    assert torch.allclose(a, reference[1])
+    assert torch.allclose(m[edges], reference[2][edges])
+    assert torch.allclose(c[pairs], reference[3][pairs])
+    assert torch.equal(c <= -INF / 2, reference[3] <= -INF / 2)
+    assert torch.allclose(grad, reference[4])
+
+
+def test_word_statistics():
+    check_word_statistics()
+    check_word_statistics(marginal_temperature=0.7)
+
+
+def test_word_statistics_lm():
+    tokenizer, _, fwd_ms, _ = word_lattices()
+    B, N, M, L = fwd_ms.size()
+    E = LatticeAttentionMixin.linearize(fwd_ms).size(-1)
+    token_mask = (torch.rand(B, N * (E + L), generator=torch.Generator().manual_seed(1)) > 0.15).double()
+    lm_mask = token_mask[:, :, None] * token_mask[:, None, :] * tokenizer.causal_mask(N, L, M)[None].double()
+    check_word_statistics(lm=True, lm_mask=lm_mask)
+
+    # the attention bias only depends on the prefix marginals relative to the log betas, which are checked on their own
+    tokenizer, fwd_ids, fwd_ms, lengths = word_lattices()
+    fwd_ids, fwd_ms, lengths = fwd_ids.reshape(-1, M, L), fwd_ms.reshape(-1, M, L), lengths.reshape(-1)
+    with torch.no_grad():
+        _, _, _, log_betas, _ = tokenizer.word_statistics(fwd_ids, fwd_ms, lengths, lm=True)
+        reference = tokenizer.pairwise_algorithm(tokenizer.get_weights(fwd_ids), fwd_ms, lengths)[:, 0, 1:]
+    nodes = torch.arange(L)[None, :] < lengths[:, None]
+    assert torch.allclose(log_betas[nodes], reference[nodes])
+
+
+def no_grad_outputs(tokenizer, fwd_ids, fwd_ms, lengths, cache=True, **kwargs):
+    # the statistics cache is only used by the calls that don't need the gradient of the weights
+    statistics_cache = tokenizer.statistics_cache
+    try:
+        if not cache:
+            tokenizer.statistics_cache = None
+        with torch.no_grad():
+            ent, a, m, c = tokenizer(fwd_ids, fwd_ms, lengths, **kwargs)
+    finally:
+        tokenizer.statistics_cache = statistics_cache
+    a = a.dense() if isinstance(a, BlockAttentionBias) else a
+    return ent, a.clamp(min=-INF), m, c.clamp(min=-INF)
+
+
+def check_cached_outputs(tokenizer, fwd_ids, fwd_ms, lengths, **kwargs):
+    cached = no_grad_outputs(tokenizer, fwd_ids, fwd_ms, lengths, **kwargs)
+    for output, reference in zip(cached, no_grad_outputs(tokenizer, fwd_ids, fwd_ms, lengths, cache=False, **kwargs)):
+        assert torch.allclose(output, reference)
+    return cached
+
+
+def test_statistics_cache_wider_batches():
+    tokenizer, fwd_ids, fwd_ms, lengths = word_lattices()
+    B, N, M, L = fwd_ms.size()
+    computed = [] # number of segments of every dp with the cache enabled
+    segment_statistics = tokenizer.segment_statistics
+    def counted_segment_statistics(ids, *args, **kwargs):
+        if tokenizer.statistics_cache is not None:
+            computed.append(ids.size(0))
+        return segment_statistics(ids, *args, **kwargs)
+    tokenizer.segment_statistics = counted_segment_statistics
+    tokenizer.enable_statistics_cache()
+
+    # segments of at most 2 characters, cached on their own [2, 2] lattices (and [1, 1] for single characters)
+    check_cached_outputs(tokenizer, *encode_blocks(tokenizer, [[["ab", "ca"], ["dd", "b"]], [["a", "bc"], []]], M, 4))
+    assert computed == [6]
+
+    # restored into the [3, 4] segment lattices of the wider batch, only the longer words miss
+    computed.clear()
+    check_cached_outputs(tokenizer, fwd_ids, fwd_ms, lengths)
+    assert computed == [4] # [SP1], abcd, bcd, abc
+    E = LatticeAttentionMixin.linearize(fwd_ms).size(-1)
+    lm_mask = tokenizer.causal_mask(N, L, M)[None].double().expand(B, -1, -1)
+    for kwargs in [dict(marginal_temperature=0.7), dict(lm=True, lm_mask=lm_mask), dict(lm=True, factorized=True, token_mask=torch.ones(B, N * (E + L), dtype=torch.double))]:
+        check_cached_outputs(tokenizer, fwd_ids, fwd_ms, lengths, **kwargs)
+
+    # calls that need the gradient of the weights don't use the cache
+    computed.clear()
+    tokenizer(fwd_ids, fwd_ms, lengths)
+    assert computed == [8]
+
+
+def test_statistics_cache_invalidation():
+    tokenizer, fwd_ids, fwd_ms, lengths = word_lattices()
+    tokenizer.enable_statistics_cache()
+    before = check_cached_outputs(tokenizer, fwd_ids, fwd_ms, lengths)
+    entries = dict(tokenizer.statistics_cache.entries)
+
+    # no update
+    tokenizer.bump_weights_version()
+    assert tokenizer.statistics_cache.entries.keys() == entries.keys()
+
+    # only the words with the unit that changed are dropped
+    unit = tokenizer.vocab.index("d")
+    tokenizer.weights.weight.data[unit] -= 0.5
+    tokenizer.bump_weights_version()
+    kept = [key for key, (units, _) in entries.items() if unit not in units]
+    assert 0 < len(kept) < len(entries)
+    assert list(tokenizer.statistics_cache.entries) == kept
+    after = check_cached_outputs(tokenizer, fwd_ids, fwd_ms, lengths)
+    assert not torch.allclose(after[0], before[0])
+
+    # compacting the vocabulary renumbers the units, the whole cache is dropped
+    tokenizer.compact(torch.tensor([i for i in range(len(tokenizer.vocab)) if tokenizer.vocab[i] not in ("cd", "bcd")]))
+    assert len(tokenizer.statistics_cache.entries) == 0 and tokenizer.statistics_cache.nbytes == 0
+    check_cached_outputs(tokenizer, *encode_blocks(tokenizer, WORD_BLOCKS))
+
+
+if __name__ == "__main__":
+    test_forward_algorithm_backward()
+    test_entropy_backward()
+    test_expectation_backward()
+    test_forward_statistics_backward()
+    test_product_semiring()
+    test_pairwise_algorithm()
+    test_scan_log_alphas()
+    test_sample_paths()
+    test_sampled_layout()
+    test_word_statistics()
+    test_word_statistics_lm()
+    test_statistics_cache_wider_batches()
+    test_statistics_cache_invalidation()
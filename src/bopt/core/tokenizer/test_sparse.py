@@ -0,0 +1,59 @@
+import torch
+
+from bopt.core.integerize import Integerizer
+from bopt.core.tokenizer.tokenizer import Tokenizer
+
+
+def random_tokenizer_and_lattices(B=5, M=4, L=9, lengths=(9, 0, 4, 9, 1), seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    units = ["[PAD]", "[UNK]", "[SP1]"] + [f"u{i}" for i in range(20)]
+    weights = {unit: -3 * torch.rand(1, generator=generator).item() for unit in units}
+    tokenizer = Tokenizer(vocab=Integerizer(units), weights=weights, log_space_parametrization=True, max_unit_length=M, specials=["[SP1]"])
+    tokenizer.double()
+
+    # most slots of a large max unit length are not in the vocabulary, characters always are
+    lengths = torch.tensor(lengths)
+    fwd_ms = (torch.rand(B, M, L, generator=generator) > 0.6).double()
+    fwd_ms[:, 0] = 1
+    fwd_ms = fwd_ms * torch.triu(torch.ones(M, L, dtype=torch.double)) * (torch.arange(L)[None, None] < lengths[:, None, None])
+    fwd_ids = torch.randint(3, len(units), (B, M, L), generator=generator).masked_fill(fwd_ms == 0, tokenizer.pad_index)
+    return tokenizer, fwd_ids, fwd_ms, lengths
+
+
+def test_sparse_round_trip():
+    tokenizer, fwd_ids, fwd_ms, lengths = random_tokenizer_and_lattices()
+    lattice = tokenizer.to_sparse_lattice(fwd_ids, fwd_ms, lengths)
+    assert lattice.ids.size(0) == int(fwd_ms.sum())
+    assert torch.all(lattice.end[1:] >= lattice.end[:-1]) # sorted by end node
+    ids, ms, sparse_lengths = tokenizer.to_dense_lattice(lattice)
+    assert torch.equal(ids, fwd_ids)
+    assert torch.equal(ms, fwd_ms.float())
+    assert torch.equal(sparse_lengths, lengths)
+
+
+def test_sparse_statistics():
+    tokenizer, fwd_ids, fwd_ms, lengths = random_tokenizer_and_lattices()
+    B, M, L = fwd_ids.size()
+    lattice = tokenizer.to_sparse_lattice(fwd_ids, fwd_ms, lengths)
+
+    fwd_ts = tokenizer.get_weights(fwd_ids)
+    log_alpha, edge_log_alpha, node_log_alpha, ent, _ = tokenizer.forward_statistics(fwd_ts, fwd_ms, lengths)
+
+    transitions = tokenizer.get_weights(lattice.ids)
+    sparse_log_alpha, sparse_edge_log_alpha, sparse_node_log_alpha = tokenizer.sparse_forward_algorithm(lattice, transitions)
+    nodes = torch.arange(L + 1)[None, :] <= lengths[:, None]
+    assert torch.allclose(sparse_log_alpha, log_alpha)
+    assert torch.allclose(tokenizer.to_dense_values(lattice, sparse_edge_log_alpha, 0.0), edge_log_alpha.masked_fill(fwd_ms == 0, 0.0))
+    assert torch.allclose(sparse_node_log_alpha[nodes], node_log_alpha[nodes])
+
+    assert torch.allclose(tokenizer.sparse_entropy(lattice, transitions), ent)
+
+    # the marginals are the gradient of log Z w.r.t. the edge potentials
+    marginals = tokenizer.sparse_marginals(lattice, transitions.detach())
+    _, dense_marginals = torch.autograd.functional.vjp(lambda ts: tokenizer.forward_statistics(ts, fwd_ms, lengths)[0], fwd_ts.detach(), torch.ones(B, dtype=torch.double))
+    assert torch.allclose(tokenizer.to_dense_values(lattice, marginals, 0.0), dense_marginals.masked_fill(fwd_ms == 0, 0.0))
+
+
+if __name__ == "__main__":
+    test_sparse_round_trip()
+    test_sparse_statistics()
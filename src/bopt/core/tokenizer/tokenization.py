@@ -4,11 +4,13 @@ from typing import List, Tuple, Callable, TypeVar, Set
 import torch
 
 from bopt.core.integerize import Integerizer
+from bopt.core.tokenizer.structure import structures
 
 T = TypeVar("T", str, List[str])
 PackedChunk = TypeVar("PackedChunk", bound=List[str])
 
 class TokenizationMixin:
+    structures = structures
 
     def __init__(self, *args,
                  vocab: Integerizer = None,
@@ -19,8 +21,6 @@ class TokenizationMixin:
                  specials: List[str] = tuple(),
                  **kwargs):
         super().__init__(*args, **kwargs)
-        self.parallel_backward_mask_cache = dict()
-        self.vocab_list = vocab
         self.csp = continuing_subword_prefix
         self.pad_token = pad_token
         self.bos_token = "[BOS]"
@@ -28,18 +28,25 @@ class TokenizationMixin:
         self.node_token = node_token
 
         # represent vocabulary
-        self.vocab = vocab
+        self.specials = list(specials)
         self.specials_set = set() if not specials else set(specials)
+        self.set_vocab(vocab)
+        self.max_unit_length = min(max_unit_length, max(self.len_c(u) for u in vocab)) #removed so that everything is consistently set by the commandline argument max_unit_length and there's no overrides
+
+    def set_vocab(self, vocab: Integerizer) -> None:
+        """
+        Switches to `vocab` (e.g. a compacted vocabulary) and redoes the bookkeeping of the special indices.
+        """
+        self.vocab_list = self.vocab = vocab
 
         # some bookkeeping
-        self.pad_index = vocab.index(pad_token)
-        self.node_index = vocab.index(node_token)
+        self.pad_index = vocab.index(self.pad_token)
+        self.node_index = vocab.index(self.node_token)
         self.bos_index = vocab.index(self.bos_token)
         self.eos_index = vocab.index(self.eos_token)
-        self.specials_indices = [vocab.index(special) for special in specials]
+        self.specials_indices = [vocab.index(special) for special in self.specials]
         self.singleton_indices = [vocab.index(u) for u in vocab if self.len_c(u) == 1]
         self.constant_indices = sorted(list(set([self.pad_index] + self.specials_indices + self.singleton_indices)))
-        self.max_unit_length = min(max_unit_length, max(self.len_c(u) for u in vocab)) #removed so that everything is consistently set by the commandline argument max_unit_length and there's no overrides
 
     @classmethod
     def len_chunk(cls, chunk: str, specials_set: Set[str]):
@@ -141,12 +148,7 @@ class TokenizationMixin:
         return ids, mask, pos_ids, lm_ids, lm_mask, lm_pos_ids
 
     def parallel_backward_mask(self, L: int, M: int, device: str = "cpu") -> Tuple[torch.FloatTensor, torch.FloatTensor]:
-        if (L, M, device) in self.parallel_backward_mask_cache:
-            return self.parallel_backward_mask_cache[(L, M, device)]
-        mmask = torch.zeros(L, L, L, dtype=torch.float).to(device)
-        emask = torch.zeros(L, L, L, dtype=torch.float).to(device)
-        triu_ones = torch.triu(torch.ones(L, L, dtype=torch.float).to(device), diagonal=0)
-        for j in range(L):
+        def build():
             # the i=2 backward pass should have a transition mask looking like this
             #   valid edges                   mmask            emask
             # [ e t  a   h   ]             [ 1 1 1 1 ]       [ 0 0 1 1 ]
@@ -156,15 +158,15 @@ class TokenizationMixin:
             #
             # mmask has [nolonger!] the diagonal and a single path leading up to the i=2th node (this represents the actual lattice)
             # emask only cuts out the edges themselves that's actually in the sub-lattice (this is for picking out weigths)
-            i = L - 1 - j  # reverse the order so we do backward of the smallest lattice first instead of full lattice first
-            # mmask[j, :L - i, i:L] = triu_ones[:L - i, :L - i]
-            emask[j, :L - i, i:L] = triu_ones[:L - i, :L - i]
-            mmask[j, 0, :i] = 1
-        mmask, emask = mmask[:,:M,:], emask[:,:M,:]
-        self.parallel_backward_mask_cache[(L, M, device)] = (mmask, emask)
-        return mmask, emask
-
-    def encode_batch(self, chunks: List[str], M: int, L: int = None, device: str = "cpu", compact=False, verbatim=False) -> Tuple[torch.LongTensor,
+            # the j-th pass is for i = L - 1 - j, i.e. the backward of the smallest lattice comes first instead of the full lattice
+            i = (L - 1 - torch.arange(L))[:, None, None] # [L (j), 1, 1]
+            row, column = torch.arange(L)[None, :, None], torch.arange(L)[None, None, :]
+            emask = ((column >= i) & (column - i >= row)).to(torch.float) # row < L - i follows from column < L
+            mmask = ((row == 0) & (column < i)).to(torch.float)
+            return mmask[:, :M, :], emask[:, :M, :]
+        return self.structures.get("parallel_backward_mask", (L, M), build, device=device)
+
+    def encode_batch(self, chunks: List[str], M: int, L: int = None, device: str = "cpu", compact=True, verbatim=False) -> Tuple[torch.LongTensor,
                                                                             torch.FloatTensor,
                                                                             torch.LongTensor,
                                                                             torch.LongTensor,
@@ -176,7 +178,7 @@ class TokenizationMixin:
             L = max(self.len_c(chunk) for chunk in chunks)  # max length of chunk
         return self.encode_batch_generic(chunks, L, M, self.encode_transitions, self.len_c, device=device, compact=compact, verbatim=verbatim)
 
-    def encode_packed_batch(self, packed_chunks: List[List[str]], M: int, L: int = None, device: str = "cpu", compact=False, verbatim=False) -> Tuple[torch.LongTensor,
+    def encode_packed_batch(self, packed_chunks: List[List[str]], M: int, L: int = None, device: str = "cpu", compact=True, verbatim=False) -> Tuple[torch.LongTensor,
                                                                             torch.FloatTensor,
                                                                             torch.LongTensor,
                                                                             torch.LongTensor,
@@ -194,7 +196,7 @@ class TokenizationMixin:
                      encoder: Callable[[List[T], int, int], Tuple[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]],
                      length_fn: Callable[[List[T]], int],
                      device: str = "cpu",
-                     compact=False,
+                     compact=True,
                      verbatim=False) -> Tuple[torch.LongTensor,
                                                     torch.FloatTensor,
                                                     torch.LongTensor,
@@ -350,4 +352,12 @@ class TokenizationMixin:
         return unit
 
     def is_padding(self, id: int):
-        return id == self.pad_index or id == self.bos_index or id == self.eos_index or id == self.node_index
\ No newline at end of file
+        return id == self.pad_index or id == self.bos_index or id == self.eos_index or id == self.node_index
+
+    def decode_ids(self, ids: torch.LongTensor, counts: torch.LongTensor, remove_csp=False, remove_padding=False) -> List[List[str]]:
+        """
+        Converts left aligned id sequences [B, T] with counts [B] (e.g. from `viterbi_backtrace`) into units, with a
+        single transfer to the host.
+        """
+        return [[self.id2str(id, remove_csp=remove_csp) for id in row[:count] if not remove_padding or not self.is_padding(id)]
+                for row, count in zip(ids.tolist(), counts.tolist())]
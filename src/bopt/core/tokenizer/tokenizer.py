@@ -1,18 +1,22 @@
 import math
-from typing import Dict, Tuple, List
+from typing import Dict, Tuple, List, Union
 
 import torch
 import code
 from torch import nn
 
+from bopt.core.attention_bias import BlockAttentionBias
+from bopt.core.integerize import Integerizer
 from bopt.core.tokenizer.attention import LatticeAttentionMixin
 from bopt.core.tokenizer.dynamic import LatticeDPMixin
+from bopt.core.tokenizer.sparse import SparseLatticeMixin
 from bopt.core.tokenizer.tokenization import TokenizationMixin
+from bopt.core.tokenizer.words import WordLatticeMixin
 from bopt.core.utils import increasing_roll_left, increasing_roll_right
 
 INF = 1e9
 
-class Tokenizer(TokenizationMixin, LatticeDPMixin, LatticeAttentionMixin, nn.Module):
+class Tokenizer(TokenizationMixin, LatticeDPMixin, SparseLatticeMixin, LatticeAttentionMixin, WordLatticeMixin, nn.Module):
 
     def __init__(self, *args,
                  weights: Dict[str, float] = None,
@@ -57,6 +61,36 @@ class Tokenizer(TokenizationMixin, LatticeDPMixin, LatticeAttentionMixin, nn.Mod
     def reset_singleton_weight(self) -> None:
         self.weights.weight.data[self.singleton_indices] = 1.0 if not self.lsp else 0.0
 
+    def live_units(self, threshold: float) -> torch.LongTensor:
+        """
+        Ids of the units with a potential (the largest among the mixture components) of at least `threshold`, in
+        increasing order. The padding, special, singleton, bos / eos and node units are always kept so that every string
+        still has a segmentation.
+        """
+        ids = torch.arange(len(self.vocab), device=self.weights.weight.device)
+        log_potentials = self.get_weights(ids).detach()
+        if self.mixture_count > 1:
+            log_potentials = log_potentials.max(-1)[0]
+        live = log_potentials >= math.log(threshold)
+        live[self.constant_indices + [self.bos_index, self.eos_index, self.node_index]] = True
+        if self.vocab.unk_token in self.vocab:
+            live[self.vocab.index(self.vocab.unk_token)] = True
+        return ids[live]
+
+    def compact(self, units: torch.LongTensor) -> None:
+        """
+        Keeps only `units` (increasing ids, e.g. `live_units`) in the vocabulary, the other units are dropped and the
+        rest are renumbered in order. The weights are sliced in place so optimizers keep the same parameter.
+        """
+        self.set_vocab(Integerizer([self.vocab[i] for i in units.tolist()], unk_token=self.vocab.unk_token))
+        self.weights_dict = {unit: self.weights_dict[unit] for unit in self.vocab} if self.weights_dict is not None else None
+        self.weights.weight.data = self.weights.weight.data[units.to(self.weights.weight.device)]
+        if self.weights.weight.grad is not None:
+            self.weights.weight.grad = self.weights.weight.grad[units.to(self.weights.weight.device)]
+        self.weights.num_embeddings = len(self.vocab)
+        self.weights.padding_idx = self.pad_index
+        self.bump_weights_version()
+
     def get_singleton_weight(self) -> torch.FloatTensor:
         return self.weights.weight.data[self.singleton_indices]
 
@@ -76,98 +110,70 @@ class Tokenizer(TokenizationMixin, LatticeDPMixin, LatticeAttentionMixin, nn.Mod
     def forward(self, fwd_ids: torch.LongTensor,
                 fwd_ms: torch.FloatTensor,
                 lengths: torch.LongTensor,
-                bwd_ids: torch.LongTensor,
-                bwd_ms: torch.FloatTensor,
-                bwd_lengths:  torch.LongTensor,
-                mmask: torch.FloatTensor,
-                emask: torch.FloatTensor,
                 tmask: torch.FloatTensor=None,
                 lm: bool=False,
                 lm_mask: torch.FloatTensor=None,
                 fwd_ts: torch.FloatTensor=None,
-                bwd_ts: torch.FloatTensor=None,
-                marginal_temperature: float=None) -> Tuple[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
+                marginal_temperature: float=None,
+                factorized: bool=False,
+                token_mask: torch.FloatTensor=None) -> Tuple[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
         """
 
         fwd_ids: num_batch, num_block, max_unit_length, max_block_length
         fwd_ms: num_batch, num_block, max_unit_length, max_block_length
         lengths: num_batch, num_block
-        bwd_ids: num_batch, num_block, max_block_length, max_unit_length, max_block_length
-        bwd_ms: num_batch, num_block, max_block_length, max_unit_length, max_block_length
-        bwd_lengths: num_batch, num_block
-        mmask: num_batch, num_block, max_block_length, max_unit_length, max_block_length
-        emask: num_batch, num_block, max_block_length, max_unit_length, max_block_length
+        factorized: return the attention bias as a `BlockAttentionBias` instead of a dense tensor (see
+                    `tile_factorized`), with lm the causal mask is implied and `token_mask` [num_batch, num_block * (E + L)]
+                    replaces lm_mask
         """
+        if factorized and (tmask is not None or self.mixture_count > 1):
+            raise ValueError("factorized attention bias does not support task masks or mixtures of lattices")
         # reshape inputs to have only one batch dimension
         num_batch, num_block = fwd_ids.size()[:2]
         fwd_ids = fwd_ids.reshape(-1, *fwd_ids.size()[2:])
         fwd_ms = fwd_ms.reshape(-1, *fwd_ms.size()[2:])
         lengths = lengths.reshape(-1, *lengths.size()[2:])
-        bwd_ids = bwd_ids.reshape(-1, *bwd_ids.size()[2:])
-        bwd_ms = bwd_ms.reshape(-1, *bwd_ms.size()[2:])
-        bwd_lengths = bwd_lengths.reshape(-1, *bwd_lengths.size()[2:])
-        mmask = mmask[0] # mmask and emask should be the same for all examples, so just take the first one (it already has an extra dimension)
-        emask = emask[0] # mmask and emask should be the same for all examples, so just take the first one (it already has an extra dimension)
         device = self.weights.weight.data.device
 
+        # with the weights of the units the dp of a word only depends on its ids, so it runs once per distinct word
+        if self.factorize_words and fwd_ts is None and self.mixture_count == 1 and lengths.max() > 0:
+            M, L = fwd_ms.size()[-2:]
+            ent, c, em_, log_betas, m = self.word_statistics(fwd_ids, fwd_ms, lengths, lm=lm, marginal_temperature=marginal_temperature)
+            return self.tile_statistics(ent, c, em_, log_betas, m, num_batch, num_block, M, L, fwd_ms, tmask=tmask, lm=lm, lm_mask=lm_mask, factorized=factorized, token_mask=token_mask)
+
         if fwd_ts is None:
             fwd_ts = self.get_weights(fwd_ids)
         else:
             fwd_ts = fwd_ts.reshape(-1, *fwd_ts.size()[2:])
-        if bwd_ts is None:
-            bwd_ts = self.get_weights(bwd_ids)
-        else:
-            bwd_ts = bwd_ts.reshape(-1, *bwd_ts.size()[2:])
 
         # handle mixture of lattices
         if self.mixture_count > 1:
             fwd_ts = fwd_ts.permute(fwd_ts.dim()-1, *range(fwd_ts.dim()-1)).reshape(-1, *fwd_ts.size()[1:fwd_ts.dim()-1]) # [B, M, L, K] -> [K, B, M, L] -> [KB, M, L]
-            bwd_ts = bwd_ts.permute(bwd_ts.dim()-1, *range(bwd_ts.dim()-1)).reshape(-1, *bwd_ts.size()[1:bwd_ts.dim()-1])  # [B, M, L, K] -> [K, B, M, L] -> [KB, M, L]
             fwd_ms = fwd_ms[None, ...].expand(self.mixture_count, *fwd_ms.size()).reshape(-1, *fwd_ms.size()[1:])
             lengths = lengths[None, ...].expand(self.mixture_count, *lengths.size()).reshape(-1, *lengths.size()[1:])
-            bwd_ms = bwd_ms[None, ...].expand(self.mixture_count, *bwd_ms.size()).reshape(-1, *bwd_ms.size()[1:])
-            bwd_lengths = bwd_lengths[None, ...].expand(self.mixture_count, *bwd_lengths.size()).reshape(-1, *bwd_lengths.size()[1:])
             if tmask is not None:
                 tmask = tmask[None, ...].expand(self.mixture_count, *tmask.size()).reshape(-1, *tmask.size()[1:])
             if lm_mask is not None:
                 lm_mask = lm_mask[None, ...].expand(self.mixture_count, *lm_mask.size()).reshape(-1, *lm_mask.size()[1:])
-            # mmask and emask are broadcast-ready so no need to expand they'll just broadcast themselves
 
         B, M, L = fwd_ts.size() # this is the effective B now, which is really self.mixture_count * num_batch * num_block
 
-        # 1 forward pass
-        log_alpha, edge_log_alpha, node_log_alpha = self.forward_algorithm(fwd_ts, fwd_ms, lengths, return_nodes=True)
-        ent, edge_ent = self.entropy(fwd_ts, fwd_ms, lengths)
-
-        # max_length backward passes, one from each position
-        log_betas, edge_log_betas, node_log_betas_rev = self.forward_algorithm(bwd_ts, bwd_ms, bwd_lengths, return_nodes=True)
-        log_betas = log_betas.reshape(B, L)
-        edge_log_betas = edge_log_betas.reshape(B, L, M, L)
+        # 1 forward pass, computes the entropy in the same sweep
+        log_alpha, edge_log_alpha, node_log_alpha, ent, _ = self.forward_statistics(fwd_ts, fwd_ms, lengths)
 
-        # mask out the character suffixes in backward that are just auxiliary and don't really exist
-        edge_log_betas = edge_log_betas * emask + torch.ones_like(edge_log_betas).fill_(-INF) * (1-emask)
+        # 1 sweep for the inside weights between all pairs of nodes, which gives the betas of every prefix lattice
+        node_log_inside = self.pairwise_algorithm(fwd_ts, fwd_ms, lengths)
+        log_betas = node_log_inside[:, 0, 1:] # [B, L] partition function of the prefix lattices
 
         # compute conditionals
-        c, ea, eb, em_, m = self.conditionals(fwd_ts, fwd_ms, log_alpha, edge_log_alpha, log_betas, edge_log_betas, marginal_temperature=marginal_temperature, device=device)
-        c = c.reshape(self.mixture_count * num_batch, num_block, c.size(-2), c.size(-1))
-        m = m.reshape(self.mixture_count *num_batch, num_block, m.size(-1))
-        a = self.tile(m, c, self.mixture_count * num_batch, num_block, M, L, fwd_ms, task_mask=tmask)
-        ent = ent.reshape(self.mixture_count * num_batch, -1).sum(-1)
-        if lm:
-            a = self.tile_lm(em_, log_betas, m, a, self.mixture_count * num_batch, num_block, M, L, lm_mask)
-
-        if (ent < -1e-3).any() or (ent.isnan().any()) or (ent.isinf().any()):
-            print(f"Bug detected in entropy! Negative entropy! {ent}")
-            # code.interact(local=locals())
-        if (a > 1e-3).any():
-            print("Bug detected in entropy! Greater than one marginals!")
-            code.interact(local=locals())
-        ent = torch.maximum(ent, torch.zeros_like(ent))
-        a = torch.minimum(a, torch.zeros_like(a))
+        c, ea, em_, m = self.conditionals(fwd_ts, fwd_ms, log_alpha, edge_log_alpha, node_log_inside, marginal_temperature=marginal_temperature, device=device, prefix_marginals=lm)
+        if self.mixture_count == 1:
+            return self.tile_statistics(ent, c, em_, log_betas, m, num_batch, num_block, M, L, fwd_ms, tmask=tmask, lm=lm, lm_mask=lm_mask, factorized=factorized, token_mask=token_mask)
+        ent, a, m, c = self.tile_statistics(ent, c, em_, log_betas, m, num_batch, num_block, M, L, fwd_ms, tmask=tmask, lm=lm, lm_mask=lm_mask)
 
         # handle mixture of lattices
         if self.mixture_count > 1:
-            normalized_n = (node_log_alpha + node_log_betas_rev.flip(-1).reshape(B, L, -1)[:, -1, :])[:,:-1] - log_alpha[:, None]
+            normalized_n = (node_log_alpha + node_log_inside[:, :, -1])[:,:-1] - log_alpha[:, None]
             marginal_n = normalized_n.reshape(self.mixture_count, num_batch * num_block, *normalized_n.size()[1:]).logsumexp(dim=0) - math.log(self.mixture_count)
 
             normalized_m = m
@@ -183,42 +189,109 @@ class Tokenizer(TokenizationMixin, LatticeDPMixin, LatticeAttentionMixin, nn.Mod
             marginal_c_matrix[~fwd_ms.reshape(self.mixture_count, num_batch * num_block, M, L)[0].to(torch.bool)] = -INF
 
             marginal_ent = -(marginal_m_matrix[triu_ones].double().exp() * marginal_c_matrix[triu_ones].double()).reshape(num_batch * num_block, -1).sum(-1)
-            # normalized_fwd_ts = self.forward_normalize(fwd_ts, fwd_ms, lengths, bwd_ts, bwd_ms, bwd_lengths, mmask, emask, device=device, m=m)
+            # normalized_fwd_ts = self.forward_normalize(fwd_ts, fwd_ms, lengths, device=device, m=m)
             return ent.reshape(self.mixture_count, num_batch * num_block, *ent.size()[1:]), \
                    a.reshape(self.mixture_count, num_batch * num_block, *a.size()[1:]), \
                    m.reshape(self.mixture_count, num_batch * num_block, *m.size()[1:]), \
                    c.reshape(self.mixture_count, num_batch * num_block, *c.size()[1:]), \
                    marginal_ent, \
                    marginal_c_matrix
+
+    def tile_statistics(self, ent: torch.FloatTensor,
+                        c: torch.FloatTensor,
+                        em_: torch.FloatTensor,
+                        log_betas: torch.FloatTensor,
+                        m: torch.FloatTensor,
+                        num_batch: int,
+                        num_block: int,
+                        M: int,
+                        L: int,
+                        fwd_ms: torch.FloatTensor,
+                        tmask: torch.FloatTensor = None,
+                        lm: bool = False,
+                        lm_mask: torch.FloatTensor = None,
+                        factorized: bool = False,
+                        token_mask: torch.FloatTensor = None) -> Tuple[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
+        """
+        Tiles the block statistics (one row per lattice of every block) into the sequence level entropy, attention
+        bias, marginals and conditionals returned by `forward`.
+        """
+        c = c.reshape(self.mixture_count * num_batch, num_block, c.size(-2), c.size(-1))
+        m = m.reshape(self.mixture_count *num_batch, num_block, m.size(-1))
+        ent = ent.reshape(self.mixture_count * num_batch, -1).sum(-1)
+        if factorized:
+            a = self.tile_factorized(m, c, num_batch, num_block, M, L, fwd_ms, edge_marginals=em_ if lm else None, log_betas=log_betas if lm else None, token_mask=token_mask)
+        else:
+            a = self.tile(m, c, self.mixture_count * num_batch, num_block, M, L, fwd_ms, task_mask=tmask)
+            if lm:
+                a = self.tile_lm(em_, log_betas, m, a, self.mixture_count * num_batch, num_block, M, L, lm_mask)
+
+        if (ent < -1e-3).any() or (ent.isnan().any()) or (ent.isinf().any()):
+            print(f"Bug detected in entropy! Negative entropy! {ent}")
+            # code.interact(local=locals())
+        if a.max() > 1e-3:
+            print("Bug detected in entropy! Greater than one marginals!")
+            code.interact(local=locals())
+        ent = torch.maximum(ent, torch.zeros_like(ent))
+        a = a.map(lambda x: torch.minimum(x, torch.zeros_like(x))) if factorized else torch.minimum(a, torch.zeros_like(a))
         return ent, a, m, c,
 
+    def reweight_statistics(self, ent: torch.FloatTensor,
+                            a: Union[torch.FloatTensor, BlockAttentionBias],
+                            m: torch.FloatTensor,
+                            c: torch.FloatTensor,
+                            fwd_ids: torch.LongTensor,
+                            fwd_ms: torch.FloatTensor,
+                            marginal_temperature: float = None) -> Tuple[torch.FloatTensor, Union[torch.FloatTensor, BlockAttentionBias], torch.FloatTensor, torch.FloatTensor]:
+        """
+        Makes the outputs of `forward` computed without gradient, possibly with older weights (e.g. on another thread),
+        differentiable w.r.t. the current weights. The values are unchanged, the gradients are the exact gradients at
+        the weights the statistics were computed with, from the covariance of the edges given by the marginals and the
+        conditionals: d log p(e) / d t_f = Cov(e, f) / p(e) and d H / d t_f = - sum_e t_e Cov(e, f).
+
+        The bias of a key gets the gradient of the marginal of the key, also where the bias is a conditional or (lm) a
+        prefix marginal.
+
+        fwd_ids, fwd_ms: num_batch, num_block, max_unit_length, max_block_length
+        """
+        if self.mixture_count > 1:
+            raise ValueError("re-weighting the statistics does not support mixtures of lattices")
+        num_batch, num_block = fwd_ids.size()[:2]
+        temperature = marginal_temperature if marginal_temperature is not None else 1.0
+        ms = self.linearize(fwd_ms) # [num_batch, num_block, E]
+        ts = self.linearize(self.get_weights(fwd_ids)).masked_fill(ms == 0, 0.0)
+        delta = ts - ts.detach() # zero, with the gradient of the weights
+
+        # Cov(e, f) / p(e) = p(f | e) - p(f), without dividing by the (possibly tiny) marginals
+        p = (m.detach() * temperature).exp().masked_fill(ms == 0, 0.0) # [num_batch, num_block, E]
+        relative_covariance = (c.detach() * temperature).exp() - p.unsqueeze(-2) # [num_batch, num_block, E (src), E (tgt)]
+        d_log_p = (relative_covariance @ delta.unsqueeze(-1)).squeeze(-1).masked_fill(ms == 0, 0.0)
+        g = d_log_p / temperature # zero, with the gradient of m
+
+        ent = ent - (ts.detach() * p * d_log_p).reshape(num_batch, -1).sum(-1)
+        if isinstance(a, BlockAttentionBias):
+            a = a._replace(edge_conditionals=a.edge_conditionals + g.unsqueeze(-2), edge_marginals=a.edge_marginals + g)
+            if a.causal:
+                previous = torch.cat([torch.zeros_like(g[:, :1]), g[:, :-1]], 1)
+                a = a._replace(node_conditionals=a.node_conditionals + g.unsqueeze(-2), node_marginals=a.node_marginals + g, node_previous=a.node_previous + previous)
+        else:
+            keys = g.reshape(num_batch, 1, -1)
+            a = a + torch.nn.functional.pad(keys, (0, a.size(-1) - keys.size(-1)))
+        return ent, a, m + g, c + g.unsqueeze(-2)
+
     def forward_normalize(self,
                 fwd_ts: torch.FloatTensor,
                 fwd_ms: torch.FloatTensor,
                 lengths: torch.LongTensor,
-                bwd_ts: torch.FloatTensor,
-                bwd_ms: torch.FloatTensor,
-                bwd_lengths:  torch.LongTensor,
-                mmask: torch.FloatTensor,
-                emask: torch.FloatTensor,
                 device="cpu",
                 m=None) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
         if m is None:
             B, M, L = fwd_ts.size()  # this is the effective B now, which is really self.mixture_count * num_batch * num_block
 
-            # 1 forward pass
+            # 1 forward and 1 reverse pass, the marginals only need the betas to the last node
             log_alpha, edge_log_alpha = self.forward_algorithm(fwd_ts, fwd_ms, lengths)
-            ent, edge_ent = self.entropy(fwd_ts, fwd_ms, lengths)
-
-            # max_length backward passes, one from each position
-            log_betas, edge_log_betas = self.forward_algorithm(bwd_ts, bwd_ms, bwd_lengths)
-            log_betas = log_betas.reshape(B, L)
-            edge_log_betas = edge_log_betas.reshape(B, L, M, L)
-
-            # mask out the character suffixes in backward that are just auxiliary and don't really exist
-            edge_log_betas = edge_log_betas * emask + torch.ones_like(edge_log_betas).fill_(-INF) * (1 - emask)
-
-            _,_,_,_,m = self.conditionals(fwd_ts, fwd_ms, log_alpha, edge_log_alpha, log_betas, edge_log_betas, device=device)
+            _, edge_log_beta = self.backward_algorithm(fwd_ts, fwd_ms, lengths)
+            m = self.linearize(edge_log_alpha + edge_log_beta - fwd_ts) - log_alpha[:, None]
 
         B, M, L = fwd_ts.size()
         m = m[..., self.inverse_permutation(L, M)]
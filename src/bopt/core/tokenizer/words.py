@@ -0,0 +1,331 @@
+from collections import OrderedDict
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+import torch
+
+from bopt.core.tokenizer.semiring import INF
+
+
+class WordSegments(NamedTuple):
+    """
+    The segments of a batch of lattices between the nodes that no edge crosses (the chunk boundaries of
+    `encode_packed_transitions`), in order of block then start node.
+
+    block: [S] block of every segment
+    start: [S] first node of every segment
+    length: [S] number of characters of every segment
+    char_segment: [B, L] segment of every character (column) of a block, 0 past the length of the block
+    """
+    block: torch.LongTensor
+    start: torch.LongTensor
+    length: torch.LongTensor
+    char_segment: torch.LongTensor
+
+
+class WordStatisticsCache:
+    """
+    Least recently used cache of the dp statistics of segments (see `WordLatticeMixin.word_statistics`) for the
+    current version of the weights, up to `max_bytes`.
+
+    Every entry remembers the units of its segment, `bump` starts a new version of the weights and only keeps the
+    entries that don't use any of the units that changed.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.version = 0
+
+    def get(self, key: Tuple) -> Optional[Tuple[torch.Tensor, ...]]:
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key][1]
+
+    def put(self, key: Tuple, units: frozenset, values: Tuple[torch.Tensor, ...]) -> None:
+        if key in self.entries:
+            return
+        self.entries[key] = (units, values)
+        self.nbytes += self.size(values)
+        while self.nbytes > self.max_bytes and self.entries:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.nbytes -= self.size(evicted)
+
+    def bump(self, touched: Iterable[int] = None) -> None:
+        """
+        Starts a new version of the weights, in which the units `touched` (all units if None) changed.
+        """
+        self.version += 1
+        if touched is None:
+            self.clear()
+            return
+        touched = set(touched)
+        for key in [key for key, (units, _) in self.entries.items() if not units.isdisjoint(touched)]:
+            _, evicted = self.entries.pop(key)
+            self.nbytes -= self.size(evicted)
+
+    @staticmethod
+    def size(values: Tuple[torch.Tensor, ...]) -> int:
+        return sum(v.numel() * v.element_size() for v in values)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.nbytes = 0
+
+
+class SegmentStatistics(NamedTuple):
+    """
+    DP statistics of segment lattices [U, M', L'] (with E' edges).
+
+    ent: [U]
+    log_alpha: [U]
+    c: [U, E', E'] conditionals
+    em_: [U, L', E'] unnormalized prefix edge marginals
+    m: [U, E'] marginals
+    log_betas: [U, L'] prefix partition functions
+    """
+    ent: torch.FloatTensor
+    log_alpha: torch.FloatTensor
+    c: torch.FloatTensor
+    em_: torch.FloatTensor
+    m: torch.FloatTensor
+    log_betas: torch.FloatTensor
+
+
+class WordLatticeMixin:
+    """
+    A lattice factors at every node that no edge crosses: its partition function is the product of those of the
+    segments between these nodes, edges of different segments are independent, and so on. The DP of a segment only
+    depends on its unit ids (and the weights), and words repeat a lot within a batch, so `word_statistics` runs the
+    DP once per distinct segment, on lattices only as long as the longest one, and composes the block statistics.
+    """
+    factorize_words = True # if set, `Tokenizer.forward` uses `word_statistics` when the edge weights only depend on the ids
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statistics_cache = None
+        self.weights_snapshot = None
+
+    def enable_statistics_cache(self, max_bytes: int = 256 * 2 ** 20) -> None:
+        """
+        Caches the statistics of every word between updates of the weights, for the calls that don't need their
+        gradient (no_grad, e.g. evaluation, or frozen weights). `bump_weights_version` must be called after every
+        update of the weights.
+
+        The cache isn't thread-safe: a tokenizer running on another thread (the shadow of `StaleLatticePipeline`)
+        must never share it with the main thread, the shadow is a deepcopy with a cache of its own.
+        """
+        self.statistics_cache = WordStatisticsCache(max_bytes)
+        self.weights_snapshot = self.weights.weight.detach().clone()
+
+    def bump_weights_version(self) -> None:
+        """
+        Call after updating the weights (e.g. optimizer.step()), drops the cached statistics of the words with a unit
+        whose weight changed.
+        """
+        if self.statistics_cache is None:
+            return
+        weight = self.weights.weight.detach()
+        if weight.size() != self.weights_snapshot.size() or weight.device != self.weights_snapshot.device:
+            self.statistics_cache.bump()
+        else:
+            touched = (weight != self.weights_snapshot).reshape(weight.size(0), -1).any(-1).nonzero(as_tuple=True)[0]
+            if touched.numel() > 0:
+                self.statistics_cache.bump(touched.tolist())
+        self.weights_snapshot = weight.clone()
+
+    def word_segments(self, fwd_ms: torch.FloatTensor, lengths: torch.LongTensor) -> WordSegments:
+        """
+        fwd_ms: B, M, L
+        lengths: B
+        """
+        B, M, L = fwd_ms.size()
+        device = fwd_ms.device
+        _, band = self.lattice_band(M, L, device=device)
+        active = fwd_ms.to(torch.bool) & band.unsqueeze(0)
+
+        # the edge in row k of column i crosses the nodes i-k+1 ... i
+        crossed = torch.zeros(B, L + 1, dtype=torch.bool, device=device)
+        for k in range(1, M):
+            for d in range(k):
+                crossed[:, k - d:L - d] |= active[:, k, k:]
+        nodes = torch.arange(L + 1, device=device)[None, :]
+        boundary = ~crossed & (nodes <= lengths[:, None])
+
+        # consecutive boundaries of a block delimit a segment, the last boundary of every block is its length
+        block, node = boundary.nonzero(as_tuple=True)
+        starts = (node < lengths[block]).nonzero(as_tuple=True)[0]
+        is_start = (boundary & (nodes < lengths[:, None]))[:, :L]
+        char_segment = (is_start.reshape(-1).cumsum(0) - 1).reshape(B, L).clamp(min=0)
+        char_segment = char_segment.masked_fill(nodes[:, :L] >= lengths[:, None], 0)
+        return WordSegments(block[starts], node[starts], node[starts + 1] - node[starts], char_segment)
+
+    def segment_lattices(self, fwd_ids: torch.LongTensor, fwd_ms: torch.FloatTensor, segments: WordSegments) -> Tuple[torch.LongTensor, torch.FloatTensor, torch.LongTensor]:
+        """
+        Transition matrices [S, M', L'] of the segments on their own, with L' the longest segment and M' = min(M, L').
+        """
+        M, L = fwd_ms.size()[-2:]
+        Lw = segments.length.max().item()
+        Mw = min(M, Lw)
+        columns = torch.arange(Lw, device=fwd_ms.device)
+        inside = columns[None, :] < segments.length[:, None] # [S, Lw]
+        index = (segments.block[:, None, None], torch.arange(Mw, device=fwd_ms.device)[None, :, None], (segments.start[:, None] + columns[None, :]).clamp(max=L - 1)[:, None, :])
+        ids = fwd_ids[index].masked_fill(~inside[:, None, :], self.pad_index)
+        ms = fwd_ms[index].masked_fill(~inside[:, None, :], 0.0)
+        return ids, ms, segments.length
+
+    def word_statistics(self, fwd_ids: torch.LongTensor,
+                        fwd_ms: torch.FloatTensor,
+                        lengths: torch.LongTensor,
+                        lm: bool = False,
+                        marginal_temperature: float = None) -> Tuple[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
+        """
+        The block statistics that `Tokenizer.forward` gets from the DP, with one DP per distinct segment.
+
+        fwd_ids: B, M, L
+        fwd_ms: B, M, L
+        lengths: B
+
+        Returns the entropy [B], conditionals [B, E, E], the (unnormalized) prefix edge marginals [B, L, E] and the
+        log betas [B, L] of the prefix lattices (both None unless `lm`) and the marginals [B, E].
+        """
+        B, M, L = fwd_ms.size()
+        device = fwd_ms.device
+        segments = self.word_segments(fwd_ms, lengths)
+        ids, ms, seg_lengths = self.segment_lattices(fwd_ids, fwd_ms, segments)
+        S, Mw, Lw = ids.size()
+
+        # dp over the distinct segments
+        keys = torch.cat([ids.masked_fill(ms == 0, -1).reshape(S, -1), seg_lengths[:, None]], -1)
+        _, types = torch.unique(keys, dim=0, return_inverse=True) # [S]
+        first = torch.full((types.max().item() + 1,), S, dtype=torch.long, device=device).scatter_reduce(0, types, torch.arange(S, device=device), "amin")
+        ids, ms, seg_lengths = ids[first], ms[first], seg_lengths[first]
+        if self.statistics_cache is not None and not (torch.is_grad_enabled() and self.weights.weight.requires_grad):
+            ent, log_alpha, c, em_, m, log_betas = self.cached_segment_statistics(ids, ms, seg_lengths, M, marginal_temperature=marginal_temperature)
+        else:
+            ent, log_alpha, c, em_, m, log_betas = self.segment_statistics(ids, ms, seg_lengths, marginal_temperature=marginal_temperature)
+
+        # position of every edge of a block in the lattice of its segment
+        start, end = self.edges(L, M)
+        start, end = start.to(device), end.to(device)
+        local_start, local_end = self.edges(Lw, Mw)
+        local_index = torch.zeros(Lw, Mw, dtype=torch.long, device=device)
+        local_index[local_start.to(device), (local_end - local_start - 1).to(device)] = torch.arange(local_start.size(0), device=device)
+        edge_segment = segments.char_segment[:, start] # [B, E]
+        offset = start[None, :] - segments.start[edge_segment]
+        in_segment = (start[None, :] < lengths[:, None]) & (end[None, :] <= segments.start[edge_segment] + segments.length[edge_segment])
+        edge_type = types[edge_segment]
+        edge_local = local_index[offset.clamp(0, Lw - 1), (end - start - 1).clamp(max=Mw - 1)[None, :]]
+
+        # entropies add up, edges of different segments are independent
+        block_ent = ent.new_zeros(B).index_add(0, segments.block, ent[types])
+        block_m = m[edge_type, edge_local].masked_fill(~in_segment, -INF)
+        same = (edge_segment[:, :, None] == edge_segment[:, None, :]) & in_segment[:, :, None] & in_segment[:, None, :]
+        block_ms = self.linearize(fwd_ms).to(torch.bool) & in_segment
+        independent = block_ms[:, :, None] & block_ms[:, None, :] & ~same
+        block_c = torch.where(same, c[edge_type[:, :, None], edge_local[:, :, None], edge_local[:, None, :]],
+                              block_m[:, None, :].masked_fill(~independent, -INF))
+        if not lm:
+            return block_ent, block_c, None, None, block_m
+
+        # partition functions of the segments before every segment of a block
+        first_of_block = torch.full((B,), S, dtype=torch.long, device=device).scatter_reduce(0, segments.block, torch.arange(S, device=device), "amin")
+        position = torch.arange(S, device=device) - first_of_block[segments.block]
+        segment_log_alpha = log_alpha.new_zeros(B, L).index_put((segments.block, position), log_alpha[types])
+        before = (segment_log_alpha.cumsum(-1) - segment_log_alpha)[segments.block, position] # [S]
+
+        # prefix lattices ending inside a segment are the segments before it and a prefix of the segment, past the
+        # length of a block the prefix lattices are the whole lattice
+        nodes = torch.arange(L, device=device)
+        past = nodes[None, :] >= lengths[:, None] # [B, L]
+        node_segment = segments.char_segment # [B, L]
+        node_type = types[node_segment]
+        node_local = (nodes[None, :] - segments.start[node_segment]).clamp(0, Lw - 1)
+        block_log_betas = torch.where(past, segment_log_alpha.sum(-1, keepdim=True), before[node_segment] + log_betas[node_type, node_local])
+
+        local_marginals = em_ - log_betas.unsqueeze(-1) # [U, Lw, Ew] normalized prefix marginals
+        full = local_marginals[types[edge_segment], (segments.length[edge_segment] - 1), edge_local] # [B, E]
+        prefix = local_marginals[node_type[:, :, None], node_local[:, :, None], edge_local[:, None, :]] # [B, L, E]
+        earlier = in_segment[:, None, :] & ((edge_segment[:, None, :] < node_segment[:, :, None]) | past[:, :, None])
+        current = in_segment[:, None, :] & ~past[:, :, None] & (edge_segment[:, None, :] == node_segment[:, :, None]) & (end[None, None, :] <= nodes[None, :, None] + 1)
+        block_em_ = torch.where(earlier, full[:, None, :], torch.where(current, prefix, prefix.new_full((), -INF))) + block_log_betas.unsqueeze(-1)
+        return block_ent, block_c, block_em_, block_log_betas, block_m
+
+    def segment_statistics(self, ids: torch.LongTensor, ms: torch.FloatTensor, lengths: torch.LongTensor, marginal_temperature: float = None) -> SegmentStatistics:
+        ts = self.get_weights(ids)
+        log_alpha, edge_log_alpha, _, ent, _ = self.forward_statistics(ts, ms, lengths)
+        node_log_inside = self.pairwise_algorithm(ts, ms, lengths)
+        log_betas = node_log_inside[:, 0, 1:]
+        c, _, em_, m = self.conditionals(ts, ms, log_alpha, edge_log_alpha, node_log_inside, marginal_temperature=marginal_temperature, device=ms.device)
+        return SegmentStatistics(ent, log_alpha, c, em_, m, log_betas)
+
+    def cached_segment_statistics(self, ids: torch.LongTensor, ms: torch.FloatTensor, lengths: torch.LongTensor, M: int, marginal_temperature: float = None) -> SegmentStatistics:
+        """
+        `segment_statistics` with the dp only for the segments missing from `statistics_cache`.
+
+        Entries are kept for the lattice of the segment on its own ([min(M, l), l] for l characters), so they can be
+        used in batches with longer segments.
+        """
+        U, Mw, Lw = ids.size()
+        keys = ids.masked_fill(ms == 0, -1).cpu().numpy()
+        lengths_list = lengths.tolist()
+        entries = []
+        for u, length in enumerate(lengths_list):
+            key = (M, length, marginal_temperature, keys[u, :min(M, length), :length].tobytes())
+            entries.append((key, self.statistics_cache.get(key)))
+        misses = [u for u, (_, values) in enumerate(entries) if values is None]
+        if len(misses) == U:
+            statistics = self.segment_statistics(ids, ms, lengths, marginal_temperature=marginal_temperature)
+        else:
+            computed = self.segment_statistics(ids[misses], ms[misses], lengths[misses], marginal_temperature=marginal_temperature) if misses else None
+            template = computed if computed is not None else next(values for _, values in entries if values is not None)
+            Ew = self.edges(Lw, Mw)[0].size(0)
+            shapes = [(U,), (U,), (U, Ew, Ew), (U, Lw, Ew), (U, Ew), (U, Lw)]
+            statistics = SegmentStatistics(*[template[i].new_full(shape, -INF) for i, shape in enumerate(shapes)])
+            if misses:
+                index = torch.tensor(misses, dtype=torch.long, device=ids.device)
+                for value, miss_value in zip(statistics, computed):
+                    value[index] = miss_value
+            for length in set(lengths_list):
+                hits = [u for u in range(U) if lengths_list[u] == length and entries[u][1] is not None]
+                if hits:
+                    self.restore_segments(statistics, hits, [entries[u][1] for u in hits], length, min(M, length), Mw, Lw)
+
+        # remember the new segments, on their own lattice
+        for u in misses:
+            length = lengths_list[u]
+            edges = self.segment_edges(length, min(M, length), Lw, Mw).to(ids.device)
+            values = SegmentStatistics(statistics.ent[u], statistics.log_alpha[u], statistics.c[u][edges][:, edges],
+                                       statistics.em_[u, :length][:, edges], statistics.m[u, edges], statistics.log_betas[u, :length])
+            self.statistics_cache.put(entries[u][0], frozenset(ids[u][ms[u] > 0].tolist()), tuple(v.detach() for v in values))
+        return statistics
+
+    def restore_segments(self, statistics: SegmentStatistics, rows: List[int], entries: List[Tuple[torch.Tensor, ...]], length: int, Mc: int, Mw: int, Lw: int) -> None:
+        """
+        Writes cached entries of segments of `length` characters into the rows of [U, M', L'] statistics.
+        """
+        device = statistics.m.device
+        edges = self.segment_edges(length, Mc, Lw, Mw).to(device)
+        rows = torch.tensor(rows, dtype=torch.long, device=device)
+        nodes = torch.arange(length, device=device)
+        ent, log_alpha, c, em_, m, log_betas = [torch.stack(values) for values in zip(*entries)]
+        statistics.ent[rows] = ent
+        statistics.log_alpha[rows] = log_alpha
+        statistics.m[rows[:, None], edges[None, :]] = m
+        statistics.c[rows[:, None, None], edges[None, :, None], edges[None, None, :]] = c
+        statistics.em_[rows[:, None, None], nodes[None, :, None], edges[None, None, :]] = em_
+        statistics.log_betas[rows[:, None], nodes[None, :]] = log_betas
+
+    @classmethod
+    def segment_edges(cls, L: int, M: int, Lw: int, Mw: int) -> torch.LongTensor:
+        """
+        Positions [E] of the edges of a [M, L] lattice among the edges of a [Mw, Lw] lattice (L <= Lw, M <= Mw).
+        """
+        def build():
+            start, end = cls.edges(L, M)
+            wide_start, wide_end = cls.edges(Lw, Mw)
+            index = torch.full((Lw, Mw), -1, dtype=torch.long)
+            index[wide_start, wide_end - wide_start - 1] = torch.arange(wide_start.size(0))
+            return index[start, end - start - 1]
+        return cls.structures.get("segment_edges", (L, M, Lw, Mw), build)
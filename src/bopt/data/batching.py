@@ -0,0 +1,61 @@
+from typing import Iterator, List
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+def lattice_sequence_length(blocks, characters, max_unit_length: int):
+    """
+    N * (E + L), the length of the lattice inputs of the model, for `blocks` blocks of `characters` characters and
+    units of at most `max_unit_length` characters (numbers or arrays).
+    """
+    M = np.minimum(max_unit_length, characters)
+    E = (characters * (characters + 1)) // 2 - ((characters - M) * (characters - M + 1)) // 2
+    return blocks * (E + characters)
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Batches of examples with similar numbers of blocks and characters per block, as many as fit in `budget` positions
+    of the lattice inputs of the model once the batch is trimmed to its most blocks and its longest block (see
+    `trim_compact_batch`), and at least one.
+
+    The examples are sorted by blocks then characters, ties in random order, and cut into batches in that order. With
+    `shuffle` the order of the batches is random, and different every epoch.
+
+    lengths: num_examples, N (the characters of every block, the `lengths` of the lattice caches)
+    """
+
+    def __init__(self, lengths: np.ndarray, max_unit_length: int, budget: int, shuffle: bool = True, seed: int = 0):
+        self.blocks = (lengths > 0).sum(-1).astype(np.int64)
+        self.characters = lengths.max(-1).astype(np.int64)
+        self.max_unit_length = max_unit_length
+        self.budget = budget
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        # ties have the same cost, so the number of batches doesn't depend on their order
+        self.num_batches = len(self.batches(np.arange(len(self.blocks))))
+
+    def batches(self, order: np.ndarray) -> List[List[int]]:
+        order = order[np.lexsort((self.characters[order], self.blocks[order]))]
+        batches, batch, blocks, characters = [], [], 0, 0
+        for i in order.tolist():
+            b, c = max(blocks, self.blocks[i]), max(characters, self.characters[i])
+            if batch and (len(batch) + 1) * lattice_sequence_length(b, c, self.max_unit_length) > self.budget:
+                batches.append(batch)
+                batch, b, c = [], self.blocks[i], self.characters[i]
+            batch.append(i)
+            blocks, characters = b, c
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        order = self.rng.permutation(len(self.blocks)) if self.shuffle else np.arange(len(self.blocks))
+        batches = self.batches(order)
+        if self.shuffle:
+            batches = [batches[i] for i in self.rng.permutation(len(batches))]
+        return iter(batches)
+
+    def __len__(self) -> int:
+        return self.num_batches
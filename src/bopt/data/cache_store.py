@@ -0,0 +1,167 @@
+import argparse
+import fcntl
+import functools
+import hashlib
+import json
+import os
+import shutil
+from typing import Any, Callable, Dict, Optional
+
+from bopt.core.integerize import Integerizer
+from bopt.core.tokenizer import Tokenizer
+from bopt.data.datasets import CACHE_VERSION, ColumnarCache, cache_complete
+
+FINGERPRINT_FILE = "fingerprint.json"
+FINGERPRINT_VERSION = 1
+
+# the command line arguments the preprocessing functions that take `args` read
+PREPROCESSING_OPTIONS = ["segmentation_dictionary", "dummy_prefix", "encoding", "skip_gram_distances"]
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2 ** 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def units_digest(units) -> str:
+    return hashlib.sha256("\n".join(units).encode("utf-8")).hexdigest()
+
+
+def describe(value: Any) -> Any:
+    """
+    A json description of an argument of a preprocessing function.
+    """
+    if isinstance(value, Integerizer):
+        return {"vocab": units_digest(list(value))}
+    if isinstance(value, functools.partial):
+        # the command line arguments are described by the options
+        return {"function": describe(value.func), "args": [describe(arg) for arg in value.args if not isinstance(arg, argparse.Namespace)]}
+    if callable(value):
+        return f"{value.__module__}.{value.__qualname__}"
+    if isinstance(value, (list, tuple)):
+        return [describe(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): describe(v) for k, v in value.items()}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(value)
+
+
+def preprocessing_fingerprint(preprocess: Callable, data_file: str, tokenizer: Tokenizer, args: tuple, kwargs: dict,
+                              options: Dict[str, Any], weights: bool) -> Dict[str, Any]:
+    """
+    Everything the cache of `preprocess(data_file, cache_dir, tokenizer, *args, **kwargs)` depends on: the contents of
+    the data file, the vocabulary, specials and csp of the tokenizer (and its weights if the preprocessing tokenizes,
+    `weights`), the arguments, e.g. N, L, M and the output vocabulary, and the command line `options` the function
+    reads (contents of the files among them). The task is implied by `preprocess`.
+    """
+    files = options.get("segmentation_dictionary") or []
+    return {"version": FINGERPRINT_VERSION,
+            "cache_version": CACHE_VERSION,
+            "preprocess": describe(preprocess),
+            "data": file_digest(data_file),
+            "vocab": units_digest(list(tokenizer.vocab)),
+            "specials": list(tokenizer.specials),
+            "csp": tokenizer.csp,
+            "max_unit_length": tokenizer.max_unit_length,
+            "weights": hashlib.sha256(tokenizer.weights.weight.detach().cpu().numpy().tobytes()).hexdigest() if weights else None,
+            "args": describe(list(args)),
+            "kwargs": describe(kwargs),
+            "options": describe(options),
+            "option_files": [file_digest(f) for f in files]}
+
+
+def fingerprint_key(fingerprint: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def read_fingerprint(cache_dir: str) -> Optional[Dict[str, Any]]:
+    path = os.path.join(cache_dir, FINGERPRINT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rt") as f:
+        return json.load(f)
+
+
+def write_fingerprint(cache_dir: str, fingerprint: Dict[str, Any]) -> None:
+    with open(os.path.join(cache_dir, FINGERPRINT_FILE + ".tmp"), "wt") as f:
+        json.dump(fingerprint, f, indent=4)
+    os.replace(os.path.join(cache_dir, FINGERPRINT_FILE + ".tmp"), os.path.join(cache_dir, FINGERPRINT_FILE))
+
+
+def valid_cache(cache_dir: str, fingerprint: Dict[str, Any]) -> bool:
+    """
+    Whether `cache_dir` is a complete cache of `fingerprint` whose files have the sizes its index says.
+    """
+    if not os.path.isdir(cache_dir) or read_fingerprint(cache_dir) != fingerprint or not cache_complete(cache_dir):
+        return False
+    if ColumnarCache.exists(cache_dir):
+        try:
+            ColumnarCache(cache_dir).verify()
+        except ValueError:
+            return False
+    return True
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        # another file system
+        shutil.copy2(src, dst)
+
+
+class CacheStore:
+    """
+    Preprocessed caches shared by runs, keyed by their fingerprint (see `preprocessing_fingerprint`). The entry
+    `<root>/<key>` holds the cache in `cache/` and the files some preprocessing functions write next to their cache dir
+    (`cache.meta.json`, `cache.index.json`). An entry is built in the staging directory `<root>/.<key>.building` and
+    published by renaming it, so a run never sees a partial entry. A failed or interrupted build leaves the staging
+    directory for the next run to resume, and concurrent runs building the same entry take turns on the lock file
+    `<root>/.<key>.lock`.
+    Runs get hard links (copies across file systems) of the files of an entry in their own cache dir.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def entry(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def get(self, fingerprint: Dict[str, Any], build: Callable[[str], None]) -> str:
+        """
+        The entry of `fingerprint`, built with `build(cache_dir)` first if there is no valid one.
+        """
+        key = fingerprint_key(fingerprint)
+        entry = self.entry(key)
+        if valid_cache(os.path.join(entry, "cache"), fingerprint):
+            return entry
+        staging = os.path.join(self.root, f".{key}.building")
+        with open(os.path.join(self.root, f".{key}.lock"), "a") as lock:
+            # one run builds an entry at a time, the others wait for it and use it
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if valid_cache(os.path.join(entry, "cache"), fingerprint):
+                return entry
+            if os.path.exists(entry):
+                # left by an older version of the code, or corrupted
+                shutil.rmtree(entry)
+            # kept if the build fails, the next build resumes it (see `preprocess_in_parts`)
+            os.makedirs(os.path.join(staging, "cache"), exist_ok=True)
+            build(os.path.join(staging, "cache"))
+            write_fingerprint(os.path.join(staging, "cache"), fingerprint)
+            os.rename(staging, entry)
+        return entry
+
+    def link(self, entry: str, cache_dir: str) -> None:
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+        shutil.copytree(os.path.join(entry, "cache"), cache_dir, copy_function=link_or_copy)
+        for f in os.listdir(entry):
+            if f.startswith("cache."):
+                if os.path.exists(cache_dir + f[len("cache"):]):
+                    os.remove(cache_dir + f[len("cache"):])
+                link_or_copy(os.path.join(entry, f), cache_dir + f[len("cache"):])
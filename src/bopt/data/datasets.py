@@ -1,26 +1,302 @@
+import bisect
 import json
+from typing import Any, Dict, List, Union
 
+import numpy as np
+import torch
 from torch.utils.data import Dataset
 from torch.utils.data.dataloader import default_collate
 import os
 import pickle
+import shutil
+
+CACHE_INDEX = "index.json"
+CACHE_VERSION = 1
+
+
+def column_value(value: Any) -> Union[str, np.ndarray]:
+    """
+    The value of a field as stored in the columnar cache, strings stay strings, everything else becomes a contiguous
+    array (doubles are stored as floats, the datasets use floats).
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, torch.Tensor):
+        value = value.detach().cpu().numpy()
+    value = np.asarray(value)
+    if value.dtype == np.float64:
+        value = value.astype(np.float32)
+    # ascontiguousarray makes scalars 1-d
+    return np.ascontiguousarray(value).reshape(value.shape)
+
+
+def smallest_int_dtype(max_value: int) -> torch.dtype:
+    """
+    The narrowest signed integer dtype that holds `max_value`, for storing ids and lengths in a cache.
+    """
+    for dtype in [torch.int16, torch.int32]:
+        if max_value <= torch.iinfo(dtype).max:
+            return dtype
+    return torch.int64
+
+
+class ColumnarCacheWriter:
+    """
+    Writes examples (dicts of strings and fixed-shape tensors, arrays, lists or numbers) into a columnar cache in
+    `root`: every field of a shard is one raw binary file of fixed-size rows, a string field is the utf-8 bytes of all
+    the examples and an offsets file. `index.json`, with the dtypes, shapes and shard lengths, is written last by
+    `close`, a cache without it is incomplete.
+
+    Use as a context manager, the index is only written if the block exits without an exception.
+    """
+
+    def __init__(self, root: str, shard_size: int = 2 ** 16):
+        self.root = root
+        self.shard_size = shard_size
+        self.fields = None
+        self.shards = []
+        self.files = None
+        self.text_offsets = None
+
+    def __enter__(self) -> "ColumnarCacheWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.close_shard()
+
+    def path(self, shard: str, field: str, suffix: str = "bin") -> str:
+        return os.path.join(self.root, f"{shard}.{field}.{suffix}")
+
+    def append(self, example: Dict[str, Any]) -> None:
+        example = {field: column_value(value) for field, value in example.items()}
+        fields = {field: {"dtype": "str"} if isinstance(value, str) else {"dtype": value.dtype.str, "shape": list(value.shape)}
+                  for field, value in example.items()}
+        if self.fields is None:
+            self.fields = fields
+        elif fields != self.fields:
+            raise ValueError(f"every example of a columnar cache needs the same fields, dtypes and shapes, expected {self.fields}, got {fields}")
+
+        if self.files is None or self.shards[-1]["length"] == self.shard_size:
+            self.open_shard()
+        for field, value in example.items():
+            if isinstance(value, str):
+                data = value.encode("utf-8")
+                self.text_offsets[field] += len(data)
+                self.files[field].write(data)
+                self.files[field + ".offsets"].write(np.array([self.text_offsets[field]], dtype=np.int64).tobytes())
+            else:
+                self.files[field].write(value.tobytes())
+        self.shards[-1]["length"] += 1
+
+    def open_shard(self) -> None:
+        self.close_shard()
+        shard = f"shard-{len(self.shards):05d}"
+        self.shards.append({"name": shard, "length": 0})
+        self.files = {field: open(self.path(shard, field), "wb") for field in self.fields}
+        self.text_offsets = {field: 0 for field, spec in self.fields.items() if spec["dtype"] == "str"}
+        for field in self.text_offsets:
+            self.files[field + ".offsets"] = open(self.path(shard, field, "offsets.bin"), "wb")
+            self.files[field + ".offsets"].write(np.zeros(1, dtype=np.int64).tobytes())
+
+    def close_shard(self) -> None:
+        if self.files is not None:
+            for f in self.files.values():
+                f.close()
+        self.files = None
+
+    def close(self) -> None:
+        self.close_shard()
+        write_cache_index(self.root, self.fields or {}, self.shards)
+
+
+def write_cache_index(root: str, fields: Dict[str, Any], shards: List[Dict[str, Any]]) -> None:
+    index = {"version": CACHE_VERSION, "fields": fields, "shards": shards}
+    with open(os.path.join(root, CACHE_INDEX + ".tmp"), "wt") as f:
+        json.dump(index, f)
+    os.replace(os.path.join(root, CACHE_INDEX + ".tmp"), os.path.join(root, CACHE_INDEX))
+
+
+def merge_columnar_caches(root: str, parts: List[str]) -> None:
+    """
+    Makes `root` the columnar cache of the examples of the complete columnar caches in its subdirectories `parts`, in
+    that order. Only the index is written, the shards stay in the parts.
+    """
+    fields, shards = None, []
+    for part in parts:
+        with open(os.path.join(root, part, CACHE_INDEX), "rt") as f:
+            index = json.load(f)
+        if not index["shards"]:
+            continue
+        if fields is None:
+            fields = index["fields"]
+        elif index["fields"] != fields:
+            raise ValueError(f"the parts of a columnar cache need the same fields, dtypes and shapes, {part} has {index['fields']}, expected {fields}")
+        shards.extend({"name": f"{part}/{shard['name']}", "length": shard["length"]} for shard in index["shards"])
+    write_cache_index(root, fields or {}, shards)
+
+
+class ColumnarCache:
+    """
+    Read side of `ColumnarCacheWriter`. The files are memory mapped (copy on write) the first time an example is read
+    in a process, so the cache can be pickled to DataLoader workers, and the arrays of an example are tensor views of
+    the maps, nothing is copied until a dataset converts them.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        with open(os.path.join(root, CACHE_INDEX), "rt") as f:
+            index = json.load(f)
+        if index.get("version") != CACHE_VERSION:
+            raise ValueError(f"{root} is a columnar cache of version {index.get('version')}, expected {CACHE_VERSION}")
+        self.fields = index["fields"]
+        self.shards = [shard["name"] for shard in index["shards"]]
+        self.starts = np.cumsum([0] + [shard["length"] for shard in index["shards"]]).tolist()
+        self.maps = None
+
+    @staticmethod
+    def exists(root: str) -> bool:
+        return os.path.exists(os.path.join(root, CACHE_INDEX))
+
+    def __len__(self) -> int:
+        return self.starts[-1]
+
+    def verify(self) -> None:
+        """
+        Raises a ValueError if a file of the cache is missing or doesn't have the size the index implies.
+        """
+        def check(path, size):
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                raise ValueError(f"{path} should have {size} bytes")
+        for shard, length in zip(self.shards, np.diff(self.starts).tolist()):
+            for field, spec in self.fields.items():
+                if spec["dtype"] == "str":
+                    offsets = self.path(shard, field, "offsets.bin")
+                    check(offsets, 8 * (length + 1))
+                    check(self.path(shard, field), int(np.fromfile(offsets, dtype="<i8")[-1]))
+                else:
+                    check(self.path(shard, field), length * np.dtype(spec["dtype"]).itemsize * int(np.prod(spec["shape"])))
+
+    def __getstate__(self):
+        return {**self.__dict__, "maps": None}
+
+    def path(self, shard: str, field: str, suffix: str = "bin") -> str:
+        return os.path.join(self.root, f"{shard}.{field}.{suffix}")
+
+    def map(self, path: str, dtype: str, shape: List[int]) -> np.ndarray:
+        if int(np.prod(shape)) == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="c", shape=tuple(shape))
+
+    def open(self) -> None:
+        self.maps = []
+        for shard, length in zip(self.shards, np.diff(self.starts).tolist()):
+            maps = {}
+            for field, spec in self.fields.items():
+                if spec["dtype"] == "str":
+                    offsets = self.map(self.path(shard, field, "offsets.bin"), "<i8", [length + 1])
+                    maps[field] = (self.map(self.path(shard, field), "u1", [int(offsets[-1])]), offsets)
+                else:
+                    maps[field] = self.map(self.path(shard, field), spec["dtype"], [length] + spec["shape"])
+            self.maps.append(maps)
+
+    def column(self, field: str) -> np.ndarray:
+        """
+        The values of a (non-string) field of all the examples, [len(self), *shape].
+        """
+        if self.maps is None:
+            self.open()
+        spec = self.fields[field]
+        if not self.maps:
+            return np.zeros([0] + spec["shape"], dtype=spec["dtype"])
+        return np.concatenate([maps[field] for maps in self.maps])
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        if self.maps is None:
+            self.open()
+        shard = bisect.bisect_right(self.starts, index) - 1
+        i = index - self.starts[shard]
+        example = {}
+        for field, spec in self.fields.items():
+            if spec["dtype"] == "str":
+                data, offsets = self.maps[shard][field]
+                example[field] = data[offsets[i]:offsets[i + 1]].tobytes().decode("utf-8")
+            elif len(spec["shape"]) == 0:
+                example[field] = self.maps[shard][field][i].item()
+            else:
+                example[field] = torch.from_numpy(self.maps[shard][field][i])
+        return example
+
+
+class PickleCache:
+    """
+    Caches written before the columnar format, one pickle of lists per example.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.length = len([f for f in os.listdir(root) if f.endswith(".pkl")])
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        with open(os.path.join(self.root, f"{index}.pkl"), "rb") as f:
+            example = pickle.load(f)
+        return {field: torch.as_tensor(value) if isinstance(value, list) else value for field, value in example.items()}
+
+
+def cache_complete(root: str) -> bool:
+    """
+    Whether `root` holds a finished cache (a columnar cache with its index, or the pickles of the old format).
+    """
+    return ColumnarCache.exists(root) or any(f.endswith(".pkl") for f in os.listdir(root))
+
+
+def clear_cache_dir(root: str) -> None:
+    for f in os.listdir(root):
+        path = os.path.join(root, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def open_cache(root: str) -> Union[ColumnarCache, PickleCache]:
+    if ColumnarCache.exists(root):
+        return ColumnarCache(root)
+    if any(f.startswith("shard-") or f.startswith("part-") for f in os.listdir(root)):
+        raise ValueError(f"{root} is an incomplete columnar cache (no {CACHE_INDEX}), rebuild it with --overwrite_cache")
+    return PickleCache(root)
 
 
 class LazyDataset(Dataset):
 
     def __init__(self, root):
         self.root = root
+        self.cache = open_cache(root)
 
     def __len__(self):
-        return len(os.listdir(self.root))
+        return len(self.cache)
 
     def __getitem__(self, index):
-        with open(os.path.join(self.root, f"{index}.pkl"), "rb") as f:
-            return self.encode(pickle.load(f), index)
+        return self.encode(self.cache[index], index)
 
     def encode(self, example, index):
         raise NotImplementedError
 
+    def column(self, field):
+        """
+        The values of `field` of every example as stored in the cache, without encoding the examples.
+        """
+        if isinstance(self.cache, ColumnarCache):
+            return self.cache.column(field)
+        return np.stack([np.asarray(self.cache[i][field]) for i in range(len(self.cache))])
+
     @staticmethod
     def collate(batch):
         return default_collate(batch)
@@ -29,6 +305,7 @@ class LazySkipGramDataset(Dataset):
 
     def __init__(self, root, max_block_length):
         self.root = root
+        self.cache = open_cache(root)
         with open(f"{root}.index.json", "rt") as f:
             index = json.load(f)
         self.length = index["total"]
@@ -47,13 +324,11 @@ class LazySkipGramDataset(Dataset):
 
     def __getitem__(self, index):
         dist, src, tgt = self._index[index]
-        with open(os.path.join(self.root, f"{src}.pkl"), "rb") as f:
-            with open(os.path.join(self.root, f"{tgt}.pkl"), "rb") as g:
-                return self.encode({"src": pickle.load(f), "tgt": pickle.load(g)}, (index, dist, src, tgt, self.max_block_length))
+        return self.encode({"src": self.cache[src], "tgt": self.cache[tgt]}, (index, dist, src, tgt, self.max_block_length))
 
     def encode(self, example, index):
         raise NotImplementedError
 
     @staticmethod
     def collate(batch):
-        return default_collate(batch)
\ No newline at end of file
+        return default_collate(batch)
@@ -3,13 +3,15 @@ import code
 from tqdm import tqdm
 from bopt.core.integerize import Integerizer
 from bopt.core.tokenizer import Tokenizer
-from bopt.data.datasets import LazyDataset
+from bopt.data.datasets import ColumnarCacheWriter, LazyDataset, smallest_int_dtype
 from bopt.data.language_modeling.utils import viterbi_tokenize, pack_viterbi_chunks
 from bopt.data.language_modeling.utils import clear_cache, pretokenize, truncated_and_pad_packed_chunks
 
 import os
-import pickle
+from typing import Dict, NamedTuple, Union
+
 import torch
+from torch.utils.data.dataloader import default_collate
 
 """
 MAX_BLOCKS = 10 # N: Number of words roughly in a sentence
@@ -19,6 +21,141 @@ MAX_UNIT_LENGTH = 20 # M: number of characters in a candidate unit
 MAX_BLOCK_TOKENS = (MAX_BLOCK_LENGTH * (MAX_BLOCK_LENGTH + 1)) // 2 - ((MAX_BLOCK_LENGTH - MAX_UNIT_LENGTH) * (MAX_BLOCK_LENGTH - MAX_UNIT_LENGTH + 1)) // 2
 """
 
+ID_FIELDS = ["input_ids", "fwd_ids", "bwd_ids", "viterbi_fwd_ids", "viterbi_bwd_ids"]
+POSITION_FIELDS = ["pos_ids", "lengths", "ntokens"]
+
+
+class CompactLatticeExample(NamedTuple):
+    """
+    An example (or, collated, a batch) of a compact language modeling lattice cache, the ids are in the dtype they
+    are stored in and the masks are left out, `expand_compact_batch` rebuilds the full batch.
+    """
+    input_ids: torch.Tensor # [N * (E + L)]
+    pos_ids: torch.Tensor # [N * (E + L)]
+    fwd_ids: torch.Tensor # [N, M, L]
+    lengths: torch.Tensor # [N]
+    bwd_ids: torch.Tensor # [N, M, L]
+    verbatim: int # whether the lattices are verbatim (viterbi) lattices, these only pad the backward mask outside the characters
+    text: str
+    ntokens: torch.Tensor # [N]
+
+
+class CompactViterbiLatticeExample(NamedTuple):
+    """
+    `CompactLatticeExample` of a cache with the (always verbatim) viterbi lattices of the output.
+    """
+    input_ids: torch.Tensor
+    pos_ids: torch.Tensor
+    fwd_ids: torch.Tensor
+    lengths: torch.Tensor
+    bwd_ids: torch.Tensor
+    verbatim: int
+    text: str
+    ntokens: torch.Tensor
+    viterbi_fwd_ids: torch.Tensor # [N, M, L]
+    viterbi_bwd_ids: torch.Tensor # [N, M, L]
+
+
+def lattice_cache_example(example: Dict[str, Union[str, torch.Tensor]], tokenizer: Tokenizer, verbatim: bool = False, compact_storage: bool = True) -> Dict[str, Union[str, torch.Tensor]]:
+    """
+    The fields of `example` that are written to the cache. With `compact_storage`, every mask (and the duplicate text)
+    is dropped, they are functions of the ids (the padding unit never occurs in a lattice) or of L and M only, and the
+    ids and positions are stored in the narrowest integer dtype that fits the vocabulary / the sequence length.
+    """
+    if not compact_storage:
+        return example
+    id_dtype = smallest_int_dtype(len(tokenizer.vocab))
+    position_dtype = smallest_int_dtype(example["input_ids"].numel())
+    compact = {field: example[field].to(id_dtype) for field in ID_FIELDS if field in example}
+    compact.update({field: example[field].to(position_dtype) for field in POSITION_FIELDS})
+    compact["verbatim"] = torch.tensor(verbatim, dtype=torch.int8)
+    compact["text_str"] = example["text_str"]
+    return compact
+
+
+def expand_lattice_masks(tokenizer: Tokenizer, fwd_ids: torch.Tensor, bwd_ids: torch.Tensor, lengths: torch.Tensor, verbatim: torch.Tensor):
+    """
+    The forward and backward masks of batched compact lattices. The first row of a backward lattice is kept where the
+    packed lattice has no characters and, unless the lattice is verbatim, everywhere else too (see
+    `Tokenizer.init_transitions_and_masks`).
+    """
+    L = fwd_ids.size(-1)
+    fwd_ms = (fwd_ids != tokenizer.pad_index).to(torch.float)
+    bwd_ms = (bwd_ids != tokenizer.pad_index).to(torch.float)
+    column = torch.arange(L, device=fwd_ids.device)
+    padding_row = (column < L - lengths[..., None]) | (verbatim == 0)[:, None, None]
+    bwd_ms[:, :, 0, :] = torch.maximum(bwd_ms[:, :, 0, :], padding_row.to(torch.float))
+    return fwd_ms, bwd_ms
+
+
+def expand_compact_batch(batch, tokenizer: Tokenizer, device: str):
+    """
+    Rebuilds, on `device`, the batch of `LanguageModelingLatticeDataset` (or `LanguageModelingLatticeOutputViterbiDataset`)
+    that a full cache would have given from a collated `CompactLatticeExample` (or `CompactViterbiLatticeExample`), other
+    batches are returned as they are.
+    """
+    if not isinstance(batch, (CompactLatticeExample, CompactViterbiLatticeExample)):
+        return batch
+    input_ids, fwd_ids, bwd_ids = [t.to(device).to(torch.long) for t in (batch.input_ids, batch.fwd_ids, batch.bwd_ids)]
+    pos_ids, lengths, ntokens, verbatim = [t.to(device).to(torch.long) for t in (batch.pos_ids, batch.lengths, batch.ntokens, batch.verbatim)]
+    B, N, M, L = fwd_ids.size()
+
+    input_mask = (input_ids != tokenizer.pad_index).to(torch.long)
+    fwd_ms, bwd_ms = expand_lattice_masks(tokenizer, fwd_ids, bwd_ids, lengths, verbatim)
+    bwd_lengths = torch.full((B, N * L), L, dtype=torch.long, device=device)
+    mmask, emask = tokenizer.parallel_backward_mask(L, M, device=device)
+    mmask, emask = [mask.to(torch.long)[None, None].expand(B, 1, L, M, L) for mask in (mmask, emask)]
+    viterbi = []
+    if isinstance(batch, CompactViterbiLatticeExample):
+        viterbi_fwd_ids, viterbi_bwd_ids = batch.viterbi_fwd_ids.to(device).to(torch.long), batch.viterbi_bwd_ids.to(device).to(torch.long)
+        viterbi_fwd_ms, viterbi_bwd_ms = expand_lattice_masks(tokenizer, viterbi_fwd_ids, viterbi_bwd_ids, lengths, torch.ones_like(verbatim))
+        viterbi = [viterbi_fwd_ids, viterbi_fwd_ms, viterbi_bwd_ids, viterbi_bwd_ms]
+    return (input_ids, pos_ids, input_mask,
+            fwd_ids, fwd_ms, lengths,
+            bwd_ids, bwd_ms, bwd_lengths,
+            *viterbi,
+            mmask, emask, input_mask.to(torch.float), batch.text, ntokens)
+
+
+def trim_compact_batch(batch):
+    """
+    Drops the blocks and characters that are padding in every example of a collated `CompactLatticeExample` (or
+    `CompactViterbiLatticeExample`) batch: N becomes the most blocks and L the longest block of the batch (M at most L),
+    the lattice inputs of the model are gathered into the order of the smaller blocks and the (right aligned) backward
+    lattices keep their last L columns. Other batches are returned as they are.
+    """
+    if not isinstance(batch, (CompactLatticeExample, CompactViterbiLatticeExample)):
+        return batch
+    B, N, M, L = batch.fwd_ids.size()
+    # padding blocks come last
+    trimmed_N = max(int((batch.lengths > 0).sum(-1).max()), 1)
+    trimmed_L = max(int(batch.lengths.max()), 1)
+    trimmed_M = min(M, trimmed_L)
+    if trimmed_N == N and trimmed_L == L:
+        return batch
+    E = batch.input_ids.size(-1) // N - L
+    edges = Tokenizer.segment_edges(trimmed_L, trimmed_M, L, M)
+
+    def sequence(ids):
+        lattice, nodes = ids[:, :N * E].reshape(B, N, E), ids[:, N * E:].reshape(B, N, L)
+        return torch.cat([lattice[:, :trimmed_N, edges].reshape(B, -1), nodes[:, :trimmed_N, :trimmed_L].reshape(B, -1)], -1)
+    fwd = lambda ids: ids[:, :trimmed_N, :trimmed_M, :trimmed_L].contiguous()
+    bwd = lambda ids: ids[:, :trimmed_N, :trimmed_M, L - trimmed_L:].contiguous()
+    trimmed = dict(input_ids=sequence(batch.input_ids), pos_ids=sequence(batch.pos_ids),
+                   fwd_ids=fwd(batch.fwd_ids), lengths=batch.lengths[:, :trimmed_N].contiguous(),
+                   bwd_ids=bwd(batch.bwd_ids), ntokens=batch.ntokens[:, :trimmed_N].contiguous())
+    if isinstance(batch, CompactViterbiLatticeExample):
+        trimmed.update(viterbi_fwd_ids=fwd(batch.viterbi_fwd_ids), viterbi_bwd_ids=bwd(batch.viterbi_bwd_ids))
+    return batch._replace(**trimmed)
+
+
+def trimmed_collate(examples):
+    """
+    `default_collate` followed by `trim_compact_batch`.
+    """
+    return trim_compact_batch(default_collate(examples))
+
+
 def preprocess_language_modeling_with_lattices_dataset(
                     data_file: str,
                     cache_dir: str,
@@ -27,9 +164,10 @@ def preprocess_language_modeling_with_lattices_dataset(
                     max_blocks: int = None,
                     max_block_length: int = None,
                     max_unit_length: int = None,
-                    encoding: str = "utf-8"):
+                    encoding: str = "utf-8",
+                    compact_storage: bool = True):
     """
-    Computes the lattice representation and metadata of each sentence, and store it in a pickled file in a cache dir.
+    Computes the lattice representation and metadata of each sentence, and store it in the columnar cache (see `ColumnarCacheWriter`) in a cache dir.
     This method always clears the cache dir FIRST before writing anything into it.
 
     Args:
@@ -41,12 +179,13 @@ def preprocess_language_modeling_with_lattices_dataset(
         max_block_length: each lattice accounts for maximum of L characters
         max_unit_length: the maximum edge length size within each block
         encoding: the format of data_fiile
+        compact_storage: only store the ids, lengths and text (see `lattice_cache_example`)
     Returns:
 
     """
     clear_cache(cache_dir)
 
-    with open(data_file, encoding=encoding) as text_file:
+    with open(data_file, encoding=encoding) as text_file, ColumnarCacheWriter(cache_dir) as cache:
         for i, line in enumerate(tqdm(text_file)):
             text_str = line.strip()
             input_tokens = pretokenize(text_str)
@@ -62,26 +201,24 @@ def preprocess_language_modeling_with_lattices_dataset(
             binary_mask = torch.cat([mask, lm_mask], 0)
 
             # save to cache dir
-            item_name = os.path.join(cache_dir, f"{i}.pkl")
-
-            with open(item_name, "wb") as f:
-                pickle.dump(
-                    {"input_ids": ids.tolist() + lm_ids.tolist(),
-                     "pos_ids": pos_ids.tolist() + lm_pos_ids.tolist(),
-                     "input_mask": mask.tolist() + lm_mask.tolist(),
-                     "fwd_ids": fwd_ids.tolist(),
-                     "fwd_ms": fwd_ms.tolist(),
-                     "lengths": lengths.tolist(), # number of characters for each chunk
-                     "ntokens": ntokens, # number of tokens for each chunk
-                     "bwd_ids": bwd_ids.tolist(),
-                     "bwd_ms": bwd_ms.tolist(),
-                     "bwd_lengths": bwd_lengths.tolist(),
-                     "mmask": mmask.tolist(),
-                     "emask": emask.tolist(),
-                     "binary_mask": binary_mask.tolist(),
+            cache.append(lattice_cache_example(
+                    {"input_ids": torch.cat([ids, lm_ids]),
+                     "pos_ids": torch.cat([pos_ids, lm_pos_ids]),
+                     "input_mask": torch.cat([mask, lm_mask]),
+                     "fwd_ids": fwd_ids,
+                     "fwd_ms": fwd_ms,
+                     "lengths": lengths, # number of characters for each chunk
+                     "ntokens": torch.tensor(ntokens), # number of tokens for each chunk
+                     "bwd_ids": bwd_ids,
+                     "bwd_ms": bwd_ms,
+                     "bwd_lengths": bwd_lengths,
+                     "mmask": mmask,
+                     "emask": emask,
+                     "binary_mask": binary_mask,
                      "text_str": text_str,
                      "text": text_str,
-                     }, file=f)
+                     },
+                    input_tokenizer, verbatim=False, compact_storage=compact_storage))
 
 def preprocess_language_modeling_with_viterbi_lattices_dataset(
                     data_file: str,
@@ -91,13 +228,14 @@ def preprocess_language_modeling_with_viterbi_lattices_dataset(
                     max_blocks: int = None,
                     max_block_length: int = None,
                     max_unit_length: int = None,
-                    encoding: str = "utf-8"):
+                    encoding: str = "utf-8",
+                    compact_storage: bool = True):
     # transfer to CPU
     device = input_tokenizer.weights.weight.device
     input_tokenizer.to("cpu")
 
     clear_cache(cache_dir)
-    with open(data_file, encoding=encoding) as text_file:
+    with open(data_file, encoding=encoding) as text_file, ColumnarCacheWriter(cache_dir) as cache:
         for i, line in enumerate(tqdm(text_file)):
             text_str = line.strip()
             input_tokens = pretokenize(text_str)
@@ -117,25 +255,24 @@ def preprocess_language_modeling_with_viterbi_lattices_dataset(
             binary_mask = torch.cat([mask, lm_mask], 0)
 
             # save to cache dir
-            item_name = os.path.join(cache_dir, f"{i}.pkl")
-
-            with open(item_name, "wb") as f:
-                pickle.dump({"input_ids": ids.tolist() + lm_ids.tolist(),
-                     "pos_ids": pos_ids.tolist() + lm_pos_ids.tolist(),
-                     "input_mask": mask.tolist() + lm_mask.tolist(),
+            cache.append(lattice_cache_example(
+                    {"input_ids": torch.cat([ids, lm_ids]),
+                     "pos_ids": torch.cat([pos_ids, lm_pos_ids]),
+                     "input_mask": torch.cat([mask, lm_mask]),
                      "text":text_str,
-                     "fwd_ids": fwd_ids.tolist(),
-                     "fwd_ms": fwd_ms.tolist(),
-                     "lengths": lengths.tolist(),
-                     "ntokens": ntokens,
-                     "bwd_ids": bwd_ids.tolist(),
-                     "bwd_ms": bwd_ms.tolist(),
-                     "bwd_lengths": bwd_lengths.tolist(),
-                     "mmask": mmask.tolist(),
-                     "emask": emask.tolist(),
-                     "binary_mask": binary_mask.tolist(),
+                     "fwd_ids": fwd_ids,
+                     "fwd_ms": fwd_ms,
+                     "lengths": lengths,
+                     "ntokens": torch.tensor(ntokens),
+                     "bwd_ids": bwd_ids,
+                     "bwd_ms": bwd_ms,
+                     "bwd_lengths": bwd_lengths,
+                     "mmask": mmask,
+                     "emask": emask,
+                     "binary_mask": binary_mask,
                      "text_str": text_str,
-                     }, file=f)
+                     },
+                    input_tokenizer, verbatim=True, compact_storage=compact_storage))
     # transfer back to device
     input_tokenizer.to(device)
 
@@ -146,11 +283,12 @@ def preprocess_language_modeling_with_lattices_output_viterbi_dataset(args, data
                                                        output_vocab: Integerizer,
                                                        max_blocks: int = None,
                                                        max_block_length: int = None,
-                                                       max_unit_length: int = None):
+                                                       max_unit_length: int = None,
+                                                       compact_storage: bool = True):
     device = input_tokenizer.weights.weight.device
     input_tokenizer.to("cpu")
     clear_cache(cache_dir)
-    with open(data_file, encoding='utf_8') as textfile:
+    with open(data_file, encoding='utf_8') as textfile, ColumnarCacheWriter(cache_dir) as cache:
         for i, line in enumerate(tqdm(textfile)):
             text_str = line.strip()
             input_tokens = pretokenize(text_str)
@@ -171,30 +309,29 @@ def preprocess_language_modeling_with_lattices_output_viterbi_dataset(args, data
 
             viterbi_fwd_ids, viterbi_fwd_ms, _, viterbi_bwd_ids, viterbi_bwd_ms, _, _, _ = input_tokenizer.encode_packed_batch(viterbi_chunks, max_unit_length, max_block_length, compact=True, verbatim=True)
 
-            item_name = os.path.join(cache_dir, f"{i}.pkl")
-
-            with open(item_name, "wb") as f:
-                pickle.dump(
-                    {"input_ids": ids.tolist() + lm_ids.tolist(),
-                     "pos_ids": pos_ids.tolist() + lm_pos_ids.tolist(),
-                     "input_mask": mask.tolist() + lm_mask.tolist(),
+            # save to cache dir
+            cache.append(lattice_cache_example(
+                    {"input_ids": torch.cat([ids, lm_ids]),
+                     "pos_ids": torch.cat([pos_ids, lm_pos_ids]),
+                     "input_mask": torch.cat([mask, lm_mask]),
                      "text": text_str,
-                     "fwd_ids": fwd_ids.tolist(),
-                     "fwd_ms": fwd_ms.tolist(),
-                     "lengths": lengths.tolist(),
-                     "ntokens": ntokens,
-                     "bwd_ids": bwd_ids.tolist(),
-                     "bwd_ms": bwd_ms.tolist(),
-                     "bwd_lengths": bwd_lengths.tolist(),
-                     "mmask": mmask.tolist(),
-                     "emask": emask.tolist(),
-                     "binary_mask": binary_mask.tolist(),
+                     "fwd_ids": fwd_ids,
+                     "fwd_ms": fwd_ms,
+                     "lengths": lengths,
+                     "ntokens": torch.tensor(ntokens),
+                     "bwd_ids": bwd_ids,
+                     "bwd_ms": bwd_ms,
+                     "bwd_lengths": bwd_lengths,
+                     "mmask": mmask,
+                     "emask": emask,
+                     "binary_mask": binary_mask,
                      "text_str": text_str,
-                     "viterbi_fwd_ids": viterbi_fwd_ids.tolist(),
-                     "viterbi_fwd_ms": viterbi_fwd_ms.tolist(),
-                     "viterbi_bwd_ids": viterbi_bwd_ids.tolist(),
-                     "viterbi_bwd_ms": viterbi_bwd_ms.tolist()
-                     }, file=f)
+                     "viterbi_fwd_ids": viterbi_fwd_ids,
+                     "viterbi_fwd_ms": viterbi_fwd_ms,
+                     "viterbi_bwd_ids": viterbi_bwd_ids,
+                     "viterbi_bwd_ms": viterbi_bwd_ms
+                     },
+                    input_tokenizer, verbatim=False, compact_storage=compact_storage))
     input_tokenizer.to(device)
 
 
@@ -217,21 +354,25 @@ class LanguageModelingLatticeDataset(LazyDataset):
             "mmask"
             "emask"
             "binary_mask"
+        A compact cache (see `lattice_cache_example`) gives a `CompactLatticeExample` instead.
         """
-        return (torch.LongTensor(ex["input_ids"]),
-                torch.LongTensor(ex["pos_ids"]),
-                torch.LongTensor(ex["input_mask"]),
-                torch.LongTensor(ex["fwd_ids"]),
-                torch.FloatTensor(ex["fwd_ms"]),
-                torch.LongTensor(ex["lengths"]),
-                torch.LongTensor(ex["bwd_ids"]),
-                torch.FloatTensor(ex["bwd_ms"]),
-                torch.LongTensor(ex["bwd_lengths"]),
-                torch.LongTensor(ex["mmask"]),
-                torch.LongTensor(ex["emask"]),
-                torch.FloatTensor(ex["binary_mask"]),
+        if "fwd_ms" not in ex:
+            return CompactLatticeExample(ex["input_ids"], ex["pos_ids"], ex["fwd_ids"], ex["lengths"], ex["bwd_ids"],
+                                         ex["verbatim"], ex["text_str"], ex["ntokens"])
+        return (torch.as_tensor(ex["input_ids"], dtype=torch.long),
+                torch.as_tensor(ex["pos_ids"], dtype=torch.long),
+                torch.as_tensor(ex["input_mask"], dtype=torch.long),
+                torch.as_tensor(ex["fwd_ids"], dtype=torch.long),
+                torch.as_tensor(ex["fwd_ms"], dtype=torch.float),
+                torch.as_tensor(ex["lengths"], dtype=torch.long),
+                torch.as_tensor(ex["bwd_ids"], dtype=torch.long),
+                torch.as_tensor(ex["bwd_ms"], dtype=torch.float),
+                torch.as_tensor(ex["bwd_lengths"], dtype=torch.long),
+                torch.as_tensor(ex["mmask"], dtype=torch.long),
+                torch.as_tensor(ex["emask"], dtype=torch.long),
+                torch.as_tensor(ex["binary_mask"], dtype=torch.float),
                 ex["text_str"],
-                torch.LongTensor(ex["ntokens"]))
+                torch.as_tensor(ex["ntokens"], dtype=torch.long))
 
 
 class LanguageModelingLatticeOutputViterbiDataset(LazyDataset):
@@ -253,22 +394,27 @@ class LanguageModelingLatticeOutputViterbiDataset(LazyDataset):
             "mmask"
             "emask"
             "binary_mask"
+        A compact cache (see `lattice_cache_example`) gives a `CompactViterbiLatticeExample` instead.
         """
-        return (torch.LongTensor(ex["input_ids"]),
-                torch.LongTensor(ex["pos_ids"]),
-                torch.LongTensor(ex["input_mask"]),
-                torch.LongTensor(ex["fwd_ids"]),
-                torch.FloatTensor(ex["fwd_ms"]),
-                torch.LongTensor(ex["lengths"]),
-                torch.LongTensor(ex["bwd_ids"]),
-                torch.FloatTensor(ex["bwd_ms"]),
-                torch.LongTensor(ex["bwd_lengths"]),
-                torch.LongTensor(ex["viterbi_fwd_ids"]),
-                torch.FloatTensor(ex["viterbi_fwd_ms"]),
-                torch.LongTensor(ex["viterbi_bwd_ids"]),
-                torch.FloatTensor(ex["viterbi_bwd_ms"]),
-                torch.LongTensor(ex["mmask"]),
-                torch.LongTensor(ex["emask"]),
-                torch.FloatTensor(ex["binary_mask"]),
+        if "fwd_ms" not in ex:
+            return CompactViterbiLatticeExample(ex["input_ids"], ex["pos_ids"], ex["fwd_ids"], ex["lengths"], ex["bwd_ids"],
+                                                ex["verbatim"], ex["text_str"], ex["ntokens"],
+                                                ex["viterbi_fwd_ids"], ex["viterbi_bwd_ids"])
+        return (torch.as_tensor(ex["input_ids"], dtype=torch.long),
+                torch.as_tensor(ex["pos_ids"], dtype=torch.long),
+                torch.as_tensor(ex["input_mask"], dtype=torch.long),
+                torch.as_tensor(ex["fwd_ids"], dtype=torch.long),
+                torch.as_tensor(ex["fwd_ms"], dtype=torch.float),
+                torch.as_tensor(ex["lengths"], dtype=torch.long),
+                torch.as_tensor(ex["bwd_ids"], dtype=torch.long),
+                torch.as_tensor(ex["bwd_ms"], dtype=torch.float),
+                torch.as_tensor(ex["bwd_lengths"], dtype=torch.long),
+                torch.as_tensor(ex["viterbi_fwd_ids"], dtype=torch.long),
+                torch.as_tensor(ex["viterbi_fwd_ms"], dtype=torch.float),
+                torch.as_tensor(ex["viterbi_bwd_ids"], dtype=torch.long),
+                torch.as_tensor(ex["viterbi_bwd_ms"], dtype=torch.float),
+                torch.as_tensor(ex["mmask"], dtype=torch.long),
+                torch.as_tensor(ex["emask"], dtype=torch.long),
+                torch.as_tensor(ex["binary_mask"], dtype=torch.float),
                 ex["text_str"],
-                torch.LongTensor(ex["ntokens"]))
+                torch.as_tensor(ex["ntokens"], dtype=torch.long))
@@ -3,12 +3,11 @@ import json
 from tqdm import tqdm
 from bopt.core.integerize import Integerizer
 from bopt.core.tokenizer import Tokenizer
-from bopt.data.datasets import LazyDataset
+from bopt.data.datasets import ColumnarCacheWriter, LazyDataset
 from bopt.data.language_modeling.utils import clear_cache, viterbi_tokenize, pretokenize, pack_viterbi_chunks, \
     truncated_and_pad_packed_chunks, prefix_sum, load_segmentation_dictionary, use_gold_segmentations
 
 import os
-import pickle
 import torch
 import glob
 
@@ -43,7 +42,7 @@ def preprocess_language_modeling_with_unigram_dataset(args,
         segmentation_dictionary = load_segmentation_dictionary(*args.segmentation_dictionary)
     else:
         segmentation_dictionary = None
-    with open(data_file, encoding=encoding) as textfile:
+    with open(data_file, encoding=encoding) as textfile, ColumnarCacheWriter(cache_dir) as cache:
         for i, line in enumerate(tqdm(textfile)):
             text_str = line.strip()
             input_tokens = pretokenize(text_str)
@@ -80,10 +79,7 @@ def preprocess_language_modeling_with_unigram_dataset(args,
             mask = [int(id != input_tokenizer.pad_index) for id in input_ids]
 
             # log to file
-            item_name = os.path.join(cache_dir, f"{i}.pkl")
-
-            with open(item_name, "wb") as f:
-                pickle.dump(
+            cache.append(
                     {"input_ids": input_ids,
                      "pos_ids": pos_ids,
                      "input_mask": mask,
@@ -91,7 +87,7 @@ def preprocess_language_modeling_with_unigram_dataset(args,
                      "text": text_str,
                      "length": [length],  # in terms of characters
                      "ntokens": [ntokens]
-                     }, file=f)
+                     })
     msg = (f"Segmentation dictionary is {args.segmentation_dictionary}, {total_tokens} tokens, "
           f"{replaced_tokens} ({replaced_tokens / total_tokens}) replaced, "
           f"{is_gold_tokens} ({is_gold_tokens / total_tokens}) gold, "
@@ -122,7 +118,7 @@ def preprocess_language_modeling_with_unigram_node_dataset(data_file: str,
     
     clear_cache(cache_dir)
     
-    with open(data_file, encoding=encoding) as textfile:
+    with open(data_file, encoding=encoding) as textfile, ColumnarCacheWriter(cache_dir) as cache:
         for i, line in enumerate(tqdm(textfile)):
             text_str = line.strip()
             input_tokens = pretokenize(text_str)
@@ -156,9 +152,7 @@ def preprocess_language_modeling_with_unigram_node_dataset(data_file: str,
             mask = [int(id != input_tokenizer.pad_index) for id in input_ids]
 
             # log to file
-            item_name = os.path.join(cache_dir, f"{i}.pkl")
-            with open(item_name, "wb") as f:
-                pickle.dump(
+            cache.append(
                     {"input_ids": input_ids + [input_tokenizer.node_index for _ in input_ids],
                      "pos_ids": pos_ids + [pos_id + 1 for pos_id in pos_ids],
                      "input_mask": mask + mask,
@@ -166,7 +160,7 @@ def preprocess_language_modeling_with_unigram_node_dataset(data_file: str,
                      "text": text_str,
                      "length": [length], # in terms of characters
                      "ntokens": [ntokens]
-                     }, file=f)
+                     })
 
 
 
@@ -184,12 +178,12 @@ class LanguageModelingUnigramDataset(LazyDataset):
             "length"
             "ntokens"
         """
-        ret =  (torch.LongTensor(ex["input_ids"]),
-                torch.LongTensor(ex["pos_ids"]),
-                torch.LongTensor(ex["input_mask"]),
-                torch.LongTensor(ex["labels"]),
-                torch.LongTensor(ex["length"]),
-                torch.LongTensor(ex["ntokens"]),
+        ret =  (torch.as_tensor(ex["input_ids"], dtype=torch.long),
+                torch.as_tensor(ex["pos_ids"], dtype=torch.long),
+                torch.as_tensor(ex["input_mask"], dtype=torch.long),
+                torch.as_tensor(ex["labels"], dtype=torch.long),
+                torch.as_tensor(ex["length"], dtype=torch.long),
+                torch.as_tensor(ex["ntokens"], dtype=torch.long),
                 ex["text"])
         return ret
 
@@ -203,8 +197,7 @@ def tokenize_language_modeling_with_unigram_dataset(data_file: str, input_tokeni
             # viterbi segmentation
             fwd_ids, fwd_ms, lengths, bwd_ids, bwd_ms, bwd_lengths, mmask, emask = input_tokenizer.encode_batch(input_tokens, input_tokenizer.max_unit_length)
             fwd_ts = input_tokenizer.get_weights(fwd_ids)
-            max_log_alpha, _, backpointers = input_tokenizer.viterbi_algorithm(fwd_ts, fwd_ms, lengths)
-            log_alpha, _ = input_tokenizer.forward_algorithm(fwd_ts, fwd_ms, lengths)
+            max_log_alpha, backpointers, log_alpha = input_tokenizer.viterbi_forward_algorithm(fwd_ts, fwd_ms, lengths)
             word_ids = input_tokenizer.decode_backpointers(fwd_ids, lengths, backpointers)
             input_ids = sum(word_ids, [])
             input_subwords = [input_tokenizer.id2str(id, remove_csp=True) for id in input_ids]
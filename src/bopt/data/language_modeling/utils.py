@@ -6,11 +6,11 @@ from typing import List
 
 from bopt.core.tokenizer import Tokenizer
 from bopt.core.tokenizer.tokenization import PackedChunk
+from bopt.data.datasets import clear_cache_dir
 
 
 def clear_cache(cache_dir: str):
-    for f in glob.glob(f'{cache_dir}/*'):
-        os.remove(f)
+    clear_cache_dir(cache_dir)
 
 
 def pretokenize(text_str: str) -> List[str]:
@@ -41,15 +41,14 @@ def viterbi_tokenize(tokenizer: Tokenizer, tokens: List[str], remove_csp=False,
     """
     fwd_ids, fwd_ms, lengths, bwd_ids, bwd_ms, bwd_lengths, mmask, emask = tokenizer.encode_batch(tokens, tokenizer.max_unit_length, device=device)
     if tokenizer.mixture_count > 1:
-        _,_,_,_,_, fwd_ts = tokenizer(fwd_ids.unsqueeze(1), fwd_ms.unsqueeze(1), lengths.unsqueeze(1), bwd_ids.unsqueeze(1), bwd_ms.unsqueeze(1), bwd_lengths.unsqueeze(1), mmask, emask)
+        _,_,_,_,_, fwd_ts = tokenizer(fwd_ids.unsqueeze(1), fwd_ms.unsqueeze(1), lengths.unsqueeze(1))
     else:
         fwd_ts = tokenizer.get_weights(fwd_ids)
-    max_log_alpha, _, backpointers = tokenizer.viterbi_algorithm(fwd_ts, fwd_ms, lengths)
-    log_alpha, _ = tokenizer.forward_algorithm(fwd_ts, fwd_ms, lengths)
-    word_ids = tokenizer.decode_backpointers(fwd_ids, lengths, backpointers)
+    max_log_alpha, backpointers, log_alpha = tokenizer.viterbi_forward_algorithm(fwd_ts, fwd_ms, lengths)
+    word_ids, counts = tokenizer.viterbi_backtrace(fwd_ids, lengths, backpointers, padding_id=tokenizer.pad_index)
     if return_prob:
-        return [[tokenizer.id2str(id, remove_csp=remove_csp) for id in word_id] for word_id in word_ids], (max_log_alpha - log_alpha).exp().reshape(-1).tolist()
-    return [[tokenizer.id2str(id, remove_csp=remove_csp) for id in word_id] for word_id in word_ids]
+        return tokenizer.decode_ids(word_ids, counts, remove_csp=remove_csp), (max_log_alpha - log_alpha).exp().reshape(-1).tolist()
+    return tokenizer.decode_ids(word_ids, counts, remove_csp=remove_csp)
 
 def pack_viterbi_chunks(kept_chunks, input_tokenizations) -> List[PackedChunk]:
     """
@@ -18,11 +18,8 @@ def marginal(m=None, **kwargs):
 def ent(ent=None, **kwargs):
     return ent.tolist()
 
-def lm_marginal(tokenizer=None, fwd_ids=None, fwd_ms=None, lengths=None, bwd_ids=None, bwd_ms=None, bwd_lengths=None, mmask=None, emask=None, global_mask=None, output_fwd_ts=None, output_bwd_ts=None, **kwargs):
-    ent, a, m, c = tokenizer(fwd_ids, fwd_ms, lengths,
-                             bwd_ids, bwd_ms, bwd_lengths,
-                             mmask, emask, None, lm=True, lm_mask=global_mask, fwd_ts=output_fwd_ts,
-                             bwd_ts=output_bwd_ts)
+def lm_marginal(tokenizer=None, fwd_ids=None, fwd_ms=None, lengths=None, global_mask=None, output_fwd_ts=None, bias_kwargs=None, **kwargs):
+    ent, a, m, c = tokenizer(fwd_ids, fwd_ms, lengths, None, lm=True, fwd_ts=output_fwd_ts, **(bias_kwargs or dict(lm_mask=global_mask)))
     return m.tolist()
 
 def marginal_count(om_list=None, **kwargs):
@@ -1,7 +1,6 @@
 import code
 import csv
 import os
-import pickle
 from pathlib import Path
 
 import torch
@@ -14,7 +13,7 @@ from tqdm import tqdm
 from bopt.core.integerize import Integerizer
 from bopt.core.tokenizer import Tokenizer
 from bopt.core.tokenizer.tokenization import TokenizationMixin
-from bopt.data.datasets import LazyDataset
+from bopt.data.datasets import ColumnarCacheWriter, LazyDataset
 from bopt.data.language_modeling.utils import clear_cache, truncated_and_pad_packed_chunks, viterbi_tokenize, \
     pack_viterbi_chunks, use_gold_segmentations, load_segmentation_dictionary
 from bopt.data.utils import load_vocab, load_weights, constant_initializer
@@ -68,7 +67,7 @@ def preprocess_morpheme_prediction_with_unigram_dataset(args, data_file: str,
 
     ws = Whitespace()
     dummy_prefix = args.dummy_prefix if args.dummy_prefix is not None else ""
-    with open(data_file, encoding='utf_8') as csvfile:
+    with open(data_file, encoding='utf_8') as csvfile, ColumnarCacheWriter(cache_dir) as cache:
         reader = csv.DictReader(csvfile,fieldnames=["id", "label", "text", "features", "segmentation"])
         for i, row in enumerate(tqdm(reader)):
             # pretokenize
@@ -111,16 +110,13 @@ def preprocess_morpheme_prediction_with_unigram_dataset(args, data_file: str,
             for j, out_id in enumerate(output_labels):
                 label_ids[j] = out_id
 
-            item_name = os.path.join(cache_dir, f"{i}.pkl")
-            with open(item_name, "wb") as f:
-                pickle.dump(
+            cache.append(
                     {"input_ids": input_ids,
                      "pos_ids": pos_ids,
                      "input_mask": mask,
                      "labels_ids": label_ids,
                      "text":text_str,
-                }, file=f
-                )
+                })
     msg = (f"Segmentation dictionary is {args.segmentation_dictionary}, {total_tokens} tokens, "
            f"{replaced_tokens} ({replaced_tokens / total_tokens}) replaced, "
            f"{is_gold_tokens} ({is_gold_tokens / total_tokens}) gold, "
@@ -149,7 +145,7 @@ class MorphemePredictionUnigramDataset(LazyDataset):
             "labels_ids"
             "text"
         """
-        return (torch.LongTensor(ex["input_ids"]),
-                torch.LongTensor(ex["pos_ids"]),
-                torch.LongTensor(ex["input_mask"]),
-                torch.LongTensor(ex["labels_ids"]))
+        return (torch.as_tensor(ex["input_ids"], dtype=torch.long),
+                torch.as_tensor(ex["pos_ids"], dtype=torch.long),
+                torch.as_tensor(ex["input_mask"], dtype=torch.long),
+                torch.as_tensor(ex["labels_ids"], dtype=torch.long))
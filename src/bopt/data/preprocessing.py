@@ -0,0 +1,115 @@
+import copy
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Tuple
+
+import torch
+from tqdm import tqdm
+
+from bopt.core.tokenizer import Tokenizer
+from bopt.data.datasets import ColumnarCache, clear_cache_dir, merge_columnar_caches
+
+PARTS_MANIFEST = "parts.json"
+
+# the preprocessing function and the tokenizer of a worker process, shipped once by `initialize_worker`
+worker = {}
+
+
+def initialize_worker(preprocess: Callable, tokenizer: Tokenizer) -> None:
+    # one process per core, the (small) tensor ops of the preprocessing shouldn't spawn threads of their own
+    torch.set_num_threads(1)
+    worker["preprocess"] = preprocess
+    worker["tokenizer"] = tokenizer
+
+
+def preprocess_part(data_file: str, start: int, end: int, part_dir: str, args: tuple, kwargs: dict) -> None:
+    os.makedirs(part_dir, exist_ok=True)
+    part_file = f"{part_dir}.txt"
+    with open(data_file, "rb") as f, open(part_file, "wb") as part:
+        f.seek(start)
+        part.write(f.read(end - start))
+    worker["preprocess"](part_file, part_dir, worker["tokenizer"], *args, **kwargs)
+    os.remove(part_file)
+
+
+def line_ranges(data_file: str, lines_per_part: int) -> List[Tuple[int, int]]:
+    """
+    Byte ranges of consecutive `lines_per_part` lines of `data_file`.
+    """
+    ranges = []
+    start = end = count = 0
+    with open(data_file, "rb") as f:
+        for line in f:
+            end += len(line)
+            count += 1
+            if count == lines_per_part:
+                ranges.append((start, end))
+                start, count = end, 0
+    if count > 0:
+        ranges.append((start, end))
+    return ranges
+
+
+def merge_meta(cache_dir: str, parts: List[str]) -> None:
+    """
+    Sums the counts of the `{cache_dir}.meta.json` summaries some preprocessing functions write, if the parts have them.
+    """
+    metas = []
+    for part in parts:
+        if os.path.exists(os.path.join(cache_dir, f"{part}.meta.json")):
+            with open(os.path.join(cache_dir, f"{part}.meta.json"), "rt") as f:
+                metas.append(json.load(f))
+    if not metas:
+        return
+    meta = {key: sum(m[key] for m in metas) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+            for key, value in metas[0].items()}
+    with open(f"{cache_dir}.meta.json", "wt") as f:
+        print(json.dumps(meta, indent=4), file=f)
+
+
+def preprocess_in_parts(preprocess: Callable, data_file: str, cache_dir: str, tokenizer: Tokenizer, *args,
+                        num_workers: int = 1, lines_per_part: int = 10000, key: str = None, **kwargs) -> None:
+    """
+    Runs `preprocess(data_file, cache_dir, tokenizer, *args, **kwargs)`, one of the `preprocess_*_dataset` functions
+    that encode their input one line at a time into a columnar cache, on parts of `lines_per_part` lines of the data
+    file in a pool of `num_workers` processes. The tokenizer (on cpu) and `preprocess` (which must be picklable, e.g. a
+    `functools.partial` for the functions taking `args` first) are sent once to every worker.
+
+    Every part is a columnar cache in a `part-XXXXX` subdirectory of `cache_dir`, the index of `cache_dir` lists their
+    shards in the order of the file (see `merge_columnar_caches`), so the examples are in the same order as with a
+    single process. A part is done once its index is written, an interrupted run resumes with the parts that aren't,
+    as long as the data file, `lines_per_part` and `key` (e.g. the fingerprint of the arguments) are unchanged
+    (`parts.json`).
+
+    With `num_workers <= 1` this is just `preprocess`.
+    """
+    if num_workers <= 1:
+        preprocess(data_file, cache_dir, tokenizer, *args, **kwargs)
+        return
+    stat = os.stat(data_file)
+    manifest = {"data_file": os.path.abspath(data_file), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "lines_per_part": lines_per_part, "key": key}
+    manifest_file = os.path.join(cache_dir, PARTS_MANIFEST)
+    previous = None
+    if os.path.exists(manifest_file):
+        with open(manifest_file, "rt") as f:
+            previous = json.load(f)
+    if previous != manifest:
+        clear_cache_dir(cache_dir)
+        with open(manifest_file, "wt") as f:
+            json.dump(manifest, f)
+
+    ranges = line_ranges(data_file, lines_per_part)
+    parts = [f"part-{i:05d}" for i in range(len(ranges))]
+    todo = [i for i, part in enumerate(parts) if not ColumnarCache.exists(os.path.join(cache_dir, part))]
+    if todo:
+        tokenizer = copy.deepcopy(tokenizer).to("cpu")
+        # spawn: forking a process that has used cuda isn't safe
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=initialize_worker, initargs=(preprocess, tokenizer)) as executor:
+            futures = [executor.submit(preprocess_part, data_file, *ranges[i], os.path.join(cache_dir, parts[i]), args, kwargs) for i in todo]
+            for future in tqdm(as_completed(futures), total=len(futures), desc=f"{len(todo)} of {len(parts)} parts"):
+                future.result()
+    merge_meta(cache_dir, parts)
+    merge_columnar_caches(cache_dir, parts)
@@ -1,7 +1,6 @@
 import code
 import csv
 import os
-import pickle
 from pathlib import Path
 
 import torch
@@ -14,7 +13,7 @@ from tqdm import tqdm
 from bopt.core.integerize import Integerizer
 from bopt.core.tokenizer import Tokenizer
 from bopt.core.tokenizer.tokenization import TokenizationMixin
-from bopt.data.datasets import LazyDataset
+from bopt.data.datasets import ColumnarCacheWriter, LazyDataset
 from bopt.data.language_modeling.utils import clear_cache, truncated_and_pad_packed_chunks
 from bopt.data.utils import load_vocab, load_weights, constant_initializer
 
@@ -39,7 +38,7 @@ def preprocess_sentiment_analysis_with_lattices_dataset(args,
 
     E = (max_block_length * (max_block_length + 1)) // 2 - ((max_block_length - max_unit_length) * (max_block_length - max_unit_length + 1)) // 2
     ws = Whitespace()
-    with open(data_file, encoding='utf_8' if not args.encoding else args.encoding) as csvfile:
+    with open(data_file, encoding='utf_8' if not args.encoding else args.encoding) as csvfile, ColumnarCacheWriter(cache_dir) as cache:
         reader = csv.DictReader(csvfile,fieldnames=["label", "text"])
         for i, row in enumerate(tqdm(reader)):
             # pretokenize
@@ -75,26 +74,23 @@ def preprocess_sentiment_analysis_with_lattices_dataset(args,
                 print("########")
             ## FOR DEBUGGING ONLY ###
 
-            item_name = os.path.join(cache_dir, f"{i}.pkl")
-            with open(item_name, "wb") as f:
-                pickle.dump(
-                    {"input_ids": ids.tolist(),
-                     "pos_ids": pos_ids.tolist(),
-                     "input_mask": mask.tolist(),
-                     "labels_ids": label_ids.tolist(),
+            cache.append(
+                    {"input_ids": ids,
+                     "pos_ids": pos_ids,
+                     "input_mask": mask,
+                     "labels_ids": label_ids,
                      "text":text_str,
-                     "fwd_ids": fwd_ids.tolist(),
-                     "fwd_ms": fwd_ms.tolist(),
-                     "lengths": lengths.tolist(),
-                     "bwd_ids": bwd_ids.tolist(),
-                     "bwd_ms": bwd_ms.tolist(),
-                     "bwd_lengths": bwd_lengths.tolist(),
+                     "fwd_ids": fwd_ids,
+                     "fwd_ms": fwd_ms,
+                     "lengths": lengths,
+                     "bwd_ids": bwd_ids,
+                     "bwd_ms": bwd_ms,
+                     "bwd_lengths": bwd_lengths,
                      "max_blocks": max_blocks,
                      "max_block_length": max_block_length,
                      "max_unit_length": max_unit_length,
                      "E": E
-                }, file=f
-                )
+                })
 
 def tmask(max_blocks, max_unit_length, E):
     if (max_blocks, max_unit_length, E) not in TMASK_CACHE:
@@ -127,16 +123,16 @@ class SentimentAnalysisLatticeDataset(LazyDataset):
             # "emask"
             # "tmask"
         """
-        return (torch.LongTensor(ex["input_ids"]),
-                torch.LongTensor(ex["pos_ids"]),
-                torch.LongTensor(ex["input_mask"]),
-                torch.LongTensor(ex["labels_ids"]),
-                torch.LongTensor(ex["fwd_ids"]),
-                torch.FloatTensor(ex["fwd_ms"]),
-                torch.LongTensor(ex["lengths"]),
-                torch.LongTensor(ex["bwd_ids"]),
-                torch.FloatTensor(ex["bwd_ms"]),
-                torch.LongTensor(ex["bwd_lengths"]),
+        return (torch.as_tensor(ex["input_ids"], dtype=torch.long),
+                torch.as_tensor(ex["pos_ids"], dtype=torch.long),
+                torch.as_tensor(ex["input_mask"], dtype=torch.long),
+                torch.as_tensor(ex["labels_ids"], dtype=torch.long),
+                torch.as_tensor(ex["fwd_ids"], dtype=torch.long),
+                torch.as_tensor(ex["fwd_ms"], dtype=torch.float),
+                torch.as_tensor(ex["lengths"], dtype=torch.long),
+                torch.as_tensor(ex["bwd_ids"], dtype=torch.long),
+                torch.as_tensor(ex["bwd_ms"], dtype=torch.float),
+                torch.as_tensor(ex["bwd_lengths"], dtype=torch.long),
                 tmask(ex["max_blocks"], ex["max_unit_length"], ex["E"]),
                 ex["text"]
                 )
\ No newline at end of file
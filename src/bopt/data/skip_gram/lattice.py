@@ -5,14 +5,12 @@ from collections import defaultdict
 from tqdm import tqdm
 from bopt.core.integerize import Integerizer
 from bopt.core.tokenizer import Tokenizer
-from bopt.data.datasets import LazySkipGramDataset
+from bopt.data.datasets import ColumnarCacheWriter, LazySkipGramDataset
 from bopt.data.language_modeling.utils import clear_cache
 
 import os
-import pickle
 import torch
 
-from bopt.data.skip_gram.utils import sft
 
 """
 MAX_BLOCKS = 10 # N: Number of words roughly in a sentence
@@ -32,7 +30,7 @@ def preprocess_skip_gram_with_lattices_dataset(args,
                     max_unit_length: int = None,
                     encoding: str = "utf-8"):
     """
-    Computes the lattice representation and metadata of each sentence, and store it in a pickled file in a cache dir.
+    Computes the lattice representation and metadata of each sentence, and store it in the columnar cache (see `ColumnarCacheWriter`) in a cache dir.
     This method always clears the cache dir FIRST before writing anything into it.
 
     Args:
@@ -50,7 +48,7 @@ def preprocess_skip_gram_with_lattices_dataset(args,
     clear_cache(cache_dir)
     skip_gram_counts = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
     words = set()
-    with open(data_file, encoding=encoding) as text_file:
+    with open(data_file, encoding=encoding) as text_file, ColumnarCacheWriter(cache_dir) as cache:
         # get skip-gram statistics as well as all the words
         for i, line in enumerate(tqdm(text_file)):
             text_str = line.strip()
@@ -69,24 +67,21 @@ def preprocess_skip_gram_with_lattices_dataset(args,
             # binary_mask = torch.cat([mask, lm_mask], 0)
 
             # save to cache dir
-            item_name = os.path.join(cache_dir, f"{i}.pkl")
-
-            with open(item_name, "wb") as f:
-                pickle.dump(
-                    {"word_ids": ids.tolist(),
-                     "lm_ids": lm_ids.tolist(),
-                     "word_pos_ids": pos_ids.tolist(),
-                     "lm_pos_ids": lm_pos_ids.tolist(),
-                     "word_mask": mask.tolist(),
-                     "lm_mask": lm_mask.tolist(),
-                     "fwd_ids": fwd_ids.tolist(),
-                     "fwd_ms": fwd_ms.tolist(),
-                     "lengths": lengths.tolist(), # number of characters for each chunk
-                     "bwd_ids": bwd_ids.tolist(),
-                     "bwd_ms": bwd_ms.tolist(),
-                     "bwd_lengths": bwd_lengths.tolist(),
+            cache.append(
+                    {"word_ids": ids,
+                     "lm_ids": lm_ids,
+                     "word_pos_ids": pos_ids,
+                     "lm_pos_ids": lm_pos_ids,
+                     "word_mask": mask,
+                     "lm_mask": lm_mask,
+                     "fwd_ids": fwd_ids,
+                     "fwd_ms": fwd_ms,
+                     "lengths": lengths, # number of characters for each chunk
+                     "bwd_ids": bwd_ids,
+                     "bwd_ms": bwd_ms,
+                     "bwd_lengths": bwd_lengths,
                      "word": word,
-                     }, file=f)
+                     })
         with open(f"{cache_dir}.index.json", "wt") as index_file:
             json.dump({"counts": skip_gram_counts,
                        "words": words,
@@ -98,13 +93,14 @@ class SkipGramLatticeDataset(LazySkipGramDataset):
 
     def encode(self, ex, index):
         dist, src, tgt, i, max_block_length = index
-        return (torch.LongTensor(ex["src"]["word_ids"] + ex["tgt"]["word_ids"] + ex["src"]["lm_ids"] + ex["tgt"]["lm_ids"]),
-                torch.LongTensor(ex["src"]["word_pos_ids"] + sft(ex["tgt"]["word_pos_ids"], max_block_length) + ex["src"]["lm_pos_ids"] + sft(ex["tgt"]["lm_pos_ids"], max_block_length)),
-                torch.LongTensor(ex["src"]["word_mask"] + ex["tgt"]["word_mask"] + ex["src"]["lm_mask"] + ex["tgt"]["lm_mask"]),
-                torch.LongTensor(ex["src"]["fwd_ids"] + ex["tgt"]["fwd_ids"]),
-                torch.LongTensor(ex["src"]["fwd_ms"] + ex["tgt"]["fwd_ms"]),
-                torch.LongTensor(ex["src"]["lengths"] + [ex["tgt"]["lengths"][0]]),
-                torch.LongTensor(ex["src"]["bwd_ids"] + ex["tgt"]["bwd_ids"]),
-                torch.LongTensor(ex["src"]["bwd_ms"] + ex["tgt"]["bwd_ms"]),
-                torch.LongTensor(ex["src"]["bwd_lengths"] + ex["tgt"]["bwd_lengths"]),
+        src, tgt = ex["src"], ex["tgt"]
+        return (torch.cat([src["word_ids"], tgt["word_ids"], src["lm_ids"], tgt["lm_ids"]]).long(),
+                torch.cat([src["word_pos_ids"], tgt["word_pos_ids"] + max_block_length, src["lm_pos_ids"], tgt["lm_pos_ids"] + max_block_length]).long(),
+                torch.cat([src["word_mask"], tgt["word_mask"], src["lm_mask"], tgt["lm_mask"]]).long(),
+                torch.cat([src["fwd_ids"], tgt["fwd_ids"]]).long(),
+                torch.cat([src["fwd_ms"], tgt["fwd_ms"]]).long(),
+                torch.cat([src["lengths"], tgt["lengths"][:1]]).long(),
+                torch.cat([src["bwd_ids"], tgt["bwd_ids"]]).long(),
+                torch.cat([src["bwd_ms"], tgt["bwd_ms"]]).long(),
+                torch.cat([src["bwd_lengths"], tgt["bwd_lengths"]]).long(),
                 f'{ex["src"]["word"]} {ex["tgt"]["word"]}')
\ No newline at end of file
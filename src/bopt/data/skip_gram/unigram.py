@@ -5,16 +5,14 @@ from collections import defaultdict
 from tqdm import tqdm
 from bopt.core.integerize import Integerizer
 from bopt.core.tokenizer import Tokenizer
-from bopt.data.datasets import LazyDataset, LazySkipGramDataset
+from bopt.data.datasets import ColumnarCacheWriter, LazyDataset, LazySkipGramDataset
 from bopt.data.language_modeling.utils import clear_cache, viterbi_tokenize, pretokenize, pack_viterbi_chunks, \
     truncated_and_pad_packed_chunks, prefix_sum, load_segmentation_dictionary, use_gold_segmentations
 
 import os
-import pickle
 import torch
 import glob
 
-from bopt.data.skip_gram.utils import sft
 
 """
 MAX_BLOCKS = 10 # N: Number of words roughly in a sentence
@@ -48,7 +46,7 @@ def preprocess_skip_gram_with_unigram_dataset(args,
         segmentation_dictionary = None
     skip_gram_counts = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
     words = set()
-    with open(data_file, encoding=encoding) as text_file:
+    with open(data_file, encoding=encoding) as text_file, ColumnarCacheWriter(cache_dir) as cache:
         # get skip-gram statistics as well as all the words
         for i, line in enumerate(tqdm(text_file)):
             text_str = line.strip()
@@ -94,10 +92,7 @@ def preprocess_skip_gram_with_unigram_dataset(args,
             mask = [int(id != input_tokenizer.pad_index) for id in input_ids]
 
             # log to file
-            item_name = os.path.join(cache_dir, f"{i}.pkl")
-
-            with open(item_name, "wb") as f:
-                pickle.dump(
+            cache.append(
                     {"input_ids": input_ids,
                      "pos_ids": pos_ids,
                      "input_mask": mask,
@@ -105,7 +100,7 @@ def preprocess_skip_gram_with_unigram_dataset(args,
                      "word": word,
                      "length": [length],  # in terms of characters
                      "n_subwords": len(viterbi_chunks[0]),
-                     }, file=f)
+                     })
         with open(f"{cache_dir}.index.json", "wt") as index_file:
             json.dump({"counts": skip_gram_counts,
                        "words": words,
@@ -142,13 +137,14 @@ class SkipGramUnigramDataset(LazySkipGramDataset):
             "ntokens"
         """
         dist, src, tgt, i, max_block_length = index
-        labels = [-100 for _ in ex["src"]["labels"]] + ex["tgt"]["labels"][1:] + [-100]
-        labels[ex["src"]["n_subwords"]-1] = ex["tgt"]["labels"][0]
-        ret =  (torch.LongTensor(ex["src"]["input_ids"] + ex["tgt"]["input_ids"]),
-                torch.LongTensor(ex["src"]["pos_ids"] + sft(ex["tgt"]["pos_ids"], max_block_length)),
-                torch.LongTensor(ex["src"]["input_mask"] + ex["tgt"]["input_mask"]),
-                torch.LongTensor(labels),
-                torch.LongTensor([ex["tgt"]["length"][0]]),
+        src, tgt = ex["src"], ex["tgt"]
+        labels = torch.cat([torch.full_like(src["labels"], -100), tgt["labels"][1:], torch.full_like(tgt["labels"][:1], -100)]).long()
+        labels[src["n_subwords"]-1] = tgt["labels"][0]
+        ret =  (torch.cat([src["input_ids"], tgt["input_ids"]]).long(),
+                torch.cat([src["pos_ids"], tgt["pos_ids"] + max_block_length]).long(),
+                torch.cat([src["input_mask"], tgt["input_mask"]]).long(),
+                labels,
+                tgt["length"][:1].long(),
                 torch.LongTensor([1]),
                 f'{ex["src"]["word"]} {ex["tgt"]["word"]}')
         return ret
@@ -134,15 +134,14 @@ def morpheme_prediction_lattice_loop(args, dataloader, tokenizer, model, device,
                         packed_chunks.append([t])
                 gold_chunks, _ = pack_viterbi_chunks(packed_chunks, gold_tokens_in_vocab)
                 # encode the chunks into lattice / serial versions
-                gold_fwd_ids, gold_fwd_ms, gold_lengths, gold_bwd_ids, gold_bwd_ms, gold_bwd_lengths, gold_mmask, gold_emask = tokenizer.encode_packed_batch(gold_chunks, args.max_unit_length, args.max_block_length, compact=False, verbatim=True, device=input_ids.device)
-                all_fwd_ids, all_fwd_ms, all_lengths, all_bwd_ids, all_bwd_ms, all_bwd_lengths, all_mmask, all_emask = tokenizer.encode_packed_batch(packed_chunks, args.max_unit_length, args.max_block_length, compact=False, verbatim=False, device=input_ids.device)
+                gold_fwd_ids, gold_fwd_ms, gold_lengths, gold_bwd_ids, gold_bwd_ms, gold_bwd_lengths, gold_mmask, gold_emask = tokenizer.encode_packed_batch(gold_chunks, args.max_unit_length, args.max_block_length, compact=True, verbatim=True, device=input_ids.device)
+                all_fwd_ids, all_fwd_ms, all_lengths, all_bwd_ids, all_bwd_ms, all_bwd_lengths, all_mmask, all_emask = tokenizer.encode_packed_batch(packed_chunks, args.max_unit_length, args.max_block_length, compact=True, verbatim=False, device=input_ids.device)
 
                 # path marginal
                 if args.mixture_count == 1:
                     all_fwd_ts = tokenizer.get_weights(all_fwd_ids)
-                    all_bwd_ts = tokenizer.get_weights(all_bwd_ids)
                 else:
-                    all_ent, all_a, all_m, all_c, all_ment, all_fwd_ts = tokenizer(all_fwd_ids.unsqueeze(1), all_fwd_ms.unsqueeze(1), all_lengths.unsqueeze(1), all_bwd_ids.unsqueeze(1), all_bwd_ms.unsqueeze(1), all_bwd_lengths.unsqueeze(1), all_mmask, all_emask)
+                    all_ent, all_a, all_m, all_c, all_ment, all_fwd_ts = tokenizer(all_fwd_ids.unsqueeze(1), all_fwd_ms.unsqueeze(1), all_lengths.unsqueeze(1))
 
                 gold_log_alphas, _,_ = tokenizer.viterbi_algorithm(all_fwd_ts, gold_fwd_ms, gold_lengths)
                 all_log_alphas, all_edge_alphas = tokenizer.forward_algorithm(all_fwd_ts, all_fwd_ms, all_lengths)
@@ -151,12 +150,11 @@ def morpheme_prediction_lattice_loop(args, dataloader, tokenizer, model, device,
                 # tok marginal
                 if args.mixture_count == 1:
                     B = len(gold_tokens_in_vocab)
-                    all_log_betas, all_edge_log_betas = tokenizer.forward_algorithm(all_bwd_ts, all_bwd_ms, all_bwd_lengths)
-                    all_edge_log_betas = all_edge_log_betas.reshape(B, -1, *all_edge_log_betas.size()[1:])[:,-1,...].flip(-1)
+                    all_log_betas, all_edge_log_betas = tokenizer.backward_algorithm(all_fwd_ts, all_fwd_ms, all_lengths)
 
                     triu_ones = torch.triu(torch.ones(args.max_unit_length, args.max_block_length, dtype=torch.bool).to(device), diagonal=0)
                     ea = all_edge_alphas[triu_ones[None, ...].expand(B, -1, -1)].reshape(B, -1)  # [B, E] where E  = L (L+1) / 2
-                    eb = all_edge_log_betas[triu_ones.flip(-1)[None, ...].expand(B, -1, -1)].reshape(B, -1)  # [B, L, E]
+                    eb = all_edge_log_betas[triu_ones[None, ...].expand(B, -1, -1)].reshape(B, -1)  # [B, E]
                     td = tokenizer.get_weights(all_fwd_ids)[triu_ones[None, ...].expand(B, -1, -1)].reshape(B, -1)  # [B, E]
                     ms = gold_fwd_ms[triu_ones[None, ...].expand(B, -1, -1)].reshape(B, -1)  # [B, E]
                     tok_marginal += (ea + eb - td - all_log_alphas[:,None]).exp()[ms.to(torch.bool)].sum().item()
@@ -7,40 +7,64 @@ import torch
 from tqdm import tqdm
 
 from bopt.core.utils import increasing_roll_left, increasing_roll_right, forever_generator
+from bopt.data.language_modeling.lattice import expand_compact_batch
 from bopt.data.logging.lattice_loggers import LOGGERS
 
 INF = 1e9
 DEBUG = False
 
-def morpheme_prediction_lattice_step(args, batch, tokenizer, model, device, eval=False):
+def pruning(args):
+    return args.vopt and (args.prune_threshold is not None or args.prune_top_k is not None)
+
+def node_log_probs(args, model, indices, **model_kwargs):
+    """
+    Log probabilities [batch, NL, M] of the candidate output units `indices` [batch, NL, M] at the last NL positions, gathered
+    from a log_softmax over the output vocabulary or, with --candidate_output_head, scored without keeping the [batch, NL, V]
+    logits (see `BertLMPredictionHead.candidate_log_probs`).
+    """
+    if args.candidate_output_head:
+        return model(**model_kwargs, return_dict=True, output_candidates=indices)["logits"]
+    logits = model(**model_kwargs, return_dict=True)["logits"]
+    return torch.gather(torch.log_softmax(logits[:, -indices.size(1):, :], -1), -1, indices)
+
+def morpheme_prediction_lattice_inputs(args, batch, tokenizer, device):
+    """
+    Positional and keyword arguments of the tokenizer call of `morpheme_prediction_lattice_step` for `batch`.
+    """
     batch = [t.to(device) if isinstance(t, torch.Tensor) else t for t in batch]
-    input_ids, pos_ids, input_mask, label_ids, fwd_ids, fwd_ms, lengths, bwd_ids, bwd_ms_c, bwd_lengths, tmask, text = batch
-    batch_size, N, M, L = fwd_ids.size()
-    mmask, emask = tokenizer.parallel_backward_mask(L, M, device)
-    mmask = mmask[None, None, ...].expand(batch_size, 1, *mmask.size())
-    emask = emask[None, None, ...].expand(batch_size, 1, *emask.size())
+    fwd_ids, fwd_ms, lengths, tmask = batch[4], batch[5], batch[6], batch[10]
+    return (fwd_ids, fwd_ms, lengths, tmask), dict(marginal_temperature=args.marginal_temperature)
 
-    # expand bwd_ids and bwd_ms
-    bwd_ids = (bwd_ids.unsqueeze(2) * emask.to(torch.long) + tokenizer.pad_index * (1-emask.to(torch.long))).reshape(batch_size, N * L, M, L)
-    bwd_ms = (bwd_ms_c.unsqueeze(2) * emask + mmask).reshape(batch_size, N * L, M, L)
+def morpheme_prediction_lattice_step(args, batch, tokenizer, model, device, eval=False, lattice=None):
+    batch = [t.to(device) if isinstance(t, torch.Tensor) else t for t in batch]
+    input_ids, pos_ids, input_mask, label_ids, fwd_ids, fwd_ms, lengths, bwd_ids, bwd_ms_c, bwd_lengths, tmask, text = batch
 
     # dp lattice if necessasry
     ent, a, m, c = None, None, None, None
     if args.vopt:
         if args.mixture_count > 1:
-            ent, a, m, c, ment, _ = tokenizer(fwd_ids, fwd_ms, lengths,
-                                     bwd_ids, bwd_ms, bwd_lengths,
-                                     mmask, emask, tmask, marginal_temperature=args.marginal_temperature)
+            ent, a, m, c, ment, _ = tokenizer(fwd_ids, fwd_ms, lengths, tmask, marginal_temperature=args.marginal_temperature)
         else:
-            ent, a, m, c = tokenizer(fwd_ids, fwd_ms, lengths,
-                                     bwd_ids, bwd_ms, bwd_lengths,
-                                     mmask, emask, tmask, marginal_temperature=args.marginal_temperature)
+            ent, a, m, c = (lattice or tokenizer)(fwd_ids, fwd_ms, lengths, tmask, marginal_temperature=args.marginal_temperature)
+
+    # drop the unlikely edges from the model inputs, the labeled positions are always kept
+    index = None
+    if pruning(args):
+        if args.mixture_count > 1:
+            raise ValueError("pruning does not support mixtures of lattices")
+        keep = tokenizer.prune_edges(m, fwd_ms, lengths, threshold=args.prune_threshold, top_k=args.prune_top_k) | (label_ids != -100)
+        a, (input_ids, pos_ids, input_mask, model_label_ids), index = tokenizer.repack(keep, a, (input_ids, pos_ids, input_mask, label_ids), (tokenizer.pad_index, 0, 0, -100))
+    else:
+        model_label_ids = label_ids
 
     # run model
-    losses = model(input_ids=input_ids, position_ids=pos_ids, labels=label_ids, attn_bias=a if args.vopt else None, output_attentions=args.log_attention_statistics and eval, mixture_bias=args.mixture_count > 1)
+    losses = model(input_ids=input_ids, position_ids=pos_ids, labels=model_label_ids, attn_bias=a if args.vopt else None, output_attentions=args.log_attention_statistics and eval, mixture_bias=args.mixture_count > 1)
     # get loss
     loss = losses[0] * args.main_loss_multiplier
     logits = losses[1]
+    if index is not None:
+        # back to the positions of the labels
+        logits = logits.new_zeros(*label_ids.size(), logits.size(-1)).scatter(1, index.unsqueeze(-1).expand_as(logits), logits)
     if args.log_attention_statistics and eval:
         attentions = losses["attentions"]
         attentions = torch.stack(attentions, dim=0)
@@ -79,7 +103,30 @@ def morpheme_prediction_unigram_step(args, batch, tokenizer, model, device):
     return logits, loss, None, None, None, None, None, None, None
 
 
-def language_modeling_lattice_step(args, batch, tokenizer, model, device, eval=False, decode=False, decode_remove_csp=True, decode_remove_padding=True, unigram_expert=None, skip_gram=False):
+def language_modeling_bias_kwargs(args, tokenizer, binary_mask, N, L, M, device):
+    """
+    The mask of the lattice attention bias of a language modeling batch, the factorized lattice bias only needs the
+    token mask (the causal mask is implied).
+    """
+    if args.factorized_bias:
+        return None, dict(factorized=True, token_mask=binary_mask)
+    global_mask = (binary_mask.unsqueeze(1) * binary_mask.unsqueeze(2) # [batch_size, N * (E + L), N * (E + L)]
+                       * tokenizer.causal_mask(N, L, M, device=device).unsqueeze(0) # [1, N * (E + L), N * (E + L)]
+                   )
+    return global_mask, dict(lm_mask=global_mask)
+
+def language_modeling_lattice_inputs(args, batch, tokenizer, device, skip_gram=False):
+    """
+    Positional and keyword arguments of the tokenizer call of `language_modeling_lattice_step` for `batch`.
+    """
+    batch = [t.to(device) if isinstance(t, torch.Tensor) else t for t in expand_compact_batch(batch, tokenizer, device)]
+    fwd_ids, fwd_ms, lengths = batch[3], batch[4], batch[5]
+    binary_mask = batch[2] if skip_gram else batch[-3]
+    _, N, M, L = fwd_ids.size()
+    _, bias_kwargs = language_modeling_bias_kwargs(args, tokenizer, binary_mask, N, L, M, device)
+    return (fwd_ids, fwd_ms, lengths, None), dict(lm=True, marginal_temperature=args.marginal_temperature, **bias_kwargs)
+
+def language_modeling_lattice_step(args, batch, tokenizer, model, device, eval=False, decode=False, decode_remove_csp=True, decode_remove_padding=True, unigram_expert=None, skip_gram=False, lattice=None):
     """
 
     Args:
@@ -92,13 +139,14 @@ def language_modeling_lattice_step(args, batch, tokenizer, model, device, eval=F
         decode: whether to run in decode mode
         decode_remove_csp: whether to remove continuing subword prefixes in decode mode
         decode_remove_padding: whether to remove padding in decode mode
+        lattice: replaces the tokenizer for the lattice statistics of the inputs (see `StaleLatticePipeline`)
 
     Returns:
         None
     """
 
-    # expand batch
-    batch = [t.to(device) if isinstance(t, torch.Tensor) else t for t in batch]
+    # expand batch (masks of a compact cache are rebuilt on device)
+    batch = [t.to(device) if isinstance(t, torch.Tensor) else t for t in expand_compact_batch(batch, tokenizer, device)]
     # size references:
     #   input_ids/pos_ids/input_mask: [batch_size, N * (E + L)]
     #   fwd_ids, fwd_ms: [batch_size, N, M, L]
@@ -114,9 +162,6 @@ def language_modeling_lattice_step(args, batch, tokenizer, model, device, eval=F
          bwd_ids, bwd_ms_c, bwd_lengths,
          txt) = batch
         _batch_size, _N, _M, _L = fwd_ids.size()
-        mmask, emask = tokenizer.parallel_backward_mask(_L, _M, device)
-        mmask = mmask[None, None, ...].expand(_batch_size, 1, *mmask.size())
-        emask = emask[None, None, ...].expand(_batch_size, 1, *emask.size())
         binary_mask = input_mask
         ntokens = torch.ones((_batch_size, 1), device=device, dtype=torch.long)
     else:
@@ -136,17 +181,8 @@ def language_modeling_lattice_step(args, batch, tokenizer, model, device, eval=F
     # save some size variables, N is the number of blocks, M is the max edge length, and L is the block size
     batch_size, N, M, L = fwd_ids.size()
 
-
-    # expand bwd_ids and bwd_ms
-    bwd_ids = (bwd_ids.unsqueeze(2) * emask.to(torch.long) + tokenizer.pad_index * (1-emask.to(torch.long))).reshape(batch_size, N * L, M, L)
-    bwd_ms = (bwd_ms_c.unsqueeze(2) * emask + mmask).reshape(batch_size, N * L, M, L)
-
     # build some useful masks
-    bwd_connector = (bwd_ids == tokenizer.pad_index).to(torch.float)
-    bwd_connector[:, :, 1:, :] = 0  # [batch_size, N, M, L]
-    global_mask = (binary_mask.unsqueeze(1) * binary_mask.unsqueeze(2) # [batch_size, N * (E + L), N * (E + L)]
-                       * tokenizer.causal_mask(N, L, M, device=device).unsqueeze(0) # [1, N * (E + L), N * (E + L)]
-                   )
+    global_mask, bias_kwargs = language_modeling_bias_kwargs(args, tokenizer, binary_mask, N, L, M, device)
 
     # to distinguish between the lattice used for fixed-pointing and the lattice used for computing output loss
     # we use output_xx to denote lattice quantities associated with the fix-pointing
@@ -155,27 +191,17 @@ def language_modeling_lattice_step(args, batch, tokenizer, model, device, eval=F
         assert args.group_lasso == 0
         output_fwd_ids = fwd_ids
         output_fwd_ms = fwd_ms
-        output_bwd_ms_c = bwd_ms_c # this is the un-expanded bwd_ms
-        output_bwd_ms = bwd_ms
 
         f_output_fwd_ids = vfwd_ids
         f_output_fwd_ms = vfwd_ms
-        f_output_bwd_ms_c = vbwd_ms_c # this is the un-expanded vbwd_ms
-        vbwd_ms = (vbwd_ms_c.unsqueeze(2) * emask + mmask).reshape(batch_size, N * L, M, L)
-        f_output_bwd_ms = vbwd_ms
         f_output_lengths = lengths
     else:
         f_output_fwd_ids = output_fwd_ids = fwd_ids
         f_output_fwd_ms = output_fwd_ms = fwd_ms
-        f_output_bwd_ids = bwd_ids
-        f_output_bwd_ms_c = output_bwd_ms_c = bwd_ms_c
-        f_output_bwd_ms = output_bwd_ms = bwd_ms
         f_output_lengths = lengths
-        f_output_bwd_lengths = bwd_lengths
 
     # initialize the lattice using the individually parametrized edge weights and perform fix-pointing
     output_fwd_ts = None
-    output_bwd_ts = None
     if args.debug_fixed_point:
         assert not args.output_viterbi
         prev = output_fwd_ts
@@ -184,20 +210,15 @@ def language_modeling_lattice_step(args, batch, tokenizer, model, device, eval=F
         model.eval() # dropout messes with fix-pointing so let's turn it off
         with torch.no_grad(): # don't track gradient to save memory
             for _ in forever_generator():
-                ent, a, m, c = tokenizer(fwd_ids, fwd_ms, lengths,
-                                         bwd_ids, bwd_ms, bwd_lengths,
-                                         mmask, emask, None, lm=True, lm_mask=global_mask, fwd_ts=output_fwd_ts, bwd_ts=output_bwd_ts, marginal_temperature=args.marginal_temperature)
-                # run model
-                losses = model(input_ids=input_ids, position_ids=pos_ids, attn_bias=a if args.vopt else None, return_dict=True, unigram_expert=unigram_expert)
-
+                ent, a, m, c = tokenizer(fwd_ids, fwd_ms, lengths, None, lm=True, fwd_ts=output_fwd_ts, marginal_temperature=args.marginal_temperature, **bias_kwargs)
                 # get indices
                 indices = increasing_roll_left(output_fwd_ids, tokenizer.pad_index).transpose(-1, -2).reshape(batch_size, N * L,M)  # batch x NL x M
 
-                # get output probabilities
-                log_edge_weights = torch.log_softmax(losses["logits"][:, -N * L:, :], -1)  # batch x NL x V
+                # run model and get the log probs of the candidate units of the nodes
+                log_probs = node_log_probs(args, model, indices, input_ids=input_ids, position_ids=pos_ids, attn_bias=a if args.vopt else None, unigram_expert=unigram_expert)
 
-                # get log probs and convert back to transition matrix
-                output_fwd_ts = torch.gather(log_edge_weights, -1, indices).reshape(batch_size, N, L, M).transpose(-1,-2)  # batch x N x M x L
+                # convert back to transition matrix
+                output_fwd_ts = log_probs.reshape(batch_size, N, L, M).transpose(-1,-2)  # batch x N x M x L
 
                 # do some masking of the BOS and do some conditioning
                 bos_mask = torch.ones_like(output_fwd_ts) # [batch_size, N, M, L]
@@ -206,12 +227,6 @@ def language_modeling_lattice_step(args, batch, tokenizer, model, device, eval=F
                 conditioning = ofts.max(-1)[0].detach() # set the BOS edge weight appropriately to protect against over/underflow
                 output_fwd_ts = bos_mask * output_fwd_ts + (1 - bos_mask) * conditioning[:, None, None, None]
 
-                # build backward ts for next step
-                output_bwd_ts = torch.flip(output_fwd_ts, dims=[-1])
-                output_bwd_ts = output_bwd_ts * output_bwd_ms_c + -INF * (1 - output_bwd_ms_c)
-                output_bwd_ts = (output_bwd_ts.unsqueeze(2) * emask + -INF * (1 - emask)).reshape(batch_size, N * L, M, L)
-                output_bwd_ts = output_bwd_ts * (1 - bwd_connector)
-
                 # continue to re-shape the output_fwd_ts
                 output_fwd_ts = increasing_roll_right(output_fwd_ts, 0)
                 output_fwd_ts = output_fwd_ts * output_fwd_ms + (1 - output_fwd_ms) * -INF
@@ -229,20 +244,15 @@ def language_modeling_lattice_step(args, batch, tokenizer, model, device, eval=F
         model.train()
     # perform one fixed-point iteration at the fixed point with gradient and dropout
     if args.debug_fixed_point:
-        ent, a, m, c = tokenizer(fwd_ids, fwd_ms, lengths,
-                                 bwd_ids, bwd_ms, bwd_lengths,
-                                 mmask, emask, None, lm=True, lm_mask=global_mask, fwd_ts=output_fwd_ts, bwd_ts=output_bwd_ts, marginal_temperature=args.marginal_temperature)
-        # run model
-        losses = model(input_ids=input_ids, position_ids=pos_ids, attn_bias=a if args.vopt else None, return_dict=True, unigram_expert=unigram_expert)
-
+        ent, a, m, c = tokenizer(fwd_ids, fwd_ms, lengths, None, lm=True, fwd_ts=output_fwd_ts, marginal_temperature=args.marginal_temperature, **bias_kwargs)
         # get indices
         indices = increasing_roll_left(output_fwd_ids, tokenizer.pad_index).transpose(-1, -2).reshape(batch_size, N * L, M) # batch x NL x M
 
-        # get output probabilities
-        log_edge_weights = torch.log_softmax(losses["logits"][:, -N * L:, :], -1) # batch x NL x V
+        # run model and get the log probs of the candidate units of the nodes
+        log_probs = node_log_probs(args, model, indices, input_ids=input_ids, position_ids=pos_ids, attn_bias=a if args.vopt else None, unigram_expert=unigram_expert)
 
-        # get log probs and convert back to transition matrix
-        output_fwd_ts = torch.gather(log_edge_weights, -1, indices).reshape(batch_size, N, L, M).transpose(-1,-2) # batch x N x M x L
+        # convert back to transition matrix
+        output_fwd_ts = log_probs.reshape(batch_size, N, L, M).transpose(-1,-2) # batch x N x M x L
 
         # do some masking of the BOS and do some conditioning
         bos_mask = torch.ones_like(output_fwd_ts)
@@ -251,12 +261,6 @@ def language_modeling_lattice_step(args, batch, tokenizer, model, device, eval=F
         conditioning = ofts.max(-1)[0].detach()
         output_fwd_ts = bos_mask * output_fwd_ts + (1-bos_mask) * conditioning[:,None, None, None]
 
-        # build backward ts for next step
-        output_bwd_ts = torch.flip(output_fwd_ts, dims=[-1])
-        output_bwd_ts = output_bwd_ts * output_bwd_ms_c + -INF * (1 - output_bwd_ms_c)
-        output_bwd_ts = (output_bwd_ts.unsqueeze(2) * emask + -INF * (1-emask)).reshape(batch_size, N * L, M, L)
-        output_bwd_ts = output_bwd_ts * (1-bwd_connector)
-
         # continue to re-shape the output_fwd_ts
         output_fwd_ts = increasing_roll_right(output_fwd_ts, 0)
         output_fwd_ts = output_fwd_ts * output_fwd_ms + (1-output_fwd_ms) * -INF
@@ -264,31 +268,29 @@ def language_modeling_lattice_step(args, batch, tokenizer, model, device, eval=F
     # dp lattice if necessasry
     ent, a, m, c = None, None, None, None
     if args.vopt:
-        ent, a, m, c = tokenizer(fwd_ids, fwd_ms, lengths,
-                                 bwd_ids, bwd_ms, bwd_lengths,
-                                 mmask, emask, None, lm=True, lm_mask=global_mask, fwd_ts=output_fwd_ts, bwd_ts=output_bwd_ts, marginal_temperature=args.marginal_temperature)
-    # run model
-    losses = model(input_ids=input_ids, position_ids=pos_ids, attn_bias=a if args.vopt else None, return_dict=True, unigram_expert=unigram_expert)
-
+        if lattice is not None:
+            ent, a, m, c = lattice(fwd_ids, fwd_ms, lengths, None, lm=True, marginal_temperature=args.marginal_temperature, **bias_kwargs)
+        else:
+            ent, a, m, c = tokenizer(fwd_ids, fwd_ms, lengths, None, lm=True, fwd_ts=output_fwd_ts, marginal_temperature=args.marginal_temperature, **bias_kwargs)
+    # drop the unlikely edges from the model inputs, the nodes (the outputs) stay at the end of the sequence
+    model_input_ids, model_pos_ids, model_bias = input_ids, pos_ids, a if args.vopt else None
+    if pruning(args):
+        keep = tokenizer.prune_edges(m, fwd_ms, lengths, threshold=args.prune_threshold, top_k=args.prune_top_k)
+        model_bias, (model_input_ids, model_pos_ids), _ = tokenizer.repack(keep, a, (input_ids, pos_ids), (tokenizer.pad_index, 0))
     # get indices
     indices = increasing_roll_left(f_output_fwd_ids, tokenizer.pad_index).transpose(-1, -2).reshape(batch_size, N * L, M) # batch x NL x M
 
-    # get output probabilities
-    log_edge_weights = torch.log_softmax(losses["logits"][:, -N * L:, :], -1) # batch x NL x V
+    # run model and get the log probs of the candidate units of the nodes
+    log_probs = node_log_probs(args, model, indices, input_ids=model_input_ids, position_ids=model_pos_ids, attn_bias=model_bias, unigram_expert=unigram_expert)
 
-    # get log probs and convert back to transition matrix
-    f_output_fwd_ts = torch.gather(log_edge_weights, -1, indices).reshape(batch_size, N, L, M).transpose(-1,-2) # batch x N x M x L
+    # convert back to transition matrix
+    f_output_fwd_ts = log_probs.reshape(batch_size, N, L, M).transpose(-1,-2) # batch x N x M x L
     bos_mask = torch.ones_like(f_output_fwd_ts)
     bos_mask[:,0,:,0] = 0 # first column of first block is bos
     ofts = f_output_fwd_ts.reshape(batch_size, -1)
     conditioning = ofts.max(-1)[0].detach()
     f_output_fwd_ts = bos_mask * f_output_fwd_ts + (1-bos_mask) * conditioning[:,None, None, None]
 
-    # build backward ts
-    f_output_bwd_ts = torch.flip(f_output_fwd_ts, dims=[-1])
-    f_output_bwd_ts = f_output_bwd_ts * f_output_bwd_ms_c + -INF * (1 - f_output_bwd_ms_c)
-    f_output_bwd_ts = (f_output_bwd_ts.unsqueeze(2) * emask + -INF * (1-emask)).reshape(batch_size, N * L, M, L)
-    f_output_bwd_ts = f_output_bwd_ts * (1-bwd_connector)
     # continue to re-shape the f_output_fwd_ts
     f_output_fwd_ts = increasing_roll_right(f_output_fwd_ts, 0)
     f_output_fwd_ts = f_output_fwd_ts * f_output_fwd_ms + (1-f_output_fwd_ms) * -INF
@@ -298,10 +300,6 @@ def language_modeling_lattice_step(args, batch, tokenizer, model, device, eval=F
         f_output_fwd_ids = f_output_fwd_ids[:, 1:, ...]
         f_output_fwd_ms = f_output_fwd_ms[:, 1:, ...]
         f_output_lengths = f_output_lengths[:, 1:]
-        f_output_bwd_ts = f_output_bwd_ts[:,1:,...]
-        f_output_bwd_ids = f_output_bwd_ids[:, 1:, ...]
-        f_output_bwd_ms = f_output_bwd_ms[:, 1:, ...]
-        f_output_bwd_lengths = f_output_bwd_lengths[:, 1:, ...]
     # do some logging if requested
     if args.log_lattice and eval:
         with open(os.path.join(args.output_dir, args.log_lattice_file), "at") as f:
@@ -314,21 +312,41 @@ def language_modeling_lattice_step(args, batch, tokenizer, model, device, eval=F
 
     if decode:
         max_log_alpha, _, backpointers = tokenizer.viterbi_algorithm(f_output_fwd_ts.reshape(-1, *f_output_fwd_ts.size()[2:]), f_output_fwd_ms.reshape(-1, *f_output_fwd_ms.size()[2:]), f_output_lengths.reshape(-1, *f_output_lengths.size()[2:]))
-        word_ids = tokenizer.decode_backpointers(f_output_fwd_ids.reshape(-1, *f_output_fwd_ids.size()[2:]), f_output_lengths.reshape(-1, *f_output_lengths.size()[2:]), backpointers)
-        word_ids = [sum(word_ids[i*N:(i+1)*N],[]) for i in range(batch_size)]
-        return [[tokenizer.id2str(id, remove_csp=decode_remove_csp) for id in word_id if not decode_remove_padding or not tokenizer.is_padding(id)] for word_id in word_ids]
-
-    # compute prob
+        word_ids, counts = tokenizer.viterbi_backtrace(f_output_fwd_ids.reshape(-1, *f_output_fwd_ids.size()[2:]), f_output_lengths.reshape(-1, *f_output_lengths.size()[2:]), backpointers, padding_id=tokenizer.pad_index)
+        # concatenate the paths of the blocks of each example, moving the units of every block to the front (stable)
+        keep = (torch.arange(word_ids.size(-1), device=counts.device)[None, :] < counts[:, None]).reshape(batch_size, -1)
+        order = torch.argsort((~keep).to(torch.long), dim=-1, stable=True)
+        word_ids = torch.gather(word_ids.reshape(batch_size, -1), -1, order)
+        return tokenizer.decode_ids(word_ids, keep.sum(-1), remove_csp=decode_remove_csp, remove_padding=decode_remove_padding)
+
+    # compute prob, the expected number of tokens (if needed) comes out of the same sweep
+    need_expected_lengths = (not eval and not args.normalize_by_tokens and args.normalize_by_expected_length) or args.length_penalty > 0.0
+    expected_lengths = None
+    if need_expected_lengths:
+        length_transition = (torch.ones(f_output_fwd_ids.size(-2)))[None, None, :, None].expand(
+            *f_output_fwd_ids.size()).to(f_output_fwd_ms.device) * f_output_fwd_ms
     if not eval or not args.eval_viterbi_mode:
-        log_alphas, _ = tokenizer.forward_algorithm(f_output_fwd_ts.reshape(-1, M, L), # batch x N, M, L or batch x N - 1 ... for skipgram
-                                                    f_output_fwd_ms.reshape(-1, M, L),  # batch x N, M, L or batch x N - 1 ... for skipgram
-                                                    f_output_lengths.reshape(-1)) # batch x N
+        if need_expected_lengths:
+            log_alphas, _, _, _, expected_lengths = tokenizer.forward_statistics(f_output_fwd_ts.reshape(-1, M, L), # batch x N, M, L or batch x N - 1 ... for skipgram
+                                                                                 f_output_fwd_ms.reshape(-1, M, L), # batch x N, M, L or batch x N - 1 ... for skipgram
+                                                                                 f_output_lengths.reshape(-1), # batch x N
+                                                                                 value_matrix=length_transition.reshape(-1, M, L),
+                                                                                 entropy=False)
+        else:
+            log_alphas, _ = tokenizer.forward_algorithm(f_output_fwd_ts.reshape(-1, M, L), # batch x N, M, L or batch x N - 1 ... for skipgram
+                                                        f_output_fwd_ms.reshape(-1, M, L),  # batch x N, M, L or batch x N - 1 ... for skipgram
+                                                        f_output_lengths.reshape(-1)) # batch x N
     else:
         log_alphas, _, _ = tokenizer.viterbi_algorithm(f_output_fwd_ts.reshape(-1, M, L),
                                                     # batch x N, M, L or batch x N - 1 ... for skipgram
                                                     f_output_fwd_ms.reshape(-1, M, L),
                                                     # batch x N, M, L or batch x N - 1 ... for skipgram
                                                     f_output_lengths.reshape(-1))  # batch x N
+    if need_expected_lengths and expected_lengths is None:
+        expected_lengths, _ = tokenizer.expectation(f_output_fwd_ts.reshape(-1, M, L),
+                                                    length_transition.reshape(-1, M, L),
+                                                    f_output_fwd_ms.reshape(batch_size * N, M, L),
+                                                    f_output_lengths.reshape(-1))  # lengths is reshaped to batch x N or batch-1 x N for skipgram
     log_probs = log_alphas.sum()
     nchars = f_output_lengths.sum() - batch_size # adjust for BOS
 
@@ -337,8 +355,6 @@ def language_modeling_lattice_step(args, batch, tokenizer, model, device, eval=F
     elif args.normalize_by_tokens:
         loss = -log_probs / (f_output_fwd_ms.sum() - batch_size) * args.main_loss_multiplier
     elif args.normalize_by_expected_length:
-        length_transition = (torch.ones(f_output_fwd_ids.size(-2)))[None,None, :, None].expand(*f_output_fwd_ids.size()).to(f_output_fwd_ms.device) * f_output_fwd_ms
-        expected_lengths, _ = tokenizer.expectation(f_output_fwd_ts.reshape(-1, M, L), length_transition.reshape(-1, M, L), f_output_fwd_ms.reshape(batch_size * N, M, L), f_output_lengths.reshape(-1)) # lengths is reshaped to batch x N or batch-1 x N for skipgram
         loss = -log_probs / (expected_lengths.sum().item() - batch_size) * args.main_loss_multiplier
     elif args.no_normalization:
         loss = -log_probs * args.main_loss_multiplier / batch_size
@@ -349,21 +365,12 @@ def language_modeling_lattice_step(args, batch, tokenizer, model, device, eval=F
 
     expected_ntokens = None
     if args.length_penalty > 0.0:
-        length_transition = (torch.ones(f_output_fwd_ids.size(-2)))[None, None, :, None].expand(
-            *f_output_fwd_ids.size()).to(f_output_fwd_ms.device) * f_output_fwd_ms
-        expected_lengths, _ = tokenizer.expectation(f_output_fwd_ts.reshape(-1, M, L),
-                                                    length_transition.reshape(-1, M, L),
-                                                    f_output_fwd_ms.reshape(batch_size * N, M, L),
-                                                    f_output_lengths.reshape(
-                                                        -1))  # lengths is reshaped to batch x N or batch-1 x N for skipgram
         expected_ntokens = expected_lengths.sum()
     # get regularizer necessary book-keeping
     if args.group_lasso > 0:
         assert not args.output_viterbi
-        oent, _, om, _ = tokenizer(f_output_fwd_ids, f_output_fwd_ms, f_output_lengths,
-                                 f_output_bwd_ids, f_output_bwd_ms, f_output_bwd_lengths,
-                                 mmask, emask, None, lm=True, lm_mask=global_mask, fwd_ts=None if args.group_lasso_on_input else f_output_fwd_ts ,
-                                 bwd_ts=None if args.group_lasso_on_input else f_output_bwd_ts)
+        oent, _, om, _ = tokenizer(f_output_fwd_ids, f_output_fwd_ms, f_output_lengths, None, lm=True,
+                                   fwd_ts=None if args.group_lasso_on_input else f_output_fwd_ts, **bias_kwargs)
         om_list = om.reshape(batch_size, -1)[input_mask[:, :om.size(1) * om.size(2)].to(torch.bool)]
         unit_list = input_ids[:, :om.size(1) * om.size(2)][input_mask[:, :om.size(1) * om.size(2)].to(torch.bool)].reshape(-1)
         if om_list.size() != unit_list.size():
@@ -0,0 +1,95 @@
+import copy
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import time
+from typing import Callable, Iterable, Iterator, NamedTuple, Tuple
+
+import torch
+
+from bopt.core.tokenizer import Tokenizer
+
+
+class PendingLattice(NamedTuple):
+    """
+    Lattice statistics of a batch being computed on the worker.
+
+    version: number of weight updates when the weights were snapshot
+    future: the (ent, a, m, c) of the tokenizer call
+    """
+    version: int
+    future: Future
+
+
+class StaleLatticePipeline:
+    """
+    Runs the lattice dp (and the attention bias) of the next batch on a worker thread while the model runs on the
+    current batch, with a copy of the tokenizer (the shadow) and a snapshot of the weights taken when the batch before
+    it starts. The statistics of a batch are therefore at most one update stale, their gradient w.r.t. the current
+    weights goes through `Tokenizer.reweight_statistics`.
+
+    `inputs(batch)` gives the positional and keyword arguments of the tokenizer call of the step for `batch` (see
+    `lattice_inputs`), the step gets a callable with the same signature as the tokenizer in place of it.
+    """
+
+    def __init__(self, tokenizer: Tokenizer, inputs: Callable[[list], Tuple[tuple, dict]]):
+        self.tokenizer = tokenizer
+        self.inputs = inputs
+        self.shadow = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.version = 0
+        self.staleness = []
+        self.waiting = 0.0
+
+    def update(self) -> None:
+        """
+        Called after every update of the tokenizer weights.
+        """
+        self.version += 1
+
+    def submit(self, batch: list) -> PendingLattice:
+        if self.shadow is None or self.shadow.weights.weight.size() != self.tokenizer.weights.weight.size():
+            # first batch or a compacted vocabulary (the worker is idle between epochs)
+            self.shadow = copy.deepcopy(self.tokenizer)
+            self.shadow.weights.weight.requires_grad_(False)
+        snapshot = self.tokenizer.weights.weight.detach().clone()
+        args, kwargs = self.inputs(batch)
+
+        def run():
+            # grad mode is thread local
+            with torch.no_grad():
+                self.shadow.weights.weight.data.copy_(snapshot)
+                self.shadow.bump_weights_version()
+                return self.shadow(*args, **kwargs)
+        return PendingLattice(self.version, self.executor.submit(run))
+
+    def lattice(self, pending: PendingLattice) -> Callable:
+        def lattice(fwd_ids, fwd_ms, lengths, tmask=None, marginal_temperature=None, **kwargs):
+            start = time()
+            ent, a, m, c = pending.future.result()
+            self.waiting += time() - start
+            self.staleness.append(self.version - pending.version)
+            return self.tokenizer.reweight_statistics(ent, a, m, c, fwd_ids, fwd_ms, marginal_temperature=marginal_temperature)
+        return lattice
+
+    def iterate(self, batches: Iterable[list]) -> Iterator[Tuple[list, Callable]]:
+        """
+        Yields every batch with the callable that replaces the tokenizer in its step, the statistics of the next batch
+        are submitted before the current one is yielded.
+        """
+        batches = iter(batches)
+        batch = next(batches, None)
+        pending = self.submit(batch) if batch is not None else None
+        while batch is not None:
+            next_batch = next(batches, None)
+            next_pending = self.submit(next_batch) if next_batch is not None else None
+            yield batch, self.lattice(pending)
+            batch, pending = next_batch, next_pending
+
+    def statistics(self, reset: bool = True) -> Tuple[float, float]:
+        """
+        Mean staleness (in weight updates) of the statistics used since the last reset and the seconds spent waiting
+        for the worker.
+        """
+        staleness = sum(self.staleness) / max(len(self.staleness), 1), self.waiting
+        if reset:
+            self.staleness, self.waiting = [], 0.0
+        return staleness
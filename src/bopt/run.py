@@ -3,6 +3,7 @@ import math
 import os
 import sys
 from collections import OrderedDict, defaultdict
+from functools import partial
 from time import time
 import cProfile
 
@@ -23,18 +24,23 @@ from bopt.data.sentiment_analysis.unigram import preprocess_sentiment_analysis_w
     SentimentAnalysisUnigramDataset
 from bopt.data.skip_gram.lattice import preprocess_skip_gram_with_lattices_dataset, SkipGramLatticeDataset
 from bopt.data.skip_gram.unigram import SkipGramUnigramDataset, preprocess_skip_gram_with_unigram_dataset
-from bopt.forward_step import morpheme_prediction_lattice_step, language_modeling_lattice_step, \
+from bopt.forward_step import morpheme_prediction_lattice_inputs, language_modeling_lattice_inputs, morpheme_prediction_lattice_step, language_modeling_lattice_step, \
     language_modeling_unigram_step, morpheme_prediction_unigram_step
 from bopt.forward_loop import language_modeling_lattice_loop, language_modeling_unigram_loop, \
     language_modeling_lattice_decode_loop, language_modeling_unigram_decode_loop, morpheme_prediction_lattice_loop, morpheme_prediction_unigram_loop
 
 from bopt.arguments import parse_args
+from bopt.pipeline import StaleLatticePipeline
+from bopt.data.datasets import cache_complete, clear_cache_dir
+from bopt.data.preprocessing import preprocess_in_parts
+from bopt.data.cache_store import CacheStore, PREPROCESSING_OPTIONS, fingerprint_key, preprocessing_fingerprint, read_fingerprint, valid_cache, write_fingerprint
 from bopt.core.tokenizer import Tokenizer
 from bopt.data.morpheme_prediction.lattice import preprocess_morpheme_prediction_with_lattices_dataset, \
     MorphemePredictionLatticeDataset
 from bopt.data.language_modeling.lattice import LanguageModelingLatticeDataset, \
     preprocess_language_modeling_with_lattices_dataset, preprocess_language_modeling_with_viterbi_lattices_dataset, \
-    preprocess_language_modeling_with_lattices_output_viterbi_dataset, LanguageModelingLatticeOutputViterbiDataset
+    preprocess_language_modeling_with_lattices_output_viterbi_dataset, LanguageModelingLatticeOutputViterbiDataset, trimmed_collate
+from bopt.data.batching import TokenBudgetBatchSampler
 from grid_utils import acquire_all_available_gpu
 import logging
 import torch
@@ -119,21 +125,63 @@ def load_tokenizer(args, input_vocab, weights, device):
     args.max_unit_length = tokenizer.max_unit_length
     if args.vopt:
         tokenizer.to(device)
+    if args.weights_learning_rate == 0:
+        # a frozen tokenizer doesn't need the graph of its dp, so training can use the cached statistics too
+        tokenizer.weights.weight.requires_grad_(False)
+    tokenizer.scan_min_length = args.scan_min_block_length
+    if args.statistics_cache_mb > 0:
+        tokenizer.enable_statistics_cache(args.statistics_cache_mb * 2 ** 20)
     return tokenizer
 
 def create_or_clear_cache(args, cache_dir):
     if os.path.exists(cache_dir):
         if not args.overwrite_cache:
-            logger.info(f"{cache_dir} exists, using it as is...")
+            if read_fingerprint(cache_dir) is not None:
+                # checked against the fingerprint of the preprocessing by preprocess_dataset
+                return True
+            if not cache_complete(cache_dir):
+                logger.info(f"{cache_dir} is incomplete, preprocessing it (again)...")
+                return True
+            logger.info(f"{cache_dir} exists, using it as is (it has no fingerprint to check it against)...")
             return False
         else:
-            for f in glob.glob(f'{cache_dir}/*'):
-                os.remove(f)
+            clear_cache_dir(cache_dir)
             return True
     else:
         os.makedirs(cache_dir)
         return True
 
+def preprocess_dataset(args, preprocess, data, cache_dir, tokenizer, *preprocess_args, **preprocess_kwargs):
+    """
+    `preprocess(data, cache_dir, tokenizer, *preprocess_args, **preprocess_kwargs)`, over parts of the data in
+    --preprocessing_num_workers processes (see `preprocess_in_parts`), unless `cache_dir` already is the cache of the
+    same fingerprint (see `preprocessing_fingerprint`). With --cache_store, the cache is built once in the store and
+    linked into `cache_dir`.
+    """
+    fingerprint = preprocessing_fingerprint(preprocess, data, tokenizer, preprocess_args, preprocess_kwargs,
+                                            options={name: getattr(args, name, None) for name in PREPROCESSING_OPTIONS},
+                                            weights=not args.vopt or args.output_viterbi or args.debug_viterbi_lattice)
+    recorded = read_fingerprint(cache_dir)
+    if recorded == fingerprint and valid_cache(cache_dir, fingerprint):
+        logger.info(f"{cache_dir} matches its fingerprint, using it as is...")
+        return
+    if recorded is not None and recorded != fingerprint:
+        logger.info(f"{cache_dir} was preprocessed from other data or with other arguments, preprocessing it again...")
+        clear_cache_dir(cache_dir)
+
+    def build(cache_dir):
+        preprocess_in_parts(preprocess, data, cache_dir, tokenizer, *preprocess_args,
+                            num_workers=args.preprocessing_num_workers, lines_per_part=args.preprocessing_lines_per_part,
+                            key=fingerprint_key(fingerprint), **preprocess_kwargs)
+    if args.cache_store is not None:
+        store = CacheStore(args.cache_store)
+        entry = store.get(fingerprint, build)
+        logger.info(f"Linking {entry} into {cache_dir}...")
+        store.link(entry, cache_dir)
+    else:
+        build(cache_dir)
+        write_fingerprint(cache_dir, fingerprint)
+
 def preprocess_datasets(args, tokenizer, input_vocab, output_vocab):
     logger.info("Preprocessing Datasets...")
     if args.task == "morpheme_prediction":
@@ -147,7 +195,7 @@ def preprocess_datasets(args, tokenizer, input_vocab, output_vocab):
             flag = create_or_clear_cache(args, cache_dir)
             if flag:
                 if args.vopt:
-                    preprocess_morpheme_prediction_with_lattices_dataset(data,
+                    preprocess_dataset(args, preprocess_morpheme_prediction_with_lattices_dataset, data,
                                                                          cache_dir,
                                                                          tokenizer,
                                                                          output_vocab,
@@ -156,7 +204,7 @@ def preprocess_datasets(args, tokenizer, input_vocab, output_vocab):
                                                                          args.max_unit_length,
                                                                          debug=False)
                 else:
-                    preprocess_morpheme_prediction_with_unigram_dataset(args, data,
+                    preprocess_dataset(args, partial(preprocess_morpheme_prediction_with_unigram_dataset, args), data,
                                                                          cache_dir,
                                                                          tokenizer,
                                                                          output_vocab,
@@ -182,7 +230,7 @@ def preprocess_datasets(args, tokenizer, input_vocab, output_vocab):
             flag = create_or_clear_cache(args, cache_dir)
             if flag:
                 if args.vopt:
-                    preprocess_sentiment_analysis_with_lattices_dataset(args, data,
+                    preprocess_dataset(args, partial(preprocess_sentiment_analysis_with_lattices_dataset, args), data,
                                                                          cache_dir,
                                                                          tokenizer,
                                                                          output_vocab,
@@ -191,7 +239,7 @@ def preprocess_datasets(args, tokenizer, input_vocab, output_vocab):
                                                                          args.max_unit_length,
                                                                          debug=False)
                 else:
-                    preprocess_sentiment_analysis_with_unigram_dataset(args, data,
+                    preprocess_dataset(args, partial(preprocess_sentiment_analysis_with_unigram_dataset, args), data,
                                                                          cache_dir,
                                                                          tokenizer,
                                                                          output_vocab,
@@ -255,7 +303,7 @@ def preprocess_datasets(args, tokenizer, input_vocab, output_vocab):
             if flag:
                 if args.vopt:
                     if args.debug_viterbi_lattice:
-                        preprocess_language_modeling_with_viterbi_lattices_dataset(data,
+                        preprocess_dataset(args, preprocess_language_modeling_with_viterbi_lattices_dataset, data,
                                                                            cache_dir,
                                                                            tokenizer,
                                                                            output_vocab,
@@ -263,7 +311,7 @@ def preprocess_datasets(args, tokenizer, input_vocab, output_vocab):
                                                                            args.max_block_length if name == "train" or args.eval_max_block_length is None else args.eval_max_block_length,
                                                                            args.max_unit_length if name == "train" or args.eval_max_unit_length is None else args.eval_max_unit_length)
                     elif args.output_viterbi:
-                        preprocess_language_modeling_with_lattices_output_viterbi_dataset(args, data,
+                        preprocess_dataset(args, partial(preprocess_language_modeling_with_lattices_output_viterbi_dataset, args), data,
                                                                            cache_dir,
                                                                            tokenizer,
                                                                            output_vocab,
@@ -271,7 +319,7 @@ def preprocess_datasets(args, tokenizer, input_vocab, output_vocab):
                                                                            args.max_block_length if name == "train" or args.eval_max_block_length is None else args.eval_max_block_length,
                                                                            args.max_unit_length if name == "train" or args.eval_max_unit_length is None else args.eval_max_unit_length)
                     else:
-                        preprocess_language_modeling_with_lattices_dataset(data,
+                        preprocess_dataset(args, preprocess_language_modeling_with_lattices_dataset, data,
                                                                            cache_dir,
                                                                            tokenizer,
                                                                            output_vocab,
@@ -280,7 +328,7 @@ def preprocess_datasets(args, tokenizer, input_vocab, output_vocab):
                                                                            args.max_unit_length if name == "train" or args.eval_max_unit_length is None else args.eval_max_unit_length)
                 else:
                     if args.debug_node_unigram:
-                        preprocess_language_modeling_with_unigram_node_dataset(data,
+                        preprocess_dataset(args, preprocess_language_modeling_with_unigram_node_dataset, data,
                                                                       cache_dir,
                                                                       tokenizer,
                                                                       output_vocab,
@@ -290,7 +338,7 @@ def preprocess_datasets(args, tokenizer, input_vocab, output_vocab):
                                                                       args.max_length if name == "train" or args.eval_max_length is None else args.eval_max_length,
                                                                       pos_length=args.pos_length)
                     else:
-                        preprocess_language_modeling_with_unigram_dataset(args,
+                        preprocess_dataset(args, partial(preprocess_language_modeling_with_unigram_dataset, args),
                                                                       data,
                                                                       cache_dir,
                                                                       tokenizer,
@@ -306,9 +354,15 @@ def preprocess_datasets(args, tokenizer, input_vocab, output_vocab):
                     datasets[name] = dataset = LanguageModelingLatticeDataset(cache_dir)
             else:
                 datasets[name] = dataset = LanguageModelingUnigramDataset(cache_dir)
-            sampler = RandomSampler(dataset) if name == "train" else SequentialSampler(dataset)
-            dataloaders[name] = dataloader = DataLoader(dataset, sampler=sampler, batch_size=args.gpu_batch_size if name == "train" or args.eval_gpu_batch_size is None else args.eval_gpu_batch_size,
-                                                        num_workers=args.data_num_workers, collate_fn=default_collate)
+            # with a token budget the batches are trimmed to their longest example, eval and test keep their order for decoding
+            if args.batch_token_budget is not None and name == "train":
+                batch_sampler = TokenBudgetBatchSampler(dataset.column("lengths"), int(args.max_unit_length), args.batch_token_budget, shuffle=True, seed=args.seed)
+                dataloaders[name] = dataloader = DataLoader(dataset, batch_sampler=batch_sampler,
+                                                            num_workers=args.data_num_workers, collate_fn=trimmed_collate)
+            else:
+                sampler = RandomSampler(dataset) if name == "train" else SequentialSampler(dataset)
+                dataloaders[name] = dataloader = DataLoader(dataset, sampler=sampler, batch_size=args.gpu_batch_size if name == "train" or args.eval_gpu_batch_size is None else args.eval_gpu_batch_size,
+                                                            num_workers=args.data_num_workers, collate_fn=default_collate if args.batch_token_budget is None else trimmed_collate)
     else:
         raise ValueError(args.task)
     return datasets, dataloaders
@@ -328,6 +382,63 @@ def build_optimizers(args, tokenizer, model):
     return optimizer, plat_scheduler
 
 
+def select_optimizer_rows(optimizer, parameter, rows):
+    state = optimizer.state.get(parameter, {})
+    for key, value in state.items():
+        if torch.is_tensor(value) and value.dim() > 0 and value.size(0) == parameter.size(0):
+            state[key] = value[rows.to(value.device)]
+
+def select_rows(parameter, rows, optimizer):
+    """
+    Keeps the `rows` of a parameter, its gradient and its optimizer state in place, the optimizer keeps the same
+    parameter object.
+    """
+    select_optimizer_rows(optimizer, parameter, rows)
+    grad = parameter.grad
+    parameter.data = parameter.data[rows.to(parameter.device)]
+    if grad is not None:
+        parameter.grad = grad[rows.to(parameter.device)]
+
+def compact_vocabulary(args, tokenizer, model, optimizer):
+    """
+    Drops the units with a potential below args.compaction_threshold from the tokenizer, the word embeddings and (if the
+    outputs are the input units) the output layer, together with their optimizer state.
+
+    Returns the kept units (ids before the compaction).
+    """
+    units = tokenizer.live_units(args.compaction_threshold).cpu()
+    V = len(tokenizer.vocab)
+    if units.numel() == V:
+        return units
+    embeddings = model.bert.embeddings.word_embeddings
+    predictions = model.cls.predictions
+    if args.output_vocab is not None and predictions.decoder.weight is embeddings.weight:
+        raise ValueError("vocabulary compaction needs the output vocabulary to be the input vocabulary when the embeddings are tied")
+
+    # rows past the vocabulary of the tokenizer are not units, they stay
+    sliced = [(embeddings.weight, torch.cat([units, torch.arange(V, embeddings.num_embeddings)]))]
+    if args.output_vocab is None:
+        output_rows = torch.cat([units, torch.arange(V, predictions.decoder.out_features)])
+        sliced += [(predictions.decoder.weight, output_rows), (predictions.bias, output_rows)]
+    done = set()
+    for parameter, rows in sliced:
+        if id(parameter) not in done:
+            select_rows(parameter, rows, optimizer)
+            done.add(id(parameter))
+    select_optimizer_rows(optimizer, tokenizer.weights.weight, units)
+    tokenizer.compact(units)
+    embeddings.num_embeddings = model.config.vocab_size = embeddings.weight.size(0)
+    predictions.decoder.out_features = predictions.decoder.weight.size(0)
+    if model.config.override_output_vocab_size is not None:
+        model.config.override_output_vocab_size = predictions.decoder.out_features
+    logger.info(f"Compacted the vocabulary from {V} to {len(tokenizer.vocab)} units")
+    return units
+
+def clear_caches(args):
+    # the cache dirs and the files next to them (`<cache_dir>.index.json`, `<cache_dir>.meta.json`, ...)
+    if os.path.isdir(os.path.join(args.output_dir, "cache")):
+        clear_cache_dir(os.path.join(args.output_dir, "cache"))
+
 class Regularizers:
 
     @classmethod
@@ -401,7 +512,7 @@ def log_predictions(file, predictions):
         for prediction in predictions:
             print(prediction, file=f)
 
-def train(args, model: BertForMaskedLM, tokenizer:Tokenizer, train_dataloader: DataLoader,eval_dataloader: DataLoader, test_dataloader: DataLoader, optimizer, lr_scheduler, device="cpu"):
+def train(args, model: BertForMaskedLM, tokenizer:Tokenizer, train_dataloader: DataLoader,eval_dataloader: DataLoader, test_dataloader: DataLoader, optimizer, lr_scheduler, device="cpu", output_vocab=None):
     logger.info("Training...")
     model.train()
     bn = 0
@@ -413,6 +524,13 @@ def train(args, model: BertForMaskedLM, tokenizer:Tokenizer, train_dataloader: D
     unigram_expert = None if not args.unigram_expert else torch.cat([torch.log_softmax(tokenizer.weights.weight.reshape(-1), dim=-1), expert_padding], dim=-1)
     if args.fixed_unigram_expert:
         unigram_expert = unigram_expert.detach()
+    pipeline = None
+    if args.stale_lattice:
+        if args.task == "language_modeling" or args.task == "skip_gram":
+            inputs = lambda batch: language_modeling_lattice_inputs(args, batch, tokenizer, device, skip_gram=args.task == "skip_gram")
+        else:
+            inputs = lambda batch: morpheme_prediction_lattice_inputs(args, batch, tokenizer, device)
+        pipeline = StaleLatticePipeline(tokenizer, inputs)
     for epoch in range(args.train_epochs):
         if args.entropic != 0:
             if epoch < args.entropy_start_dec:
@@ -425,7 +543,7 @@ def train(args, model: BertForMaskedLM, tokenizer:Tokenizer, train_dataloader: D
         log_marginal_counts = torch.ones((len(tokenizer.vocab),), dtype=torch.float) * -INF
         lmc = torch.ones((len(tokenizer.vocab),), dtype=torch.float) * -INF
         counts = torch.zeros((len(tokenizer.vocab),), dtype=torch.float)
-        for batch in tqdm_bar:
+        for batch, lattice in (pipeline.iterate(tqdm_bar) if pipeline is not None else ((batch, None) for batch in tqdm_bar)):
             if (bn + 1) % (args.train_batch_size // args.gpu_batch_size) == 0 or bn == 0:
                 if (step % args.eval_steps) == 0 or bn == 0:
                     model.eval()
@@ -568,17 +686,17 @@ def train(args, model: BertForMaskedLM, tokenizer:Tokenizer, train_dataloader: D
 
             if args.task == "morpheme_prediction" or args.task == "sentiment_analysis":
                 if args.vopt:
-                    _, loss, ent, lengths, ntokens, out_marginals, out_units, expected_ntokens, _ = morpheme_prediction_lattice_step(args, batch, tokenizer, model, device)
+                    _, loss, ent, lengths, ntokens, out_marginals, out_units, expected_ntokens, _ = morpheme_prediction_lattice_step(args, batch, tokenizer, model, device, lattice=lattice)
                 else:
                     _, loss, ent, lengths, ntokens, out_marginals, out_units, expected_ntokens, _ = morpheme_prediction_unigram_step(args, batch, tokenizer, model, device)
             elif args.task == "language_modeling":
                 if args.vopt:
-                    _, loss, ent, lengths, ntokens, out_marginals, out_units, expected_ntokens, _ = language_modeling_lattice_step(args, batch, tokenizer, model, device, unigram_expert=unigram_expert)
+                    _, loss, ent, lengths, ntokens, out_marginals, out_units, expected_ntokens, _ = language_modeling_lattice_step(args, batch, tokenizer, model, device, unigram_expert=unigram_expert, lattice=lattice)
                 else:
                     _, loss, ent, lengths, ntokens, out_marginals, out_units, expected_ntokens, _ = language_modeling_unigram_step(args, batch, tokenizer, model, device)
             elif args.task == "skip_gram":
                 if args.vopt:
-                    _, loss, ent, lengths, ntokens, out_marginals, out_units, expected_ntokens, _ = language_modeling_lattice_step(args, batch, tokenizer, model, device, unigram_expert=unigram_expert, skip_gram=True)
+                    _, loss, ent, lengths, ntokens, out_marginals, out_units, expected_ntokens, _ = language_modeling_lattice_step(args, batch, tokenizer, model, device, unigram_expert=unigram_expert, skip_gram=True, lattice=lattice)
                 else:
                     _, loss, ent, lengths, ntokens, out_marginals, out_units, expected_ntokens, _ = language_modeling_unigram_step(args, batch, tokenizer, model, device)
             else:
@@ -631,6 +749,9 @@ def train(args, model: BertForMaskedLM, tokenizer:Tokenizer, train_dataloader: D
                 if not tokenizer.lsp:
                     # make sure weights are positive if parametrized as real numbers
                     tokenizer.clamp_weights()
+                tokenizer.bump_weights_version()
+                if pipeline is not None:
+                    pipeline.update()
                 if not args.log_space and (tokenizer.weights.weight.data <= -1e-6).any() or args.log_space and (tokenizer.weights.weight.data <= -14).any():
                     code.interact(local=locals())
                 step += 1
@@ -642,11 +763,29 @@ def train(args, model: BertForMaskedLM, tokenizer:Tokenizer, train_dataloader: D
 
                 if args.unigram_expert and not args.fixed_unigram_expert:
                     unigram_expert = torch.cat([torch.log_softmax(tokenizer.weights.weight.reshape(-1), dim=-1), expert_padding], dim=-1)
+        if pipeline is not None:
+            staleness, waiting = pipeline.statistics()
+            logger.info(f"Epoch {epoch}: lattice statistics {staleness:.2f} updates stale on average, {waiting:.1f}s waiting for the lattice worker")
         prev_log_marginal_counts = log_marginal_counts
         prev_counts = counts
         prev_lmc = lmc
         prev_type_ent = (-(prev_lmc - prev_lmc.logsumexp(-1)).to(torch.double) * (prev_lmc - prev_lmc.logsumexp(-1)).to(torch.double).exp()).sum()
 
+        if args.compaction_epochs is not None and (epoch + 1) % args.compaction_epochs == 0:
+            V = len(tokenizer.vocab)
+            units = compact_vocabulary(args, tokenizer, model, optimizer)
+            if len(tokenizer.vocab) < V:
+                # the unit statistics follow the units, the caches are rebuilt with the new ids (and fewer edges)
+                prev_log_marginal_counts, prev_counts, prev_lmc = prev_log_marginal_counts[units], prev_counts[units], prev_lmc[units]
+                if unigram_expert is not None:
+                    if args.fixed_unigram_expert:
+                        unigram_expert = unigram_expert[torch.cat([units, torch.arange(V, V + expert_padding.numel())]).to(device)]
+                    else:
+                        unigram_expert = torch.cat([torch.log_softmax(tokenizer.weights.weight.reshape(-1), dim=-1), expert_padding], dim=-1)
+                clear_caches(args)
+                _, dataloaders = preprocess_datasets(args, tokenizer, tokenizer.vocab, tokenizer.vocab if args.output_vocab is None else output_vocab)
+                train_dataloader, eval_dataloader, test_dataloader = dataloaders["train"], dataloaders["eval"], dataloaders["test"]
+
         if (epoch + 1) % args.save_epochs == 0:
             save_checkpoint(args, epoch, step, model, tokenizer, optimizer)
         lr_scheduler.step(epoch_loss / epoch_examples)
@@ -726,7 +865,7 @@ def main():
     # train!
     if args.do_train:
         logger.info("Training...")
-        train(args, model, tokenizer, dataloaders["train"], dataloaders["eval"], dataloaders["test"], optimizer, lr_scheduler, device=device)
+        train(args, model, tokenizer, dataloaders["train"], dataloaders["eval"], dataloaders["test"], optimizer, lr_scheduler, device=device, output_vocab=output_vocab)
     #    code.interact(local=locals())
     if args.do_eval:
         logger.info("Evaluating...")
@@ -0,0 +1,71 @@
+import json
+import os
+import sys
+
+import torch
+
+from bopt import arguments, run
+
+UNITS = ["[PAD]", "[UNK]", "[SP1]", "[SP2]", "[SP3]", "[SP4]", "[BOS]", "[EOS]"] + list("abcdefg") + ["ab", "cd", "abc", "efg", "ga", "dd", "bcd"]
+DROPPED = ["cd", "efg", "bcd"]
+
+
+def small_run(tmp_path, monkeypatch, output_dir):
+    """
+    The vocabulary, model and caches of a small skip gram run with vocabulary compaction.
+    """
+    with open(tmp_path / "vocab.txt", "wt") as f:
+        print("\n".join(UNITS), file=f)
+    with open(tmp_path / "train.txt", "wt") as f:
+        print("abcd efg ga\ndd bcd abc efg\nga cd", file=f)
+    with open(tmp_path / "config.json", "wt") as f:
+        json.dump({"vocab_size": len(UNITS), "hidden_size": 16, "num_attention_heads": 2, "num_hidden_layers": 1,
+                   "intermediate_size": 16, "max_position_embeddings": 64}, f)
+    monkeypatch.setattr(sys, "argv", ["run.py", "--task", "skip_gram", "--vopt", "--do_train", "--quiet", "--log_space",
+                                      "--output_dir", str(tmp_path / output_dir), "--overwrite_output_dir",
+                                      "--input_vocab", str(tmp_path / "vocab.txt"), "--config", str(tmp_path / "config.json"),
+                                      "--train_dataset", str(tmp_path / "train.txt"), "--skip_gram_distances", "1",
+                                      "--max_blocks", "1", "--max_block_length", "4", "--max_unit_length", "3",
+                                      "--specials", "[SP1]", "[SP2]", "[SP3]", "--compaction_epochs", "1",
+                                      "--statistics_cache_mb", "0"])
+    args = arguments.parse_args()
+    input_vocab, output_vocab, weights = run.load_vocab_and_weights(args)
+    tokenizer = run.load_tokenizer(args, input_vocab, weights, "cpu")
+    model, _ = run.load_model(args, "cpu")
+    return args, tokenizer, model
+
+
+def examples(dataset):
+    return [tuple(t.clone() if torch.is_tensor(t) else t for t in dataset[i]) for i in range(len(dataset))]
+
+
+def test_compaction_rebuilds_caches(tmp_path, monkeypatch):
+    args, tokenizer, model = small_run(tmp_path, monkeypatch, "compacted")
+    datasets, _ = run.preprocess_datasets(args, tokenizer, tokenizer.vocab, tokenizer.vocab)
+    cache_dir = os.path.join(args.output_dir, "cache", "train.txt")
+    assert os.path.exists(f"{cache_dir}.index.json") # a file next to the cache dir
+    before = examples(datasets["train"])
+
+    optimizer, _ = run.build_optimizers(args, tokenizer, model)
+    with torch.no_grad():
+        tokenizer.weights.weight[[tokenizer.vocab.index(unit) for unit in DROPPED]] = -30.0
+    embeddings = model.bert.embeddings.word_embeddings.weight.detach().clone()
+    units = run.compact_vocabulary(args, tokenizer, model, optimizer)
+    assert [tokenizer.vocab[i] for i in range(len(tokenizer.vocab))] == [unit for unit in UNITS if unit not in DROPPED]
+    assert torch.equal(model.bert.embeddings.word_embeddings.weight.detach(), embeddings[units])
+
+    # what the training loop does after a compaction
+    run.clear_caches(args)
+    datasets, _ = run.preprocess_datasets(args, tokenizer, tokenizer.vocab, tokenizer.vocab)
+    after = examples(datasets["train"])
+
+    # the same as preprocessing with the compacted vocabulary from scratch
+    fresh_args, fresh_tokenizer, _ = small_run(tmp_path, monkeypatch, "fresh")
+    fresh_tokenizer.compact(units)
+    fresh, _ = run.preprocess_datasets(fresh_args, fresh_tokenizer, fresh_tokenizer.vocab, fresh_tokenizer.vocab)
+    fresh = examples(fresh["train"])
+    assert len(after) == len(fresh) == len(before)
+    for example, reference in zip(after, fresh):
+        assert all(torch.equal(t, r) if torch.is_tensor(t) else t == r for t, r in zip(example, reference))
+    # the dropped units are no longer edges of the lattices (fwd_ms)
+    assert sum(int(example[4].sum()) for example in after) < sum(int(example[4].sum()) for example in before)
@@ -0,0 +1,53 @@
+from dataclasses import dataclass
+from typing import Tuple
+
+from bopt.unigram_lm_tokenizers.encoding.forward_encoding import NONEDGE_ID
+import torch
+
+
+@dataclass
+class SparseEncoding:
+    """
+    Edge list of a batch of lattices, for large max_unit_length where most of the M x L forward encoding is
+    NONEDGE_ID. The lattices of all dimensions in size_prefix are collapsed into a single one (B').
+
+    Edges are sorted by end node, the incoming edges of node n (of all lattices) are
+    node_offsets[n-1]:node_offsets[n], which corresponds to column n-1 of the forward encoding.
+    """
+    ids: torch.Tensor = None            # E, vocabulary ids (PADEDGE_ID for padding edges)
+    start: torch.Tensor = None          # E, start node of every edge
+    end: torch.Tensor = None            # E, end node of every edge (1 to L)
+    lattice: torch.Tensor = None        # E, which of the B' lattices the edge belongs to
+    node_offsets: torch.Tensor = None   # L+1
+    size: Tuple[int, ...] = None        # size of the dense encoding, size_prefix x M x L
+
+    @property
+    def num_lattices(self):
+        return self.size[:-2].numel()
+
+def to_sparse_encoding(forward_encodings: torch.Tensor) -> SparseEncoding:
+    """
+    Converts size_prefix x M x L forward encodings (see integerize_for_forward) to a SparseEncoding, keeping all
+    edges and padding edges.
+    """
+    size = forward_encodings.size()
+    M, L = size[-2:]
+    forward_encodings = forward_encodings.reshape(-1, M, L)
+    column, lattice, row = (forward_encodings != NONEDGE_ID).permute(2, 0, 1).nonzero(as_tuple=True) # sorted by column
+    node_offsets = torch.cat([column.new_zeros(1), torch.bincount(column, minlength=L).cumsum(0)])
+    return SparseEncoding(forward_encodings[lattice, row, column], column - row, column + 1, lattice, node_offsets, size)
+
+def to_dense(sparse_encoding: SparseEncoding, values: torch.Tensor, fill) -> torch.Tensor:
+    """
+    Scatters per edge values (E) back into the size_prefix x M x L layout of the forward encoding.
+    """
+    M, L = sparse_encoding.size[-2:]
+    dense = values.new_full((sparse_encoding.num_lattices, M, L), fill)
+    dense = dense.index_put((sparse_encoding.lattice, sparse_encoding.end - sparse_encoding.start - 1, sparse_encoding.end - 1), values)
+    return dense.reshape(*sparse_encoding.size)
+
+def to_dense_encoding(sparse_encoding: SparseEncoding) -> torch.Tensor:
+    """
+    Inverse of to_sparse_encoding.
+    """
+    return to_dense(sparse_encoding, sparse_encoding.ids, NONEDGE_ID)
@@ -0,0 +1,35 @@
+from bopt.integerize import Integerizer
+from bopt.unigram_lm_tokenizers.encoding.forward_encoding import integerize_for_forward
+from bopt.unigram_lm_tokenizers.encoding.sparse_encoding import to_sparse_encoding, to_dense_encoding, to_dense
+from bopt.unigram_lm_tokenizers.inference.entropy import entropy, sparse_entropy
+from bopt.unigram_lm_tokenizers.inference.forward_backward import forward_algorithm, sparse_forward_algorithm
+from bopt.unigram_lm_tokenizers.modeling.unigramlm import UnigramLM
+
+import torch
+
+
+def test_sparse_encoding():
+    vocabulary = Integerizer(["[UNK]", "h", "a", "t", "e", "hat", "hate", "at", "ate"])
+    encoding = integerize_for_forward(["hate hat", "ate", "hat ate hate"], 3, 6, 6, vocabulary, space_character=" ",
+                                       split_on_space=True, add_dummy_space_start=False, remove_space=True)
+    sparse_encoding = to_sparse_encoding(encoding)
+    print("edges", sparse_encoding.ids.numel(), "slots", encoding.numel())
+    assert (to_dense_encoding(sparse_encoding) == encoding).all()
+
+    unigramlm = UnigramLM(len(vocabulary), torch.randn(len(vocabulary), 1, dtype=torch.double), log_space_parametrization=True)
+    edge_log_potentials = unigramlm(encoding)
+    sparse_edge_log_potentials = unigramlm(sparse_encoding.ids)
+    assert (to_dense(sparse_encoding, sparse_edge_log_potentials, -torch.inf) == edge_log_potentials).all()
+
+    forward_output = forward_algorithm(edge_log_potentials)
+    sparse_forward_output = sparse_forward_algorithm(sparse_encoding, sparse_edge_log_potentials)
+    assert torch.allclose(sparse_forward_output.last_node_log_alphas, forward_output.last_node_log_alphas)
+    assert torch.allclose(to_dense(sparse_encoding, sparse_forward_output.edge_log_alphas, -torch.inf), forward_output.edge_log_alphas)
+    assert torch.allclose(sparse_entropy(sparse_encoding, sparse_edge_log_potentials), entropy(edge_log_potentials))
+
+    grad, = torch.autograd.grad(forward_output.last_node_log_alphas.sum(), unigramlm.edge_log_potentials.weight)
+    sparse_grad, = torch.autograd.grad(sparse_forward_output.last_node_log_alphas.sum(), unigramlm.edge_log_potentials.weight)
+    assert torch.allclose(sparse_grad, grad)
+
+if __name__ == "__main__":
+    test_sparse_encoding()
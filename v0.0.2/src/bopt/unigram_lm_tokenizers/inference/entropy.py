@@ -1,3 +1,5 @@
+from bopt.unigram_lm_tokenizers.encoding.sparse_encoding import SparseEncoding
+from bopt.unigram_lm_tokenizers.inference.forward_backward import segment_logsumexp
 import torch
 
 
@@ -37,3 +39,34 @@ def entropy(edge_log_potentials):
 
     return (last_node_entropy_aggregate / last_node_log_alphas.exp() + last_node_log_alphas) # entropy = internal energy + free energy
 
+
+
+def sparse_entropy(sparse_encoding: SparseEncoding, edge_log_potentials):
+    """
+    entropy over a SparseEncoding, where edge_log_potentials (E) are the potentials of its edges.
+    """
+    M, L = sparse_encoding.size[-2:]
+    size_prefix = sparse_encoding.size[:-2]
+    B = sparse_encoding.num_lattices
+    offsets = sparse_encoding.node_offsets.tolist()
+    lattice, unit_length = sparse_encoding.lattice, sparse_encoding.end - sparse_encoding.start - 1
+    edge_log_potentials = edge_log_potentials.double()
+    edge_potentials = edge_log_potentials.exp()
+    edge_entropy_individual = - torch.clamp(edge_log_potentials, min=-1e9) * edge_potentials  # -plogp
+
+    # window[:, k] = alpha / entropy aggregate of node n-1-k
+    node_log_alphas = edge_log_potentials.new_zeros(B, M)
+    node_entropies = edge_log_potentials.new_zeros(B, M)
+    for n in range(1, L + 1):
+        edges = slice(offsets[n - 1], offsets[n])
+        segments = lattice[edges]
+        prev_log_alphas, prev_entropies = node_log_alphas[segments, unit_length[edges]], node_entropies[segments, unit_length[edges]]
+        log_alpha = segment_logsumexp(edge_log_potentials[edges] + prev_log_alphas, segments, B)
+        entropy_aggregate = edge_log_potentials.new_zeros(B).index_add(0, segments, prev_log_alphas.exp() * edge_entropy_individual[edges]
+                                                                                      + prev_entropies * edge_potentials[edges])
+        node_log_alphas = torch.cat([log_alpha[:, None], node_log_alphas[:, :-1]], dim=1)
+        node_entropies = torch.cat([entropy_aggregate[:, None], node_entropies[:, :-1]], dim=1)
+
+    last_node_log_alphas = node_log_alphas[:, 0].reshape(*size_prefix)
+    last_node_entropy_aggregate = node_entropies[:, 0].reshape(*size_prefix)
+    return (last_node_entropy_aggregate / last_node_log_alphas.exp() + last_node_log_alphas) # entropy = internal energy + free energy
@@ -1,11 +1,13 @@
 import code
 from dataclasses import dataclass
 from bopt.unigram_lm_tokenizers.encoding.forward_encoding import NONEDGE_LOGPOT
+from bopt.unigram_lm_tokenizers.encoding.sparse_encoding import SparseEncoding
 from bopt.unigram_lm_tokenizers.utils.encoding import convert_to_backward_log_potentials, expand_log_potentials, \
     convert_to_forward_log_potentials, expansion_mask, lattice_mask
 from bopt.utils import increasing_roll_right, col_shift
 import torch
 
+SCAN_NEGINF = -1e9 # finite stand-in for NONEDGE_LOGPOT inside the scan, logsumexp over only -inf has nan gradients
 
 @dataclass
 class ForwardAlgorithmOutput:
@@ -19,40 +21,148 @@ class ConditionalMarginalsOutput:
     backward_conditional_marginals: torch.Tensor = None         # always set
     forward_conditional_marginals: torch.Tensor = None          # optionally set
 
-def forward_algorithm(edge_log_potentials: torch.FloatTensor, return_node_contribution=False):
+def lattice_start_nodes(M: int, L: int, device="cpu"):
+    """
+    Start node of every slot of an M x L edge matrix (column i holds the incoming edges of node i+1, the edge in row k
+    starts at node i-k) and the band of slots that start inside the lattice. The start is clamped to 0 outside the band
+    so that it can be used as an index.
+    """
+    start = torch.arange(L, device=device)[None, :] - torch.arange(M, device=device)[:, None]
+    return start.clamp(min=0), start >= 0
+
+class ForwardAlgorithmFunction(torch.autograd.Function):
+    """
+    Node log alphas (B' x L+1) of B' x M x L edge log potentials, with an analytic backward.
+
+    Instead of keeping the graph of the L steps of the forward loop, backward does one reverse (outside) sweep that
+    pushes the gradient of every node to its incoming edges in proportion to their share of the node alpha, and
+    collects the gradient of a node from its outgoing edges. With a gradient of 1 on the last node this computes the
+    edge marginals alpha(start) * potential * beta(end) / Z. Only the potentials and node alphas are kept, O(B' M L).
+    """
+
+    @staticmethod
+    def forward(ctx, edge_log_potentials):
+        B, M, L = edge_log_potentials.size()
+        node_log_alphas = edge_log_potentials.new_zeros(B, L + 1)
+        window = edge_log_potentials.new_zeros(B, M) # window[:, k] = alpha of the start node of the kth incoming edge
+        for i in range(L):
+            # aggregate the `incoming` edge-alphas into the alpha of node i+1
+            node_log_alphas[:, i + 1] = (edge_log_potentials[:, :, i] + window).logsumexp(-1)
+            window = torch.cat([node_log_alphas[:, i + 1:i + 2], window[:, :-1]], dim=1)
+        ctx.save_for_backward(edge_log_potentials, node_log_alphas)
+        return node_log_alphas
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_node_log_alphas):
+        edge_log_potentials, node_log_alphas = ctx.saved_tensors
+        B, M, L = edge_log_potentials.size()
+        start, band = lattice_start_nodes(M, L, device=edge_log_potentials.device)
+        grad_edge_log_potentials = torch.zeros_like(edge_log_potentials)
+        pending = edge_log_potentials.new_zeros(B, M) # pending[:, j] = gradient collected for node i-j
+        node_grad = grad_node_log_alphas[:, L]
+        for i in reversed(range(L)):
+            node_to_edge = node_log_alphas[:, start[:, i]].masked_fill(~band[:, i], 0)
+            posteriors = (edge_log_potentials[:, :, i] + node_to_edge - node_log_alphas[:, i + 1:i + 2]).exp().nan_to_num(nan=0.0) # unreachable nodes
+            edge_grad = node_grad[:, None] * posteriors
+            grad_edge_log_potentials[:, :, i] = edge_grad
+            # node i is complete once all its outgoing edges (columns >= i) have been visited
+            pending = pending + edge_grad * band[:, i]
+            node_grad = grad_node_log_alphas[:, i] + pending[:, 0]
+            pending = torch.cat([pending[:, 1:], torch.zeros_like(pending[:, :1])], dim=1)
+        return grad_edge_log_potentials
+
+def scan_node_log_alphas(edge_log_potentials: torch.FloatTensor):
+    """
+    Node log alphas (B' x L+1) of B' x M x L edge log potentials, computed as an associative scan with O(log L)
+    sequential steps instead of the L steps of the forward loop. Meant for long unsegmented inputs.
+
+    Column i is a log semiring transfer matrix of size M+1 that maps the alphas of the last M nodes (and a constant
+    0 for the slots before the first node) to the alphas of the M nodes ending at i+1. All prefix products of the
+    transfer matrices are computed with a Hillis-Steele scan, in O(L log L M^3) work.
+    """
+    B, M, L = edge_log_potentials.size()
+    S = M + 1
+    _, band = lattice_start_nodes(M, L, device=edge_log_potentials.device)
+    edge_log_potentials = edge_log_potentials.clamp(min=SCAN_NEGINF)
+    incoming = edge_log_potentials.masked_fill(~band, SCAN_NEGINF).transpose(-1, -2) # B' x L x M
+    constant = edge_log_potentials.masked_fill(band, SCAN_NEGINF).logsumexp(-2)[..., None] # B' x L x 1
+    shift = edge_log_potentials.new_full((S - 1, S), SCAN_NEGINF)
+    shift[torch.arange(S - 2), torch.arange(S - 2)] = 0 # node i-k becomes node (i+1)-(k+1)
+    shift[-1, -1] = 0 # and the constant stays
+    transfer = torch.cat([torch.cat([incoming, constant], dim=-1)[:, :, None, :], shift.expand(B, L, S - 1, S)], dim=2)
+
+    prefix = transfer # prefix[:, i] = transfer[:, i] ... transfer[:, 0] after ceil(log2 L) rounds
+    d = 1
+    while d < L:
+        prefix = torch.cat([prefix[:, :d], (prefix[:, d:, :, :, None] + prefix[:, :-d, None, :, :]).logsumexp(-2)], dim=1)
+        d *= 2
+    node_log_alphas = torch.cat([edge_log_potentials.new_zeros(B, 1), prefix[:, :, 0].logsumexp(-1)], dim=1)
+    return node_log_alphas.masked_fill(node_log_alphas <= SCAN_NEGINF / 2, NONEDGE_LOGPOT) # unreachable nodes
+
+def forward_algorithm(edge_log_potentials: torch.FloatTensor, return_node_contribution=False, scan_min_length=None):
+    """
+    Forward algorithm over ... x M x L edge log potentials. Blocks that are at least `scan_min_length` long use
+    `scan_node_log_alphas` instead of the (analytically differentiated) loop.
+    """
     size = edge_log_potentials.size()
     device = edge_log_potentials.device
     M, L = size[-2:]
     size_prefix = size[:-2]
-    edge_log_alphas = edge_log_potentials.reshape(-1, M, L).clone() # this is the edge log alphas without the node contribution
-    node_contributions = 0 if return_node_contribution else None
 
     # forward algorithm (converts internally to B' x M x L where B' collapses all the dimesions in size_prefix into a single one)
-    node_log_alphas = [torch.zeros(edge_log_potentials.numel() // (M * L), device=device, dtype=torch.float)]
-    for i in range(L):
-        # this is to select the outgoing edges of the ith node
-        maski = (torch.diag_embed(torch.ones(L - i, device=device, dtype=torch.bool), offset=i)[:M].unsqueeze(0)) #.to(torch.float)
-
-        # this update corresponds to the propagation of alpha from a node to all `outgoing` edges
-        # node_to_edge = node_log_alphas[i][:, None, None] * maski
-        node_to_edge = node_log_alphas[i][:, None, None].expand_as(edge_log_alphas).clone()
-        node_to_edge[~maski.expand_as(edge_log_alphas)] = 0
-        edge_log_alphas = edge_log_alphas + node_to_edge
-
-        # this is bookkeeping to record the node contributions without adding in the edge potentials
-        if return_node_contribution:
-            node_contributions = node_contributions + node_to_edge
+    edge_log_potentials = edge_log_potentials.reshape(-1, M, L)
+    if scan_min_length is not None and L >= scan_min_length:
+        node_log_alphas = scan_node_log_alphas(edge_log_potentials)
+    else:
+        node_log_alphas = ForwardAlgorithmFunction.apply(edge_log_potentials)
 
-        # this update corresponds to aggregating the `incoming` edge-alphas into the alpha of a node
-        node_log_alphas.append(edge_log_alphas[..., i].logsumexp(-1))
+    # propagate the alpha of every node to all its `outgoing` edges
+    start, band = lattice_start_nodes(M, L, device=device)
+    node_contributions = node_log_alphas[:, start].masked_fill(~band, 0)
+    edge_log_alphas = edge_log_potentials + node_contributions
 
     # converts back to prefix_size
     edge_log_alphas = edge_log_alphas.reshape(*(size_prefix + (M, L)))
-    last_node_log_alphas = node_log_alphas[-1].reshape(*size_prefix)
-    if return_node_contribution:
-        node_contributions = node_contributions.reshape(*(size_prefix + (M,L)))
+    last_node_log_alphas = node_log_alphas[:, -1].reshape(*size_prefix)
+    node_contributions = node_contributions.reshape(*(size_prefix + (M,L))) if return_node_contribution else None
+
+    return ForwardAlgorithmOutput(last_node_log_alphas, edge_log_alphas,
+                                  edge_log_alphas_node_contribution=node_contributions,
+                                  all_node_log_alphas=node_log_alphas.reshape(*(size_prefix + (L + 1,))))
+
+def segment_logsumexp(values: torch.FloatTensor, segments: torch.LongTensor, num_segments: int):
+    """
+    logsumexp of values (E) grouped by segments (E), empty segments are NONEDGE_LOGPOT.
+    """
+    maxes = values.new_full((num_segments,), NONEDGE_LOGPOT).scatter_reduce(0, segments, values.detach(), "amax")
+    sums = values.new_zeros(num_segments).index_add(0, segments, (values - maxes[segments]).exp())
+    return maxes + sums.masked_fill(sums == 0, 1.0).log()
+
+def sparse_forward_algorithm(sparse_encoding: SparseEncoding, edge_log_potentials: torch.FloatTensor):
+    """
+    forward_algorithm over a SparseEncoding, where edge_log_potentials (E) are the potentials of its edges. Every
+    step only touches the incoming edges of one node, so the work scales with the number of edges instead of M x L.
+
+    Returns a ForwardAlgorithmOutput with edge_log_alphas of size E.
+    """
+    M, L = sparse_encoding.size[-2:]
+    size_prefix = sparse_encoding.size[:-2]
+    B = sparse_encoding.num_lattices
+    offsets = sparse_encoding.node_offsets.tolist()
+    lattice, unit_length = sparse_encoding.lattice, sparse_encoding.end - sparse_encoding.start - 1
+
+    window = edge_log_potentials.new_zeros(B, M) # window[:, k] = alpha of node n-1-k
+    node_log_alphas = [window[:, 0]]
+    for n in range(1, L + 1):
+        edges = slice(offsets[n - 1], offsets[n])
+        node_log_alphas.append(segment_logsumexp(edge_log_potentials[edges] + window[lattice[edges], unit_length[edges]], lattice[edges], B))
+        window = torch.cat([node_log_alphas[-1][:, None], window[:, :-1]], dim=1)
+    node_log_alphas = torch.stack(node_log_alphas, dim=1)
 
-    return ForwardAlgorithmOutput(last_node_log_alphas, edge_log_alphas, edge_log_alphas_node_contribution=node_contributions)
+    edge_log_alphas = edge_log_potentials + node_log_alphas[lattice, sparse_encoding.start]
+    return ForwardAlgorithmOutput(node_log_alphas[:, -1].reshape(*size_prefix), edge_log_alphas,
+                                  all_node_log_alphas=node_log_alphas.reshape(*(size_prefix + (L + 1,))))
 
 def conditional_marginals(edge_log_potentials: torch.FloatTensor, return_forward=True):
     """
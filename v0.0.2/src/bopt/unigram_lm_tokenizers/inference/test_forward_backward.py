@@ -2,7 +2,8 @@ import math
 
 from bopt.integerize import Integerizer
 from bopt.unigram_lm_tokenizers.encoding.forward_encoding import integerize_for_forward, NONEDGE_ID
-from bopt.unigram_lm_tokenizers.inference.forward_backward import forward_algorithm, conditional_marginals
+from bopt.unigram_lm_tokenizers.inference.forward_backward import forward_algorithm, conditional_marginals, \
+    ForwardAlgorithmFunction
 from bopt.unigram_lm_tokenizers.modeling.unigramlm import UnigramLM
 from bopt.unigram_lm_tokenizers.utils.encoding import convert_to_backward_encoding, convert_to_forward_encoding, \
     expand_encodings
@@ -87,6 +88,63 @@ def test_forward_backward():
     assert (torch.tril(forward_attention.exp()) == 0).all()
     assert (torch.triu(backward_attention.exp()) == 0).all()
 
+def unrolled_forward_algorithm(edge_log_potentials):
+    """
+    Reference forward algorithm that autograd differentiates through the unrolled loop.
+    """
+    B, M, L = edge_log_potentials.size()
+    edge_log_alphas = edge_log_potentials
+    node_log_alphas = [edge_log_potentials.new_zeros(B)]
+    for i in range(L):
+        maski = torch.diag_embed(torch.ones(L - i, dtype=torch.bool), offset=i)[:M].unsqueeze(0)
+        node_to_edge = node_log_alphas[i][:, None, None].expand_as(edge_log_alphas).clone()
+        node_to_edge[~maski.expand_as(edge_log_alphas)] = 0
+        edge_log_alphas = edge_log_alphas + node_to_edge
+        node_log_alphas.append(edge_log_alphas[..., i].logsumexp(-1))
+    return torch.stack(node_log_alphas, -1), edge_log_alphas
+
+def test_forward_algorithm_gradient():
+    print("Test Forward Algorithm Gradient")
+    vocabulary = Integerizer(["[UNK]", "h", "a", "t", "e", "hat", "hate", "at", "ate"])
+    encoding = integerize_for_forward(["hate hat", "hat ate"], 2, 4, 5, vocabulary, space_character=" ", split_on_space=True,
+                                       add_dummy_space_start=False, remove_space=True)
+    unigramlm = UnigramLM(len(vocabulary), torch.randn(len(vocabulary), 1, dtype=torch.double), log_space_parametrization=True)
+    output_potentials = unigramlm(encoding).reshape(-1, 4, 5)
+
+    # matches autograd through the unrolled loop, including the -inf nonedges
+    forward_output = forward_algorithm(output_potentials)
+    reference_node_log_alphas, reference_edge_log_alphas = unrolled_forward_algorithm(output_potentials)
+    assert torch.allclose(forward_output.all_node_log_alphas, reference_node_log_alphas)
+    assert torch.equal(forward_output.edge_log_alphas.isinf(), reference_edge_log_alphas.isinf())
+    weights = torch.randn(reference_edge_log_alphas.size(), dtype=torch.double)
+    reference_loss = reference_node_log_alphas[:, -1].sum() + (reference_edge_log_alphas.exp() * weights).sum()
+    reference_grad, = torch.autograd.grad(reference_loss, unigramlm.edge_log_potentials.weight, retain_graph=True)
+    loss = forward_output.last_node_log_alphas.sum() + (forward_output.edge_log_alphas.exp() * weights).sum()
+    grad, = torch.autograd.grad(loss, unigramlm.edge_log_potentials.weight)
+    assert torch.allclose(grad, reference_grad)
+
+    # and finite differences on a dense lattice
+    edge_log_potentials = torch.randn(3, 4, 5, dtype=torch.double, requires_grad=True)
+    assert torch.autograd.gradcheck(ForwardAlgorithmFunction.apply, (edge_log_potentials,))
+    assert torch.autograd.gradcheck(lambda e: forward_algorithm(e, return_node_contribution=True).edge_log_alphas, (edge_log_potentials,))
+
+def test_scan_forward_algorithm():
+    print("Test Scan Forward Algorithm")
+    vocabulary = Integerizer(["[UNK]", "h", "a", "t", "e", "hat", "hate", "at", "ate"])
+    encoding = integerize_for_forward(["hatehatatehat", "atehate"], 1, 4, 13, vocabulary, space_character=" ", split_on_space=False,
+                                       add_dummy_space_start=False)
+    unigramlm = UnigramLM(len(vocabulary), torch.randn(len(vocabulary), 1, dtype=torch.double), log_space_parametrization=True)
+    output_potentials = unigramlm(encoding)
+    loop_output = forward_algorithm(output_potentials, return_node_contribution=True)
+    scan_output = forward_algorithm(output_potentials, return_node_contribution=True, scan_min_length=13)
+    assert torch.allclose(scan_output.all_node_log_alphas, loop_output.all_node_log_alphas)
+    assert torch.allclose(scan_output.edge_log_alphas_node_contribution, loop_output.edge_log_alphas_node_contribution)
+    loop_grad, = torch.autograd.grad(loop_output.last_node_log_alphas.sum(), unigramlm.edge_log_potentials.weight, retain_graph=True)
+    scan_grad, = torch.autograd.grad(scan_output.last_node_log_alphas.sum(), unigramlm.edge_log_potentials.weight)
+    assert torch.allclose(scan_grad, loop_grad)
+
 if __name__ == "__main__":
     test_forward()
-    test_forward_backward()
\ No newline at end of file
+    test_forward_backward()
+    test_forward_algorithm_gradient()
+    test_scan_forward_algorithm()
\ No newline at end of file